@@ -0,0 +1,314 @@
+import collections
+import hashlib
+import os
+import tarfile
+import threading
+
+import docker
+import pytest
+
+
+# An in-process stand-in for the parts of the docker SDK that
+# constellation and beebop use, so that deploy logic can be tested
+# without a docker daemon.  Every call is counted in `client.calls`.
+class FakeDocker:
+    def __init__(self, layers=None):
+        self.lock = threading.Lock()
+        self.calls = collections.Counter()
+        self.api = FakeAPI(self, layers or {})
+        self.images = FakeImages(self)
+        self.containers = FakeContainers(self)
+        self.networks = FakeNetworks(self)
+        self.volumes = FakeVolumes(self)
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+
+class FakeAPI:
+    def __init__(self, client, layers):
+        self.client = client
+        # image ref -> list of (layer id, size)
+        self.layers = layers
+        self.local_layers = set()
+
+    def create_endpoint_config(self, **kwargs):
+        return kwargs
+
+    def containers(self, all=False, filters=None):
+        self.client.count("api.containers")
+        return [{"Id": x.id, "Names": ["/" + x.name],
+                 "Image": x.attrs["Config"]["Image"],
+                 "ImageID": x.image.id, "State": x.status,
+                 "Status": "Up 1 second", "Labels": x.labels}
+                for x in self.client.containers.list(all)]
+
+    def exec_create(self, container_id, cmd):
+        self.client.count("exec_create")
+        container = [x for x in self.client.containers.store.values()
+                     if x.id == container_id][0]
+        self.execs = getattr(self, "execs", {})
+        code, output = self.client.containers.exec_handler(container, cmd)
+        self.execs[container_id] = (code, output)
+        return {"Id": container_id}
+
+    def exec_start(self, exec_id, stream=False):
+        self.client.count("exec_start")
+        return iter([self.execs[exec_id][1]])
+
+    def exec_inspect(self, exec_id):
+        self.client.count("exec_inspect")
+        return {"ExitCode": self.execs[exec_id][0]}
+
+    def pull(self, repository, tag=None, stream=False, decode=False):
+        self.client.count("pull")
+        ref = "{}:{}".format(repository, tag)
+        layers = self.layers.get(ref, [(digest(ref)[:12], 100)])
+        events = []
+        for layer, size in layers:
+            if layer in self.local_layers:
+                events.append({"status": "Already exists", "id": layer})
+            else:
+                events.append({"status": "Pulling fs layer", "id": layer})
+                events.append({"status": "Downloading", "id": layer,
+                               "progressDetail": {"current": size,
+                                                  "total": size}})
+                events.append({"status": "Pull complete", "id": layer})
+        self.local_layers.update(x[0] for x in layers)
+        self.client.images.add(ref, layers)
+        events.append({"status": "Status: Downloaded newer image for " + ref})
+        return iter(events)
+
+
+class FakeImage:
+    def __init__(self, ref, layers):
+        self.tags = [ref]
+        self.layers = layers
+        self.id = "sha256:" + digest(ref + str(layers))
+        self.short_id = self.id[:19]
+        self.attrs = {"Id": self.id,
+                      "RepoDigests": [ref.split(":")[0] + "@" + self.id]}
+
+
+class FakeImages:
+    def __init__(self, client):
+        self.client = client
+        self.store = {}
+
+    def add(self, ref, layers):
+        self.store[ref] = FakeImage(ref, layers)
+
+    def get(self, ref):
+        self.client.count("images.get")
+        if ref not in self.store:
+            raise docker.errors.ImageNotFound(ref)
+        return self.store[ref]
+
+    def pull(self, ref):
+        repository, tag = ref.rsplit(":", 1)
+        list(self.client.api.pull(repository, tag))
+        return self.store[ref]
+
+
+class FakeContainer:
+    def __init__(self, client, image, command, name, **kwargs):
+        self.client = client
+        self.id = digest(name or str(id(self)))
+        self.name = name
+        self.image = client.images.store.get(image) or FakeImage(image, [])
+        self.status = "running"
+        self.files = {}
+        self.modes = {}
+        self.log = []
+        self.usage = {"cpu": 0, "system": 0, "mem": 0}
+        self.labels = kwargs.get("labels") or {}
+        entrypoint = kwargs.get("entrypoint")
+        env = kwargs.get("environment") or {}
+        self.attrs = {"Id": self.id,
+                      "Image": self.image.id,
+                      "Config": {"Image": str(image),
+                                 "Cmd": command,
+                                 "Entrypoint": [entrypoint] if isinstance(
+                                     entrypoint, str) else entrypoint,
+                                 "Env": ["{}={}".format(k, v)
+                                         for k, v in env.items()],
+                                 "Hostname": self.id[:12],
+                                 "Labels": self.labels},
+                      "HostConfig": {
+                          "PortBindings": {
+                              k: [{"HostIp": v[0], "HostPort": str(v[1])}
+                                  if isinstance(v, tuple) else
+                                  {"HostIp": "", "HostPort": str(v)}]
+                              for k, v in (kwargs.get("ports") or {}).items()},
+                          "NanoCpus": kwargs.get("nano_cpus", 0),
+                          "CpuShares": kwargs.get("cpu_shares", 0),
+                          "CpusetCpus": kwargs.get("cpuset_cpus", ""),
+                          "Memory": docker.utils.parse_bytes(
+                              kwargs.get("mem_limit", 0)),
+                          "MemoryReservation": docker.utils.parse_bytes(
+                              kwargs.get("mem_reservation", 0))},
+                      "Mounts": [{"Type": m["Type"], "Name": m["Source"],
+                                  "Destination": m["Target"]}
+                                 for m in kwargs.get("mounts") or []]}
+        self.kwargs = kwargs
+
+    def exec_run(self, cmd, **kwargs):
+        self.client.count("exec_run")
+        return self.client.containers.exec_handler(self, cmd)
+
+    def logs(self, **kwargs):
+        self.client.count("logs")
+        self.logs_with = kwargs
+        return iter(self.log)
+
+    def stats(self, stream=True, one_shot=False):
+        self.client.count("stats")
+        return {"cpu_stats": {"cpu_usage": {"total_usage": self.usage["cpu"]},
+                              "system_cpu_usage": self.usage["system"],
+                              "online_cpus": 4},
+                "memory_stats": {"usage": self.usage["mem"],
+                                 "limit": 8 * 1024 ** 3}}
+
+    def put_archive(self, path, data):
+        self.client.count("put_archive")
+        with tarfile.open(fileobj=data) as tar:
+            for member in tar.getmembers():
+                name = os.path.normpath(os.path.join(path, member.name))
+                self.files[name] = tar.extractfile(member).read()
+                self.modes[name] = member.mode
+        return True
+
+    def reload(self):
+        self.client.count("reload")
+
+    def start(self):
+        self.client.count("start")
+        self.status = "running"
+
+    def rename(self, name):
+        self.client.count("rename")
+        store = self.client.containers.store
+        store[name] = store.pop(self.name)
+        self.name = name
+
+    def stop(self, **kwargs):
+        self.client.count("stop")
+        self.stopped_with = kwargs
+        self.status = "exited"
+
+    def kill(self):
+        self.client.count("kill")
+        self.status = "exited"
+
+    def remove(self, **kwargs):
+        self.client.count("remove")
+        self.removed = True
+        self.client.containers.store.pop(self.name, None)
+
+
+class FakeContainers:
+    def __init__(self, client):
+        self.client = client
+        self.store = {}
+        self.runs = []
+        self.exec_handler = lambda container, cmd: (0, b"")
+
+    def run(self, image, command=None, name=None, remove=False, **kwargs):
+        self.client.count("run")
+        self.runs.append((image, command, kwargs))
+        if remove:
+            return b""
+        x = FakeContainer(self.client, image, command, name, **kwargs)
+        self.store[name] = x
+        return x
+
+    def create(self, image, command=None, name=None, **kwargs):
+        self.client.count("create")
+        self.runs.append((image, command, kwargs))
+        x = FakeContainer(self.client, image, command, name, **kwargs)
+        x.status = "created"
+        self.store[name] = x
+        return x
+
+    def get(self, name):
+        self.client.count("containers.get")
+        if name not in self.store:
+            raise docker.errors.NotFound(name)
+        return self.store[name]
+
+    def list(self, all=False, **kwargs):
+        self.client.count("containers.list")
+        return [x for x in self.store.values()
+                if all or x.status == "running"]
+
+
+class FakeNetwork:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def connect(self, container, **kwargs):
+        self.client.count("connect")
+
+    def disconnect(self, container, **kwargs):
+        self.client.count("disconnect")
+
+    def remove(self):
+        self.client.count("networks.remove")
+        self.client.networks.store.pop(self.name, None)
+
+
+class FakeNetworks:
+    def __init__(self, client):
+        self.client = client
+        self.store = {"none": FakeNetwork(client, "none")}
+
+    def get(self, name):
+        self.client.count("networks.get")
+        if name not in self.store:
+            raise docker.errors.NotFound(name)
+        return self.store[name]
+
+    def create(self, name, **kwargs):
+        self.client.count("networks.create")
+        self.store[name] = FakeNetwork(self.client, name)
+        return self.store[name]
+
+
+class FakeVolume:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def remove(self, *args):
+        self.client.count("volumes.remove")
+        self.client.volumes.store.pop(self.name, None)
+
+
+class FakeVolumes:
+    def __init__(self, client):
+        self.client = client
+        self.store = {}
+
+    def get(self, name):
+        self.client.count("volumes.get")
+        if name not in self.store:
+            raise docker.errors.NotFound(name)
+        return self.store[name]
+
+    def create(self, name, **kwargs):
+        self.client.count("volumes.create")
+        self.store[name] = FakeVolume(self.client, name)
+        return self.store[name]
+
+
+def digest(x):
+    return hashlib.sha256(x.encode("utf-8")).hexdigest()
+
+
+@pytest.fixture
+def fake_docker(monkeypatch):
+    client = FakeDocker()
+    monkeypatch.setattr(docker.client, "from_env", lambda **kwargs: client)
+    return client
@@ -0,0 +1,261 @@
+"""Benchmark the indexed storage migration against the original
+os.walk based implementation over a synthetic poppunk_output tree.
+
+    python3 benchmark.py [n_projects] [n_clusters] [repeats]
+
+The tree is created under TMPDIR, so point that at the kind of
+filesystem you want to measure. Each round creates a fresh tree per
+implementation and flushes it to disk before timing; the order of the
+implementations rotates between rounds, so that write-back from one
+run does not always land in the same other run, and the median of the
+rounds is reported.
+
+The original functions are kept here (unchanged) both for comparison
+and so that the tests can check the two produce identical trees.
+"""
+import logging
+import os
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "..", "src"))
+sys.path.insert(0, HERE)
+
+import beebop_storage  # noqa: E402
+import migration  # noqa: E402
+
+
+def make_tree(base_folder, n_projects, n_clusters):
+    """Create a pre-migration poppunk_output tree."""
+    for i in range(n_projects):
+        project = os.path.join(base_folder, f"project{i}")
+        network = os.path.join(project, "network")
+        os.makedirs(network)
+        for file in ["network_cytoscape.csv", "network.csv"]:
+            with open(os.path.join(network, file), "w") as f:
+                f.write("id,cluster\n")
+        for c in range(1, n_clusters + 1):
+            with open(os.path.join(
+                    network, f"network_component_{c}.graphml"), "w") as f:
+                f.write("<graphml/>")
+            microreact = os.path.join(project, f"microreact_{c}")
+            os.makedirs(microreact)
+            with open(os.path.join(
+                    microreact, f"microreact_{c}_core_NJ.nwk"), "w") as f:
+                f.write("();")
+
+
+def legacy_migrate(base_folder, logger):
+    all_folders = get_all_folders(get_output_folders(base_folder))
+    add_pruned_graphmls(all_folders, logger)
+    updated = rename_microreact_to_visualise(all_folders, logger)
+    move_network_files_to_visualise(updated, logger)
+
+
+def indexed_migrate(base_folder, logger):
+    index = beebop_storage.index_folders(base_folder)
+    plans = migration.plan_storage_migration(index, logger)
+    beebop_storage.run_operations(base_folder, plans, logger)
+
+
+def get_output_folders(base_folder):
+    # return all old output folders(that have network folder in them)
+    return [
+        os.path.join(base_folder, item)
+        for item in os.listdir(base_folder)
+        if os.path.isdir(os.path.join(base_folder, item))
+        and os.path.exists(os.path.join(base_folder, item, "network"))
+    ]
+
+
+def get_all_folders(output_folders):
+    """Get all subdirectories for processing."""
+    all_folders = []
+    for folder_path in output_folders:
+        for root, dirs, files in os.walk(folder_path):
+            for dir in dirs:
+                all_folders.append(os.path.join(root, dir))
+    return all_folders
+
+
+def add_pruned_graphmls(all_folders, logger):
+    """Add pruned graphml files if not already present."""
+    logger.info("Adding pruned graphml files...")
+    for folder_path in all_folders:
+        folder_name = os.path.basename(folder_path)
+        if folder_name == "network":
+            for root, dirs, files in os.walk(folder_path):
+                for file in files:
+                    if file.startswith("network_component"):
+                        new_file_name = file.replace(
+                            "network_component", "pruned_network_component"
+                        )
+                        new_file = os.path.join(folder_path, new_file_name)
+                        if not os.path.exists(new_file):
+                            logger.info(
+                                f"Copying {file} to pruned version"
+                                f" {new_file_name}"
+                            )
+                            shutil.copyfile(
+                                os.path.join(folder_path, file), new_file
+                            )
+                        else:
+                            logger.info(
+                                f"Pruned version of {file} already exists"
+                            )
+
+
+def rename_microreact_to_visualise(all_folders, logger):
+    """Rename microreact folders and files to visualise."""
+    logger.info("Renaming microreact folders and files to visualise...")
+    updated_folders = all_folders.copy()
+
+    for i, folder_path in enumerate(all_folders):
+        folder_name = os.path.basename(folder_path)
+        if folder_name.startswith("microreact_"):
+            new_folder_name = folder_name.replace("microreact_", "visualise_")
+            new_folder_path = os.path.join(
+                os.path.dirname(folder_path), new_folder_name
+            )
+            if not os.path.exists(new_folder_path):
+                os.rename(folder_path, new_folder_path)
+                logger.info(
+                    f"Renamed folder: {folder_name} → {new_folder_name}"
+                )
+                # Update the folder path in the list
+                updated_folders[i] = new_folder_path
+
+            # Rename files within the folder
+            for root, dirs, files in os.walk(new_folder_path):
+                for file in files:
+                    if file.startswith("microreact_"):
+                        new_file_name = file.replace(
+                            "microreact_", "visualise_", 1
+                        )
+                        new_file = os.path.join(root, new_file_name)
+                        old_file = os.path.join(root, file)
+                        if not os.path.exists(new_file):
+                            os.rename(old_file, new_file)
+                            logger.info(
+                                f"Renamed file: {file} → {new_file_name}"
+                            )
+
+    return updated_folders
+
+
+def move_network_files_to_visualise(all_folders, logger):
+    """Move network files to visualise folders."""
+    logger.info("Moving network files to visualise folders...")
+    for folder_path in all_folders:
+        folder_name = os.path.basename(folder_path)
+        if folder_name == "network":
+            parent_folder = os.path.dirname(folder_path)
+
+            # Process CSV files
+            move_csv_files(folder_path, parent_folder, logger)
+
+            # Process GraphML files
+            move_graphml_files(folder_path, parent_folder, logger)
+
+
+def move_csv_files(network_folder, parent_folder, logger):
+    """Move CSV files from network folder to visualise folders."""
+    for file in os.listdir(network_folder):
+        if file.endswith(".csv"):
+            for dir_name in os.listdir(parent_folder):
+                if os.path.isdir(
+                    os.path.join(parent_folder, dir_name)
+                ) and dir_name.startswith("visualise_"):
+                    # Rename file
+                    new_fname = file.replace("network", dir_name)
+                    new_fname_path = os.path.join(network_folder, new_fname)
+
+                    if not os.path.exists(new_fname_path):
+                        shutil.copyfile(
+                            os.path.join(network_folder, file), new_fname_path
+                        )
+                        logger.info(f"Copied file: {file} → {new_fname}")
+
+                    # Move file to visualise folder
+                    visualise_folder = os.path.join(parent_folder, dir_name)
+                    if not os.path.exists(
+                        os.path.join(visualise_folder, new_fname)
+                    ):
+                        shutil.move(new_fname_path, visualise_folder)
+                        logger.info(
+                            f"Moved file: {new_fname} → {visualise_folder}"
+                        )
+
+
+def move_graphml_files(network_folder, parent_folder, logger):
+    """Move GraphML files from network folder to visualise folders."""
+    for file in os.listdir(network_folder):
+        if file.endswith(".graphml"):
+            # Get lowest cluster number (assigned cluster)
+            cluster_nums = re.findall(r"\d+", file)
+            if not cluster_nums:
+                logger.warning(f"No cluster numbers found in {file}")
+                continue
+
+            cluster_num = min(map(int, cluster_nums))
+            visualise_dir = f"visualise_{cluster_num}"
+            visualise_path = os.path.join(parent_folder, visualise_dir)
+
+            if os.path.exists(visualise_path):
+                new_fname = file.replace("network", visualise_dir)
+                new_fname_path = os.path.join(network_folder, new_fname)
+
+                if not os.path.exists(new_fname_path):
+                    os.rename(
+                        os.path.join(network_folder, file), new_fname_path
+                    )
+                    logger.info(f"Renamed file: {file} → {new_fname}")
+
+                # Move file to visualise folder
+                if not os.path.exists(os.path.join(visualise_path, new_fname)):
+                    shutil.move(new_fname_path, visualise_path)
+                    logger.info(f"Moved file: {new_fname} → {visualise_path}")
+
+
+IMPLEMENTATIONS = {
+    "original": legacy_migrate,
+    "indexed": indexed_migrate
+}
+
+
+def time_once(f, n_projects, n_clusters, logger):
+    with tempfile.TemporaryDirectory() as tmp:
+        base_folder = os.path.join(tmp, "poppunk_output")
+        make_tree(base_folder, n_projects, n_clusters)
+        os.sync()
+        t0 = time.perf_counter()
+        f(base_folder, logger)
+        os.sync()
+        return time.perf_counter() - t0
+
+
+def main(n_projects=2000, n_clusters=5, repeats=5):
+    logger = logging.getLogger("benchmark")
+    logger.disabled = True
+    names = list(IMPLEMENTATIONS)
+    times = {name: [] for name in names}
+    for i in range(repeats):
+        for name in names[i % len(names):] + names[:i % len(names)]:
+            times[name].append(time_once(IMPLEMENTATIONS[name], n_projects,
+                                         n_clusters, logger))
+    print(f"{n_projects} projects with {n_clusters} clusters,"
+          f" median of {repeats} runs:")
+    for name in names:
+        print(f"  {name}: {statistics.median(times[name]):.2f}s"
+              f" (min {min(times[name]):.2f}s,"
+              f" max {max(times[name]):.2f}s)")
+    return times
+
+
+if __name__ == "__main__":
+    main(*[int(x) for x in sys.argv[1:]])
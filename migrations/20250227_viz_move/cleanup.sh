@@ -14,8 +14,12 @@ fi
 
 # Delete redis keys
 docker cp cleanup_redis.py $CONTAINER_NAME:/beebop/storage
+docker cp ../../src/beebop_redis.py $CONTAINER_NAME:/beebop/storage
 docker exec $CONTAINER_NAME python3 /beebop/storage/cleanup_redis.py
 
 # Remove py scripts inside the container
 docker exec $CONTAINER_NAME rm -f /beebop/storage/migration.py
 docker exec $CONTAINER_NAME rm -f /beebop/storage/cleanup_redis.py
+docker exec $CONTAINER_NAME rm -f /beebop/storage/beebop_redis.py
+docker exec $CONTAINER_NAME rm -f /beebop/storage/beebop_storage.py
+docker exec $CONTAINER_NAME rm -f /beebop/storage/beebop_journal.py
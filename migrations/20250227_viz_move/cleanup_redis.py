@@ -1,19 +1,20 @@
 import redis
 import logging
 
+import beebop_redis
 
-def main(logger):
+
+def main(logger, r=None, batch_size=500, throttle=0.01):
     logger.info("Removing Redis keys...")
-    r = redis.Redis(host="beebop-redis")
+    r = r or redis.Redis(host="beebop-redis")
 
-    if r.exists("beebop:hash:job:microreact"):
-        r.delete("beebop:hash:job:microreact")
+    if beebop_redis.unlink_keys(r, ["beebop:hash:job:microreact"]):
         logger.info("Successfully deleted key 'beebop:hash:job:microreact'")
 
-    microreact_cluster_keys = r.keys("beebop:hash:job:microreact:*")
-    for key in microreact_cluster_keys:
-        r.delete(key)
-        logger.info(f"Successfully deleted key {key.decode('utf-8')}")
+    removed = beebop_redis.unlink_matching(
+        r, "beebop:hash:job:microreact:*", batch_size, throttle)
+    logger.info(f"Successfully deleted {removed} keys"
+                " 'beebop:hash:job:microreact:*'")
 
 
 if __name__ == "__main__":
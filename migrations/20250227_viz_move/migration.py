@@ -4,6 +4,12 @@ import re
 import redis
 import logging
 
+import beebop_journal
+import beebop_redis
+import beebop_storage
+
+NAME = "20250227_viz_move"
+
 
 def setup_logging():
     """Configure logging for the migration script."""
@@ -15,36 +21,57 @@ def setup_logging():
     return logging.getLogger("migration")
 
 
-def create_backup(base_folder, logger):
-    """Create backups of all output folders before migration."""
-    logger.info("Creating backups of output folders...")
+def create_backup(base_folder, logger, plans=None):
+    """Create backups of output folders before migration.
 
-    shutil.copytree(base_folder, base_folder + "_backup")
+    Given the planned operations, only the paths they touch are backed
+    up (see beebop_storage.create_snapshot); otherwise the whole of
+    base_folder is copied."""
+    logger.info("Creating backups of output folders...")
+    backup_folder = base_folder + "_backup"
+    partial = backup_folder + ".partial"
+
+    # A completed backup, whether from this script or an earlier
+    # run.sh, is never replaced
+    if os.path.exists(backup_folder):
+        raise Exception(
+            f"{backup_folder} already exists; roll back or remove it first"
+        )
 
-    logger.info("Created backup of poppunk_output")
+    # The backup is only moved into place once complete, so anything
+    # here is left over from an interrupted backup
+    if os.path.exists(partial):
+        shutil.rmtree(partial)
 
+    if plans is None:
+        shutil.copytree(base_folder, partial)
+    else:
+        beebop_storage.create_snapshot(base_folder, partial, plans, logger)
+    os.rename(partial, backup_folder)
 
-def get_output_folders(base_folder):
-    # return all old output folders(that have network folder in them)
-    return [
-        os.path.join(base_folder, item)
-        for item in os.listdir(base_folder)
-        if os.path.isdir(os.path.join(base_folder, item))
-        and os.path.exists(os.path.join(base_folder, item, "network"))
-    ]
+    logger.info("Created backup of poppunk_output")
 
 
-def update_redis_keys(logger):
+def update_redis_keys(logger, r=None, batch_size=500, throttle=0.01,
+                      dry_run=False):
     """Update Redis job keys to match new structure."""
     logger.info("Updating Redis keys...")
-    r = redis.Redis(host="beebop-redis")
+    r = r or redis.Redis(host="beebop-redis")
+
+    if dry_run:
+        n = sum(len(keys) for keys in beebop_redis.scan_keys(
+            r, "beebop:hash:job:microreact*", batch_size))
+        logger.info(
+            f"Would copy {n} keys 'beebop:hash:job:microreact*' to"
+            " 'beebop:hash:job:visualise*' (about"
+            f" {beebop_redis.estimate_seconds(n, batch_size, throttle):.1f}s)"
+        )
+        return
 
     # Copy the Redis key from "beebop:hash:job:microreact"
     # to "beebop:hash:job:visualise"
-    if r.exists("beebop:hash:job:microreact"):
-        microreact_data = r.hgetall("beebop:hash:job:microreact")
-        for field, value in microreact_data.items():
-            r.hset("beebop:hash:job:visualise", field, value)
+    if beebop_redis.copy_hashes(r, ["beebop:hash:job:microreact"],
+                                lambda key: "beebop:hash:job:visualise"):
         logger.info(
             "Successfully copied key from 'beebop:hash:job:microreact' to"
             " 'beebop:hash:job:visualise'"
@@ -52,196 +79,164 @@ def update_redis_keys(logger):
     else:
         logger.info("Source key 'beebop:hash:job:microreact' does not exist")
 
-    # Copy the Redis keys for each cluster
-    microreact_cluster_keys = r.keys("beebop:hash:job:microreact:*")
-    for key in microreact_cluster_keys:
-        phash = key.decode("utf-8").split(":")[-1]
-        microreact_data = r.hgetall(key)
-        for field, value in microreact_data.items():
-            r.hset(f"beebop:hash:job:visualise:{phash}", field, value)
-        logger.info(
-            "Successfully copied key from"
-            f" 'beebop:hash:job:microreact:{phash}' to"
-            f" 'beebop:hash:job:visualise:{phash}'"
-        )
+    # Copy the Redis keys for each cluster, scanning and writing in
+    # batches so that live workers are not blocked
+    copied = beebop_redis.copy_matching_hashes(
+        r, "beebop:hash:job:microreact:*",
+        lambda key: "beebop:hash:job:visualise:" + key.split(":")[-1],
+        batch_size, throttle)
+    logger.info(
+        f"Successfully copied {len(copied)} keys from"
+        " 'beebop:hash:job:microreact:*' to 'beebop:hash:job:visualise:*'"
+    )
+
 
+def plan_output_folder(name, folders, logger):
+    """Plan the file operations for one output folder from its index
+    entry, updating the entry to reflect each planned operation."""
+    ops = []
+    network = folders["network"]
 
-def get_all_folders(output_folders):
-    """Get all subdirectories for processing."""
-    all_folders = []
-    for folder_path in output_folders:
-        for root, dirs, files in os.walk(folder_path):
-            for dir in dirs:
-                all_folders.append(os.path.join(root, dir))
-    return all_folders
-
-
-def add_pruned_graphmls(all_folders, logger):
-    """Add pruned graphml files if not already present."""
-    logger.info("Adding pruned graphml files...")
-    for folder_path in all_folders:
-        folder_name = os.path.basename(folder_path)
-        if folder_name == "network":
-            for root, dirs, files in os.walk(folder_path):
-                for file in files:
-                    if file.startswith("network_component"):
-                        new_file_name = file.replace(
-                            "network_component", "pruned_network_component"
-                        )
-                        new_file = os.path.join(folder_path, new_file_name)
-                        if not os.path.exists(new_file):
-                            logger.info(
-                                f"Copying {file} to pruned version"
-                                f" {new_file_name}"
-                            )
-                            shutil.copyfile(
-                                os.path.join(folder_path, file), new_file
-                            )
-                        else:
-                            logger.info(
-                                f"Pruned version of {file} already exists"
-                            )
-
-
-def rename_microreact_to_visualise(all_folders, logger):
-    """Rename microreact folders and files to visualise."""
-    logger.info("Renaming microreact folders and files to visualise...")
-    updated_folders = all_folders.copy()
-
-    for i, folder_path in enumerate(all_folders):
-        folder_name = os.path.basename(folder_path)
-        if folder_name.startswith("microreact_"):
-            new_folder_name = folder_name.replace("microreact_", "visualise_")
-            new_folder_path = os.path.join(
-                os.path.dirname(folder_path), new_folder_name
+    def add(op, src, dst):
+        ops.append((op, f"{name}/{src}", f"{name}/{dst}"))
+
+    def top_level(files, suffix=""):
+        return sorted(x for x in files if "/" not in x and x.endswith(suffix))
+
+    # Add pruned graphml files if not already present
+    for file in top_level(network):
+        if file.startswith("network_component"):
+            new_file = file.replace(
+                "network_component", "pruned_network_component"
             )
-            if not os.path.exists(new_folder_path):
-                os.rename(folder_path, new_folder_path)
-                logger.info(
-                    f"Renamed folder: {folder_name} → {new_folder_name}"
+            if new_file not in network:
+                add("copy", f"network/{file}", f"network/{new_file}")
+                network.add(new_file)
+
+    # Rename microreact folders and files to visualise
+    for folder in sorted(x for x in folders if x.startswith("microreact_")):
+        new_folder = folder.replace("microreact_", "visualise_")
+        if new_folder not in folders:
+            add("rename", folder, new_folder)
+            folders[new_folder] = folders.pop(folder)
+        files = folders[new_folder]
+        for file in sorted(files):
+            parent, base = os.path.split(file)
+            if base.startswith("microreact_"):
+                new_file = os.path.join(
+                    parent, base.replace("microreact_", "visualise_", 1)
                 )
-                # Update the folder path in the list
-                updated_folders[i] = new_folder_path
-
-            # Rename files within the folder
-            for root, dirs, files in os.walk(new_folder_path):
-                for file in files:
-                    if file.startswith("microreact_"):
-                        new_file_name = file.replace(
-                            "microreact_", "visualise_", 1
-                        )
-                        new_file = os.path.join(root, new_file_name)
-                        old_file = os.path.join(root, file)
-                        if not os.path.exists(new_file):
-                            os.rename(old_file, new_file)
-                            logger.info(
-                                f"Renamed file: {file} → {new_file_name}"
-                            )
-
-    return updated_folders
-
-
-def move_network_files_to_visualise(all_folders, logger):
-    """Move network files to visualise folders."""
-    logger.info("Moving network files to visualise folders...")
-    for folder_path in all_folders:
-        folder_name = os.path.basename(folder_path)
-        if folder_name == "network":
-            parent_folder = os.path.dirname(folder_path)
-
-            # Process CSV files
-            move_csv_files(folder_path, parent_folder, logger)
-
-            # Process GraphML files
-            move_graphml_files(folder_path, parent_folder, logger)
-
-
-def move_csv_files(network_folder, parent_folder, logger):
-    """Move CSV files from network folder to visualise folders."""
-    for file in os.listdir(network_folder):
-        if file.endswith(".csv"):
-            for dir_name in os.listdir(parent_folder):
-                if os.path.isdir(
-                    os.path.join(parent_folder, dir_name)
-                ) and dir_name.startswith("visualise_"):
-                    # Rename file
-                    new_fname = file.replace("network", dir_name)
-                    new_fname_path = os.path.join(network_folder, new_fname)
-
-                    if not os.path.exists(new_fname_path):
-                        shutil.copyfile(
-                            os.path.join(network_folder, file), new_fname_path
-                        )
-                        logger.info(f"Copied file: {file} → {new_fname}")
-
-                    # Move file to visualise folder
-                    visualise_folder = os.path.join(parent_folder, dir_name)
-                    if not os.path.exists(
-                        os.path.join(visualise_folder, new_fname)
-                    ):
-                        shutil.move(new_fname_path, visualise_folder)
-                        logger.info(
-                            f"Moved file: {new_fname} → {visualise_folder}"
-                        )
-
-
-def move_graphml_files(network_folder, parent_folder, logger):
-    """Move GraphML files from network folder to visualise folders."""
-    for file in os.listdir(network_folder):
-        if file.endswith(".graphml"):
-            # Get lowest cluster number (assigned cluster)
-            cluster_nums = re.findall(r"\d+", file)
-            if not cluster_nums:
-                logger.warning(f"No cluster numbers found in {file}")
-                continue
-
-            cluster_num = min(map(int, cluster_nums))
-            visualise_dir = f"visualise_{cluster_num}"
-            visualise_path = os.path.join(parent_folder, visualise_dir)
-
-            if os.path.exists(visualise_path):
-                new_fname = file.replace("network", visualise_dir)
-                new_fname_path = os.path.join(network_folder, new_fname)
-
-                if not os.path.exists(new_fname_path):
-                    os.rename(
-                        os.path.join(network_folder, file), new_fname_path
-                    )
-                    logger.info(f"Renamed file: {file} → {new_fname}")
-
-                # Move file to visualise folder
-                if not os.path.exists(os.path.join(visualise_path, new_fname)):
-                    shutil.move(new_fname_path, visualise_path)
-                    logger.info(f"Moved file: {new_fname} → {visualise_path}")
-
-
-def main():
+                if new_file not in files:
+                    add("rename", f"{new_folder}/{file}",
+                        f"{new_folder}/{new_file}")
+                    files.remove(file)
+                    files.add(new_file)
+
+    # Copy CSV files from the network folder to each visualise folder,
+    # and move GraphML files to the visualise folder of their lowest
+    # cluster number (assigned cluster). Where the intermediate file
+    # in the network folder would be moved straight away, copy or
+    # rename directly into the visualise folder instead.
+    def place(op, file, folder):
+        new_file = file.replace("network", folder)
+        target = folders[folder]
+        if op == "copy" and new_file in target:
+            # Already copied by a previous run; unlike the original
+            # implementation, don't leave a stray copy in network
+            return
+        if new_file not in network and new_file not in target:
+            add(op, f"network/{file}", f"{folder}/{new_file}")
+            target.add(new_file)
+            if op == "rename":
+                network.remove(file)
+            return
+        if new_file not in network:
+            add(op, f"network/{file}", f"network/{new_file}")
+            network.add(new_file)
+            if op == "rename":
+                network.remove(file)
+        if new_file not in target:
+            add("move", f"network/{new_file}", f"{folder}/{new_file}")
+            network.discard(new_file)
+            target.add(new_file)
+
+    visualise = sorted(x for x in folders if x.startswith("visualise_"))
+    for file in top_level(network, ".csv"):
+        for folder in visualise:
+            place("copy", file, folder)
+
+    for file in top_level(network, ".graphml"):
+        cluster_nums = re.findall(r"\d+", file)
+        if not cluster_nums:
+            logger.warning(f"No cluster numbers found in {file}")
+            continue
+        folder = f"visualise_{min(map(int, cluster_nums))}"
+        if folder in folders:
+            place("rename", file, folder)
+
+    return ops
+
+
+def plan_storage_migration(index, logger):
+    """Plan operations for all old output folders (those with a network
+    folder in them)."""
+    return {
+        name: plan_output_folder(name, folders, logger)
+        for name, folders in index.items()
+        if "network" in folders
+    }
+
+
+def main(argv=None):
     """Main function to orchestrate the migration."""
     logger = setup_logging()
     logger.info("Starting data migration script")
+    args = beebop_journal.parse_args(NAME, argv)
 
     base_folder = "/beebop/storage/poppunk_output"
+    migration = beebop_journal.Migration(NAME, args.journal, logger)
+
+    # Index output folders in a single pass and plan pruned GraphML
+    # copies, microreact to visualise renames and moves of network
+    # files to visualise folders. This is always rerun, so resuming
+    # only plans what is left to do.
+    @migration.step(journal=False)
+    def plan(state, dry_run):
+        index = beebop_storage.index_folders(base_folder)
+        state["plans"] = plan_storage_migration(index, logger)
+
+    # Back up the paths the plan touches
+    @migration.step(after=["plan"])
+    def backup(state, dry_run):
+        if dry_run:
+            manifest = beebop_storage.snapshot_plan(state["plans"])
+            logger.info(f"Would back up {len(manifest['saved'])} paths")
+        else:
+            create_backup(base_folder, logger, state["plans"])
+
+    # Update Redis keys; independent of the file changes
+    @migration.step()
+    def redis_keys(state, dry_run):
+        update_redis_keys(logger, dry_run=dry_run)
+
+    # Apply the planned operations
+    @migration.step(after=["backup"])
+    def files(state, dry_run):
+        plans = state["plans"]
+        if dry_run:
+            for ops in plans.values():
+                for op, src, dst in ops:
+                    logger.info(f"Would {op}: {src} → {dst}")
+            n = sum(len(ops) for ops in plans.values())
+            logger.info(
+                f"Would apply {n} file operations (about"
+                f" {beebop_storage.estimate_seconds(plans):.1f}s)"
+            )
+        else:
+            n = beebop_storage.run_operations(base_folder, plans, logger)
+            logger.info(f"Applied {n} file operations")
 
-    # Step 1: Create backups
-    create_backup(base_folder, logger)
-
-    # Step 2: get output_folders
-    output_folders = get_output_folders(base_folder)
-
-    # Step 3: Update Redis keys
-    update_redis_keys(logger)
-
-    # Step 4: Get all folders for processing
-    all_folders = get_all_folders(output_folders)
-
-    # Step 5: Add pruned GraphML files
-    add_pruned_graphmls(all_folders, logger)
-
-    # Step 6: Rename microreact to visualise
-    updated_all_folders = rename_microreact_to_visualise(all_folders, logger)
-
-    # Step 7: Move network files to visualise folders
-    move_network_files_to_visualise(updated_all_folders, logger)
+    migration.run(args.dry_run)
 
     logger.info("Migration completed successfully")
 
@@ -0,0 +1,17 @@
+import logging
+
+import beebop_storage
+
+
+def main(logger):
+    base_folder = "/beebop/storage/poppunk_output"
+    beebop_storage.restore_snapshot(
+        base_folder, base_folder + "_backup", logger
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger(__name__)
+
+    main(logger)
@@ -1,17 +1,23 @@
 set -eu
 CONTAINER_NAME="beebop-api"
-OUTPUT_FOLDER=/beebop/storage/poppunk_output
 BACKUP_FOLDER=/beebop/storage/poppunk_output_backup
 
 # Check if backup_folder exists inside the container
 if docker exec $CONTAINER_NAME test -d $BACKUP_FOLDER; then
-    # Remove output_folder and copy backup_folder to output_folder
-    docker exec $CONTAINER_NAME rm -rf $OUTPUT_FOLDER
-    docker exec $CONTAINER_NAME mv $BACKUP_FOLDER $OUTPUT_FOLDER
+    # Undo the paths the migration touched using the backup manifest, or
+    # put back a full copy made before backups had one
+    docker cp rollback.py $CONTAINER_NAME:/beebop/storage
+    docker cp ../../src/beebop_storage.py $CONTAINER_NAME:/beebop/storage
+    docker exec $CONTAINER_NAME python3 /beebop/storage/rollback.py
+    docker exec $CONTAINER_NAME rm -rf $BACKUP_FOLDER
     echo "Successfully restored PopPUNK output from backup."
 else
     echo "Backup folder $BACKUP_FOLDER does not exist inside the container."
 fi
 
-# Remove migration.py inside the container
-docker exec $CONTAINER_NAME rm -f /beebop/storage/migration.py
\ No newline at end of file
+# Remove migration scripts inside the container
+docker exec $CONTAINER_NAME rm -f /beebop/storage/migration.py
+docker exec $CONTAINER_NAME rm -f /beebop/storage/rollback.py
+docker exec $CONTAINER_NAME rm -f /beebop/storage/beebop_redis.py
+docker exec $CONTAINER_NAME rm -f /beebop/storage/beebop_storage.py
+docker exec $CONTAINER_NAME rm -f /beebop/storage/beebop_journal.py
@@ -4,5 +4,8 @@ set -eu
 CONTAINER_NAME="beebop-api"
 
 docker cp migration.py $CONTAINER_NAME:/beebop/storage
+docker cp ../../src/beebop_redis.py $CONTAINER_NAME:/beebop/storage
+docker cp ../../src/beebop_storage.py $CONTAINER_NAME:/beebop/storage
+docker cp ../../src/beebop_journal.py $CONTAINER_NAME:/beebop/storage
 
 docker exec $CONTAINER_NAME python3 /beebop/storage/migration.py
\ No newline at end of file
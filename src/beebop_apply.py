@@ -0,0 +1,186 @@
+import time
+
+import docker
+import constellation
+
+from src.beebop_deploy import \
+    CONFIG_LABEL, \
+    config_digest, \
+    on_worker_hosts, \
+    pull_images, \
+    remote_workers, \
+    resolve_secrets, \
+    role
+from src.beebop_rolling import \
+    SERVICE_PORTS, \
+    replace_host_workers, \
+    replace_workers, \
+    restart_container, \
+    swap_container
+from src.beebop_scale import scale_workers, worker_containers
+
+# Dependencies are changed before the containers that use them
+APPLY_ORDER = ["redis", "api", "worker", "server", "proxy"]
+
+
+def beebop_apply(obj, args):
+    """Compare the running containers with the configuration and
+    recreate only those that differ, rather than restarting
+    everything."""
+    t0 = time.time()
+    if args["pull_images"]:
+        pull_images(obj)
+    plan = plan_changes(obj)
+    print_plan(plan)
+    if args["dry_run"] or not plan:
+        return plan
+    resolve_secrets(obj)
+    obj.network.create()
+    obj.volumes.create()
+    for step in plan:
+        apply_step(obj, step)
+    print("Applied {} changes in {:.1f}s".format(len(plan), time.time() - t0))
+    return plan
+
+
+def plan_changes(obj):
+    client = docker.client.from_env()
+    images = {}
+    for x in obj.containers.collection:
+        try:
+            images[str(x.image)] = client.images.get(str(x.image)).id
+        except docker.errors.ImageNotFound:
+            images[str(x.image)] = None
+    plan = []
+    for x in sorted(obj.containers.collection,
+                    key=lambda x: APPLY_ORDER.index(role(x.name))):
+        name = x.name
+        image_id = images[str(x.image)]
+        if isinstance(x, constellation.ConstellationService):
+            current = worker_containers(obj, x)
+            diffs = {c.name: container_diff(x.base, c, obj, image_id)
+                     for c in current}
+            # Workers exit when they lose their connection to redis
+            if any(step["name"] == "redis" for step in plan):
+                diffs = {k: v + ["redis"] for k, v in diffs.items()}
+            outdated = [c for c in current if diffs[c.name]]
+            if outdated:
+                plan.append({"name": name, "action": "replace",
+                             "containers": outdated,
+                             "reasons": sorted(set(
+                                 sum(diffs.values(), [])))})
+            if len(current) != x.scale:
+                plan.append({"name": name, "action": "scale",
+                             "from": len(current), "count": x.scale})
+        else:
+            container = x.get(obj.prefix)
+            if not container:
+                plan.append({"name": name, "action": "create"})
+                continue
+            reasons = container_diff(x, container, obj, image_id)
+            if reasons:
+                plan.append({"name": name, "action": "recreate",
+                             "container": container, "reasons": reasons})
+    # Workers on other hosts also exit when redis restarts
+    if any(step["name"] == "redis" for step in plan) and \
+            obj.data.worker_hosts:
+        plan.append({"name": "worker hosts", "action": "replace",
+                     "hosts": True, "reasons": ["redis"],
+                     "containers": sum(on_worker_hosts(
+                         obj, lambda host, client:
+                         remote_workers(host, client, obj)), [])})
+    return plan
+
+
+def container_diff(x, container, obj, image_id):
+    config = container.attrs["Config"]
+    reasons = []
+    if image_id and container.attrs["Image"] != image_id:
+        reasons.append("image")
+    # Images add their own environment and anonymous volumes, so we
+    # only check that what we ask for is present
+    env = dict(e.split("=", 1) for e in config.get("Env") or [])
+    if any(env.get(k) != str(v) for k, v in
+           (x.environment or {}).items()):
+        reasons.append("environment")
+    mounts = {(m.get("Name"), m["Destination"])
+              for m in container.attrs["Mounts"]}
+    want = {(m["Source"], m["Target"])
+            for m in [m.to_mount(obj.volumes) for m in x.mounts]}
+    if not want <= mounts:
+        reasons.append("mounts")
+    if x.args is not None and list(x.args) != (config.get("Cmd") or []):
+        reasons.append("args")
+    if x.entrypoint:
+        want = [x.entrypoint] if isinstance(x.entrypoint, str) \
+            else list(x.entrypoint)
+        if want != config.get("Entrypoint"):
+            reasons.append("entrypoint")
+    bindings = container.attrs["HostConfig"].get("PortBindings") or {}
+    ports = {(k, v[0].get("HostIp") or "", v[0]["HostPort"])
+             for k, v in bindings.items() if v}
+    # A host port may be given as (address, port)
+    want = {(k,) + ((v[0], str(v[1])) if isinstance(v, tuple)
+                    else ("", str(v)))
+            for k, v in (x.ports or {}).items()}
+    if ports != want:
+        reasons.append("ports")
+    # Containers started before they were labelled are given the
+    # benefit of the doubt
+    label = (config.get("Labels") or {}).get(CONFIG_LABEL)
+    if label and label != config_digest(x.name, obj.data):
+        reasons.append("configuration")
+    host_config = container.attrs["HostConfig"]
+    want = host_resources(obj.data.resources.get(x.name, {}))
+    if any((host_config.get(k) or 0) != v for k, v in want.items()):
+        reasons.append("resources")
+    return reasons
+
+
+# The resource limits we pass to docker, as docker reports them back in
+# HostConfig (where 0 means no limit)
+def host_resources(resources):
+    return {
+        "NanoCpus": resources.get("nano_cpus", 0),
+        "CpuShares": resources.get("cpu_shares", 0),
+        "CpusetCpus": resources.get("cpuset_cpus", 0),
+        "Memory": docker.utils.parse_bytes(resources.get("mem_limit", 0)),
+        "MemoryReservation": docker.utils.parse_bytes(
+            resources.get("mem_reservation", 0))}
+
+
+def apply_step(obj, step):
+    if step.get("hosts"):
+        replace_host_workers(obj, lambda host, c: True,
+                             **obj.data.worker_upgrade)
+        return
+    x = obj.containers.find(step["name"])
+    if step["action"] == "replace":
+        replace_workers(obj, x, step["containers"],
+                        **obj.data.worker_upgrade)
+    elif step["action"] == "scale":
+        scale_workers(obj, step["count"], service=x)
+    elif step["action"] == "recreate" and x.name in SERVICE_PORTS:
+        swap_container(x, step["container"], obj)
+    else:
+        restart_container(x, step.get("container"), obj)
+
+
+def print_plan(plan):
+    if not plan:
+        print("Nothing to change")
+        return
+    print("Plan:")
+    for step in plan:
+        if step["action"] == "create":
+            print("  + {}: create".format(step["name"]))
+        elif step["action"] == "scale":
+            print("  ~ {}: scale from {} to {}".format(
+                step["name"], step["from"], step["count"]))
+        elif step["action"] == "replace":
+            print("  ~ {}: replace {} replicas ({})".format(
+                step["name"], len(step["containers"]),
+                ", ".join(step["reasons"])))
+        else:
+            print("  ~ {}: recreate ({})".format(
+                step["name"], ", ".join(step["reasons"])))
@@ -1,29 +1,74 @@
 """
 Usage:
-  ./beebop start [--pull] [<configname>]
-  ./beebop stop  [--volumes] [--network] [--kill] [--force]
+  ./beebop start [--pull] [--profile] [<configname>]
+  ./beebop stop  [--volumes] [--network] [--kill] [--force] [--profile]
   ./beebop destroy
-  ./beebop status
-  ./beebop upgrade
+  ./beebop status [--json]
+  ./beebop upgrade [--rolling] [--profile]
+  ./beebop apply [--pull] [--dry-run]
+  ./beebop migrate [--dry-run] [<migration>]
+  ./beebop migrate --mark-applied <migration>
+  ./beebop scale (--auto | <count>) [--pool=<name>]
+  ./beebop prune --older-than=<age> [--dry-run]
+  ./beebop redis-export <file> [--prefix=<p>] [--batch-size=<n>]
+  ./beebop redis-import <file> [--prefix=<p>] [--batch-size=<n>] [--replace]
+  ./beebop logs [--follow] [--since=<age>] [--grep=<re>] [<service>...]
+  ./beebop monitor [--interval=<s>] [--output=<file>] [--prometheus]
 
 Options:
   --pull              Pull images before starting
+  --dry-run           Print planned changes without making them
+  --mark-applied      Record a migration as applied without running it
+  --auto              Keep scaling workers to match the RQ queue
+  --pool=<name>       Worker pool to scale, if several are configured
+  --older-than=<age>  Age of job outputs to remove (e.g. 90d, 12h)
+  --prefix=<p>        Only redis keys starting with this [default: beebop:]
+  --batch-size=<n>    Redis keys per pipelined round trip [default: 500]
+  --replace           Overwrite redis keys that already exist
+  --follow            Keep printing new log lines as they are written
+  --since=<age>       Only log lines from this long ago (e.g. 30m, 2h)
+  --grep=<re>         Only log lines matching this regular expression
+  --interval=<s>      Seconds between monitor samples [default: 60]
+  --output=<file>     Where to write samples [default: config/.monitor]
+  --prometheus        Write the latest sample for Prometheus' textfile
+                      collector, rather than appending to a time series
   --volumes           Remove volumes (WARNING: irreversible data loss)
   --network           Remove network
   --kill              Kill the containers (faster, but possible db corruption)
+  --rolling           Replace only changed containers, without downtime
+  --profile           Report time and docker API use for each deploy phase
+  --json              Print status as json
 """
 
+import contextlib
 import docopt
+import glob
+import hashlib
+import json
 import os
 import os.path
 import pickle
+import tempfile
 import time
-import timeago
 
-from src.beebop_deploy import \
-    BeebopConfig, \
-    beebop_constellation, \
-    beebop_start
+# Only the standard library and docopt are imported here; docker,
+# constellation and the deploy modules are imported by the commands
+# that use them so that parsing (and --help, or a typo) stays fast.
+# test_cli checks this with `python -X importtime`.
+import src.beebop_profile as profile
+
+
+def integer_arg(dat, name, minimum):
+    """An integer argument of at least minimum, exiting with the usage
+    message (as docopt does for other bad arguments) otherwise."""
+    try:
+        x = int(dat[name])
+    except ValueError:
+        x = None
+    if x is None or x < minimum:
+        raise docopt.DocoptExit("{} must be an integer of at least {}".format(
+            name, minimum))
+    return x
 
 
 def parse(argv=None):
@@ -33,13 +78,15 @@ def parse(argv=None):
     if dat["start"]:
         action = "start"
         config_name = dat["<configname>"]
-        args = {"pull_images": dat["--pull"]}
+        args = {"pull_images": dat["--pull"],
+                "profile": dat["--profile"]}
         options = {}
     elif dat["stop"]:
         action = "stop"
         args = {"kill": dat["--kill"],
                 "remove_network": dat["--network"],
-                "remove_volumes": dat["--volumes"]}
+                "remove_volumes": dat["--volumes"],
+                "profile": dat["--profile"]}
         options = {}
     elif dat["destroy"]:
         action = "stop"
@@ -49,12 +96,58 @@ def parse(argv=None):
         options = {}
     elif dat["status"]:
         action = "status"
-        args = {}
+        args = {"json": dat["--json"]}
         options = {}
     elif dat["upgrade"]:
-        args = {}
+        args = {"rolling": dat["--rolling"],
+                "profile": dat["--profile"]}
         options = {}
         action = "upgrade"
+    elif dat["apply"]:
+        action = "apply"
+        args = {"pull_images": dat["--pull"],
+                "dry_run": dat["--dry-run"]}
+        options = {}
+    elif dat["migrate"]:
+        action = "migrate"
+        args = {"dry_run": dat["--dry-run"],
+                "name": dat["<migration>"],
+                "mark_applied": dat["--mark-applied"]}
+        options = {}
+    elif dat["scale"]:
+        action = "scale"
+        args = {"autoscale": dat["--auto"],
+                "count": None if dat["--auto"] else
+                integer_arg(dat, "<count>", 0),
+                "pool": dat["--pool"]}
+        options = {}
+    elif dat["prune"]:
+        action = "prune"
+        args = {"older_than": dat["--older-than"],
+                "dry_run": dat["--dry-run"]}
+        options = {}
+    elif dat["redis-export"] or dat["redis-import"]:
+        action = "redis-export" if dat["redis-export"] else "redis-import"
+        args = {"file": dat["<file>"],
+                "prefix": dat["--prefix"],
+                "batch_size": integer_arg(dat, "--batch-size", 1)}
+        if dat["redis-import"]:
+            args["replace"] = dat["--replace"]
+        options = {}
+    elif dat["logs"]:
+        action = "logs"
+        args = {"follow": dat["--follow"],
+                "since": dat["--since"],
+                "grep": dat["--grep"],
+                "services": dat["<service>"]}
+        options = {}
+    elif dat["monitor"]:
+        action = "monitor"
+        args = {"interval": float(dat["--interval"]),
+                "output": dat["--output"],
+                "prometheus": dat["--prometheus"],
+                "samples": None}
+        options = {}
     return path, config_name, action, args, options
 
 
@@ -78,34 +171,134 @@ def read_config(path):
 
 def load_config(path, config_name=None, options=None):
     if os.path.exists(path_last_deploy(path)):
+        import timeago
         dat = read_config(path)
         when = timeago.format(dat["time"])
-        cfg = BeebopConfig(path, dat["config_name"], options=options)
         config_name = dat["config_name"]
+        cfg = cached_config(path, config_name, options)
         print("[Loaded configuration '{}' ({})]".format(
             config_name or "<base>", when))
     else:
-        cfg = BeebopConfig(path, config_name, options=options)
+        cfg = cached_config(path, config_name, options)
     return config_name, cfg
 
 
+CONFIG_CACHE_TTL = 24 * 60 * 60
+
+
+def path_config_cache(path):
+    return path + "/.config_cache"
+
+
+# The cache is invalidated by any change to the yaml, the options or
+# the code that builds the configuration
+def config_hash(path, config_name, options):
+    h = hashlib.sha256()
+    for f in sorted(glob.glob(path + "/*.yml")) + \
+            [os.path.join(os.path.dirname(__file__), "beebop_deploy.py")]:
+        h.update(f.encode("UTF-8"))
+        with open(f, "rb") as x:
+            h.update(x.read())
+    h.update(json.dumps([config_name, options], sort_keys=True).encode())
+    return h.hexdigest()
+
+
+# Vault secrets are only resolved by beebop_start, after the
+# configuration has been built and cached, so the cache holds the
+# 'VAULT:' references rather than the secrets themselves.
+def cached_config(path, config_name, options, ttl=CONFIG_CACHE_TTL):
+    key = config_hash(path, config_name, options)
+    p = path_config_cache(path)
+    if os.path.exists(p):
+        # A cache that cannot be read (a partial write from an older
+        # version, or classes that have since changed) is rebuilt
+        try:
+            with open(p, "rb") as f:
+                dat = pickle.load(f)
+            if dat["hash"] == key and time.time() - dat["time"] < ttl:
+                return dat["data"]
+        except Exception:
+            pass
+    from src.beebop_deploy import BeebopConfig
+    cfg = BeebopConfig(path, config_name, options=options)
+    # Written alongside and moved into place, so that an interrupted
+    # write never leaves a partial cache
+    fd, tmp = tempfile.mkstemp(dir=path, prefix=".config_cache.")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump({"hash": key, "time": time.time(), "data": cfg}, f)
+        os.replace(tmp, p)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return cfg
+
+
 def remove_config(path):
     p = path_last_deploy(path)
     if os.path.exists(p):
         print("Removing configuration")
         os.unlink(p)
+    if os.path.exists(path_config_cache(path)):
+        os.unlink(path_config_cache(path))
 
 
 def main(argv=None):
     path, config_name, action, args, options = parse(argv)
-    config_name, cfg = load_config(path, config_name, options)
+    if args.pop("profile", False):
+        ctx = profile.profiling(action, config_name, path)
+    else:
+        ctx = contextlib.nullcontext()
+    with ctx:
+        run(path, config_name, action, args, options)
+
+
+def run(path, config_name, action, args, options):
+    from src.beebop_deploy import \
+        beebop_constellation, \
+        beebop_start, \
+        beebop_stop, \
+        beebop_upgrade
+    with profile.phase("config"):
+        config_name, cfg = load_config(path, config_name, options)
     obj = beebop_constellation(cfg)
-    if action == "upgrade":
-        obj.restart(pull_images=True)
+    if action == "upgrade" and args["rolling"]:
+        from src.beebop_rolling import rolling_upgrade
+        rolling_upgrade(obj)
+    elif action == "upgrade":
+        beebop_upgrade(obj)
+    elif action == "apply":
+        from src.beebop_apply import beebop_apply
+        beebop_apply(obj, args)
+    elif action == "migrate":
+        from src.beebop_migrate import beebop_migrate
+        beebop_migrate(obj, args)
+    elif action == "scale":
+        from src.beebop_scale import beebop_scale
+        beebop_scale(obj, args)
+    elif action == "prune":
+        from src.beebop_prune import beebop_prune
+        beebop_prune(obj, args)
+    elif action == "redis-export":
+        from src.beebop_snapshot import beebop_redis_export
+        beebop_redis_export(obj, args)
+    elif action == "redis-import":
+        from src.beebop_snapshot import beebop_redis_import
+        beebop_redis_import(obj, args)
+    elif action == "logs":
+        from src.beebop_logs import beebop_logs
+        beebop_logs(obj, args)
+    elif action == "monitor":
+        from src.beebop_monitor import beebop_monitor
+        beebop_monitor(obj, args)
+    elif action == "status":
+        from src.beebop_status import beebop_status
+        beebop_status(obj, args)
     elif action == "start":
         save_config(path, config_name, cfg)
         beebop_start(obj, args)
-    else:
-        obj.__getattribute__(action)(**args)
-        if action == "stop" and args["remove_volumes"]:
+    elif action == "stop":
+        with profile.phase(action):
+            beebop_stop(obj, args)
+        if args["remove_volumes"]:
             remove_config(path)
@@ -1,11 +1,25 @@
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import ipaddress
+import posixpath
+import re
+import tarfile
+import threading
 import time
 import os
 
 import docker
 import json
+import redis
 import constellation
 import constellation.config as config
 import constellation.docker_util as docker_util
+import constellation.vault as vault
+from constellation.util import rand_str
+
+import src.beebop_profile as profile
 
 
 class BeebopConfig:
@@ -33,6 +47,8 @@ class BeebopConfig:
         self.volumes = {
             "storage": "beebop_storage",
             "redis-volume": "redis-volume",
+            "config-cache": "beebop_config_cache",
+            "dbs": "beebop_dbs"
         }
 
         # redis
@@ -41,6 +57,10 @@ class BeebopConfig:
         redis_tag = config.config_string(dat, ["redis", "image", "tag"])
         self.redis_ref = constellation.ImageReference(
             "library", redis_name, redis_tag)
+        if "config" in dat["redis"]:
+            self.redis_config = redis_settings(dat)
+        else:
+            self.redis_config = None
 
         # proxy
         proxy_repo = config.config_string(
@@ -68,6 +88,8 @@ class BeebopConfig:
             self.ssl = True
         else:
             self.ssl = False
+        self.proxy_performance = proxy_performance(dat) \
+            if "performance" in dat["proxy"] else None
 
         # server
         server_repo = config.config_string(
@@ -106,26 +128,349 @@ class BeebopConfig:
             dat, ["api", "storage_location"])
         self.api_dbs_location = config.config_string(
             dat, ["api", "dbs_location"])
+        # Where the databases volume is mounted; dbs_location is
+        # relative to the api's working directory
+        self.api_dbs_path = posixpath.normpath(
+            posixpath.join(API_WORKDIR, self.api_dbs_location))
+        self.api_warmup = config.config_boolean(
+            dat, ["api", "warmup"], True, False)
+        self.api_databases = [
+            {"name": config.config_string(x, ["name"]),
+             "url": config.config_string(x, ["url"]),
+             "size": config.config_integer(x, ["size"], True),
+             "sha256": config.config_string(x, ["sha256"], True),
+             "ref": config.config_boolean(x, ["ref"], True, False)}
+            for x in dat["api"].get("databases") or []]
 
         # worker and api the same image
         self.worker_ref = constellation.ImageReference(
             f"{self.registry}/{api_repo}", api_name, api_tag)
-        self.worker_count = config.config_integer(dat, ["worker", "count"])
+        self.worker_pools = worker_pools(dat)
+        self.worker_count = sum(x["count"] for x in self.worker_pools.values())
+        self.worker_autoscale = {
+            "min": config.config_integer(
+                dat, ["worker", "autoscale", "min"], True, 1),
+            "max": config.config_integer(
+                dat, ["worker", "autoscale", "max"], True,
+                self.worker_count),
+            "interval": config.config_integer(
+                dat, ["worker", "autoscale", "interval"], True, 10),
+            "cooldown_up": config.config_integer(
+                dat, ["worker", "autoscale", "cooldown_up"], True, 30),
+            "cooldown_down": config.config_integer(
+                dat, ["worker", "autoscale", "cooldown_down"], True, 300)}
+        self.worker_upgrade = {
+            "batch_size": config.config_integer(
+                dat, ["worker", "upgrade", "batch_size"], True, 1),
+            "drain_timeout": config.config_integer(
+                dat, ["worker", "upgrade", "drain_timeout"], True, 600)}
+
+        self.worker_hosts = worker_hosts(dat, self.worker_pools)
+        self.redis_bind = redis_bind(dat) if self.worker_hosts else None
+
+        self.resources = {
+            name: container_resources(dat, [name, "resources"])
+            for name in ["redis", "api", "server", "proxy"]}
+        for name, x in self.worker_pools.items():
+            self.resources[name] = x["resources"]
+
+
+# Limits that can be set in the 'resources' section of each container,
+# and the docker argument each becomes
+RESOURCES = {
+    "cpus": "nano_cpus",
+    "cpu_shares": "cpu_shares",
+    "cpuset": "cpuset_cpus",
+    "memory": "mem_limit",
+    "memory_reservation": "mem_reservation"
+}
+
+
+def container_resources(dat, path):
+    x = config.config_dict(dat, path, True, {})
+    for k in x:
+        if k not in RESOURCES:
+            raise ValueError("Unknown resource '{}' in {}".format(
+                k, ":".join(path)))
+    ret = {}
+    if "cpus" in x:
+        # As for 'docker run --cpus', a (fractional) number of CPUs
+        if not isinstance(x["cpus"], (int, float)):
+            raise ValueError("Expected number for {}:cpus".format(
+                ":".join(path)))
+        ret["nano_cpus"] = int(x["cpus"] * 1e9)
+    if "cpu_shares" in x:
+        ret["cpu_shares"] = config.config_integer(x, ["cpu_shares"])
+    if "cpuset" in x:
+        ret["cpuset_cpus"] = str(x["cpuset"])
+    # Docker accepts a number of bytes or a string such as '4g'
+    for k in ["memory", "memory_reservation"]:
+        if k in x:
+            ret[RESOURCES[k]] = x[k]
+    return ret
+
+
+# Each pool of workers is a separate service listening on its own
+# queues, so that short jobs are not stuck behind long ones. Without
+# 'pools' there is a single service 'worker' listening on rq's default
+# queue.
+def worker_pools(dat):
+    if "pools" not in dat["worker"]:
+        return {"worker": {
+            "count": config.config_integer(dat, ["worker", "count"]),
+            "queues": None,
+            "resources": container_resources(dat, ["worker", "resources"])}}
+    ret = {}
+    for name, x in config.config_dict(dat, ["worker", "pools"]).items():
+        if not re.fullmatch("[a-z0-9]+", name):
+            raise ValueError("Invalid worker pool name '{}'".format(name))
+        path = ["worker", "pools", name]
+        queues = x.get("queues")
+        if not isinstance(queues, list) or not queues or \
+                not all(isinstance(q, str) for q in queues):
+            raise ValueError("Expected list of queue names for {}".format(
+                ":".join(path + ["queues"])))
+        ret["worker-" + name] = {
+            "count": config.config_integer(dat, path + ["count"]),
+            "queues": queues,
+            "resources": container_resources(dat, path + ["resources"])}
+    return ret
+
+
+REDIS_EVICTION_POLICIES = ["noeviction", "volatile-lru", "volatile-lfu",
+                           "volatile-ttl", "volatile-random", "allkeys-lru",
+                           "allkeys-lfu", "allkeys-random"]
+
+
+# redis refuses to start on a directive it does not know, so settings
+# added in later versions are checked against the image's tag
+REDIS_MIN_VERSION = {
+    "io_threads": 6
+}
+
+
+def redis_version(tag):
+    """The major version in a redis image tag such as '5.0' or
+    '6.2-alpine', or None for tags such as 'latest'."""
+    m = re.match(r"(\d+)(\.|-|$)", tag)
+    return int(m.group(1)) if m else None
+
+
+def redis_settings(dat):
+    path = ["redis", "config"]
+    save = dat["redis"]["config"].get("save")
+    if save is not None and not isinstance(save, list):
+        raise ValueError("Expected list for redis:config:save")
+    tag = config.config_string(dat, ["redis", "image", "tag"])
+    version = redis_version(tag)
+    for k, v in REDIS_MIN_VERSION.items():
+        if version is not None and version < v and \
+                dat["redis"]["config"].get(k) is not None:
+            raise ValueError("redis:config:{} needs redis {} or later, "
+                             "but the image is redis:{}".format(k, v, tag))
+    return {
+        "maxmemory": config.config_string(dat, path + ["maxmemory"], True),
+        "maxmemory-policy": config.config_enum(
+            dat, path + ["maxmemory_policy"], REDIS_EVICTION_POLICIES, True,
+            "noeviction"),
+        "appendonly": config.config_boolean(
+            dat, path + ["appendonly"], True),
+        "appendfsync": config.config_enum(
+            dat, path + ["appendfsync"], ["always", "everysec", "no"], True,
+            "everysec"),
+        "save": save,
+        "io-threads": config.config_integer(dat, path + ["io_threads"], True)
+    }
+
+
+def redis_conf(settings):
+    lines = ["# Written by beebop-deploy from redis:config"]
+    for k, v in settings.items():
+        if v is None:
+            continue
+        if k == "save":
+            # An empty list disables RDB snapshots
+            lines += ["save {}".format(x) for x in v] or ['save ""']
+        elif isinstance(v, bool):
+            lines.append("{} {}".format(k, "yes" if v else "no"))
+        else:
+            lines.append("{} {}".format(k, v))
+    return "\n".join(lines) + "\n"
+
+
+API_WORKDIR = "/beebop"
+STORAGE_PATH = "/beebop/storage"
+REDIS_CONF = "/etc/redis.conf"
+REDIS_PORT = 6379
+
+
+def redis_files(cfg):
+    if not cfg.redis_config:
+        return {}
+    return {REDIS_CONF: redis_conf(cfg.redis_config)}
+
+
+def proxy_performance(dat):
+    path = ["proxy", "performance"]
+    return {
+        "gzip": config.config_boolean(dat, path + ["gzip"], True, True),
+        "gzip_level": config.config_integer(
+            dat, path + ["gzip_level"], True, 5),
+        # Needs an image built with ngx_brotli
+        "brotli": config.config_boolean(dat, path + ["brotli"], True, False),
+        "static_max_age": config.config_integer(
+            dat, path + ["static_max_age"], True, 86400),
+        "keepalive": config.config_integer(
+            dat, path + ["keepalive"], True, 32),
+        "ssl_session_cache": config.config_string(
+            dat, path + ["ssl_session_cache"], True, "10m"),
+        "ssl_session_timeout": config.config_string(
+            dat, path + ["ssl_session_timeout"], True, "1d"),
+        "worker_connections": config.config_integer(
+            dat, path + ["worker_connections"], True)
+    }
+
+
+PROXY_CONF = "/etc/nginx/conf.d/beebop-performance.conf"
+# Outside conf.d, so that it is only read where it is included
+PROXY_LOCATION_CONF = "/etc/nginx/beebop-location.conf"
+PROXY_UPSTREAM = "beebop_server"
+# Large downloads (GraphML networks, CSV assignments) compress well
+COMPRESSED_TYPES = ["text/plain", "text/css", "text/csv",
+                    "text/tab-separated-values", "application/javascript",
+                    "application/json", "application/xml",
+                    "application/graphml+xml", "image/svg+xml"]
+STATIC_ASSETS = r"\.(js|css|woff2?|ttf|svg|png|jpe?g|gif|ico)$"
+
+
+def proxy_conf(settings, upstream):
+    """Render proxy:performance as an nginx include for the http
+    context, with upstream the server's host:port."""
+    lines = ["# Written by beebop-deploy from proxy:performance"]
+    if settings["gzip"]:
+        lines += ["gzip on;",
+                  "gzip_comp_level {};".format(settings["gzip_level"]),
+                  "gzip_min_length 1024;",
+                  "gzip_proxied any;",
+                  "gzip_vary on;",
+                  "gzip_types {};".format(" ".join(COMPRESSED_TYPES))]
+    if settings["brotli"]:
+        lines += ["brotli on;",
+                  "brotli_comp_level {};".format(settings["gzip_level"]),
+                  "brotli_types {};".format(" ".join(COMPRESSED_TYPES))]
+    if settings["static_max_age"]:
+        lines += ["map $uri $beebop_cache_control {",
+                  '    default "";',
+                  '    "~*{}" "public, max-age={}";'.format(
+                      STATIC_ASSETS, settings["static_max_age"]),
+                  "}"]
+    lines += ["ssl_session_cache shared:beebop_ssl:{};".format(
+                  settings["ssl_session_cache"]),
+              "ssl_session_timeout {};".format(
+                  settings["ssl_session_timeout"])]
+    if settings["keepalive"]:
+        lines += ["upstream {} {{".format(PROXY_UPSTREAM),
+                  "    server {};".format(upstream),
+                  "    keepalive {};".format(settings["keepalive"]),
+                  "}"]
+    return "\n".join(lines) + "\n"
+
+
+# nginx only inherits add_header and proxy_set_header into a block that
+# sets none of its own, and the image's locations set their own, so
+# these are included in each location instead of the http context
+def proxy_location_conf(settings):
+    lines = ["# Written by beebop-deploy from proxy:performance"]
+    if settings["static_max_age"]:
+        # nginx omits the header when the value is empty
+        lines.append("add_header Cache-Control $beebop_cache_control;")
+    if settings["keepalive"]:
+        lines += ["proxy_http_version 1.1;",
+                  'proxy_set_header Connection "";']
+    return "\n".join(lines) + "\n"
+
+
+# A sed expression that includes the location snippet at the start of
+# every location block not already including it
+def proxy_location_edit():
+    return "\\|include {0};|!s#^([[:space:]]*location[^{{]*[{{])#\\1 " \
+        "include {0};#".format(PROXY_LOCATION_CONF)
+
+
+# Extra docker hosts that run worker replicas, reaching redis through
+# its published port and the storage through a shared filesystem
+# mounted at the same place on each host.
+def worker_hosts(dat, pools):
+    ret = []
+    for x in dat["worker"].get("hosts") or []:
+        name = config.config_string(x, ["name"])
+        if not re.fullmatch("[a-z0-9]+", name):
+            raise ValueError("Invalid worker host name '{}'".format(name))
+        pool = config.config_string(x, ["pool"], True)
+        if pool:
+            service = "worker-" + pool
+            if service not in pools:
+                raise ValueError("Unknown worker pool '{}' for host {}"
+                                 .format(pool, name))
+        elif len(pools) == 1:
+            service = list(pools)[0]
+        else:
+            raise ValueError("Worker host {} needs a pool".format(name))
+        ret.append({
+            "name": name,
+            "url": config.config_string(x, ["url"]),
+            "count": config.config_integer(x, ["count"]),
+            "redis_host": config.config_string(x, ["redis_host"]),
+            "storage_path": config.config_string(x, ["storage_path"]),
+            "dbs_path": config.config_string(x, ["dbs_path"]),
+            "service": service})
+    return ret
+
+
+# redis has no password, so for worker hosts it is published only on
+# an address they reach over a private network or a tunnel, never on
+# every interface.
+def redis_bind(dat):
+    address = config.config_string(dat, ["worker", "redis_bind"])
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        raise ValueError("Invalid worker:redis_bind '{}'".format(address))
+    if ip.is_unspecified or not ip.is_private:
+        raise ValueError("worker:redis_bind must be a private or loopback "
+                         "address, not '{}'".format(address))
+    return address
+
+
+# Files written into a container after it is created but before it
+# starts, for processes that read them on startup
+CONTAINER_FILES = {
+    "redis": redis_files
+}
 
 
 def beebop_constellation(cfg):
     # 1. redis
     redis_mounts = [constellation.ConstellationMount("redis-volume", "/data")]
+    redis_args = ["redis-server", REDIS_CONF] if cfg.redis_config else None
+    # Workers on other hosts reach redis on the host's port
+    redis_ports = [(REDIS_PORT, (cfg.redis_bind, REDIS_PORT))] \
+        if cfg.worker_hosts else None
     redis = constellation.ConstellationContainer(
-        "redis", cfg.redis_ref, configure=redis_configure, mounts=redis_mounts
+        "redis", cfg.redis_ref, args=redis_args, mounts=redis_mounts,
+        ports=redis_ports
     )
 
     # 2. api
     api_env = {"REDIS_HOST": redis.name,
                "STORAGE_LOCATION": cfg.api_storage_location,
                "DBS_LOCATION": cfg.api_dbs_location}
-    api_mounts = [constellation.ConstellationMount("storage",
-                                                   "/beebop/storage")]
+    # The reference databases are only written by api_configure (see
+    # databases_writer)
+    dbs_mount = constellation.ConstellationMount("dbs", cfg.api_dbs_path,
+                                                 read_only=True)
+    api_mounts = [constellation.ConstellationMount("storage", STORAGE_PATH),
+                  dbs_mount]
     api = constellation.ConstellationContainer(
         "api", cfg.api_ref, environment=api_env, mounts=api_mounts,
         configure=api_configure)
@@ -137,52 +482,769 @@ def beebop_constellation(cfg):
     # 4. worker
     worker_env = {"REDIS_HOST": redis.name}
     worker_mounts = [constellation.ConstellationMount("storage",
-                                                      "/beebop/storage")]
-    # Constellation starts containers on no network, then joins them to
-    # the network. So we get the container to sleep for 5s to allow for it
-    # to have joined the network by the time rqworker is called, otherwise
-    # it exits when it can't connect to redis
-    worker_args = ["-c", "sleep 5 && rqworker"]
-    worker = constellation.ConstellationService(
-        "worker", cfg.worker_ref, cfg.worker_count, environment=worker_env,
-        mounts=worker_mounts, entrypoint="sh", args=worker_args)
+                                                      STORAGE_PATH),
+                     dbs_mount]
+    # Workers are only started once redis answers a ping, and are
+    # created directly on the network (see start_container), so
+    # rqworker can connect as soon as it starts.
+    workers = [constellation.ConstellationService(
+        name, cfg.worker_ref, x["count"], environment=worker_env,
+        mounts=worker_mounts, entrypoint="rqworker", args=x["queues"])
+        for name, x in cfg.worker_pools.items()]
 
     # 5. proxy
     proxy_ports = [cfg.proxy_port_http, cfg.proxy_port_https]
+    proxy_mounts = [constellation.ConstellationMount("config-cache",
+                                                     CACHE_PATH)]
     proxy = constellation.ConstellationContainer(
         "proxy", cfg.proxy_ref, ports=proxy_ports, configure=proxy_configure,
+        mounts=proxy_mounts,
         args=[cfg.proxy_host,
               server.name])
 
-    containers = [redis, server, api, proxy, worker]
+    containers = [redis, server, api, proxy] + workers
 
-    obj = constellation.Constellation("beebop", cfg.container_prefix,
-                                      containers,
-                                      cfg.network, cfg.volumes,
-                                      data=cfg, vault_config=cfg.vault)
+    obj = BeebopConstellation("beebop", cfg.container_prefix, containers,
+                              cfg.network, cfg.volumes,
+                              data=cfg, vault_config=cfg.vault)
     return obj
 
 
+# constellation's own start() creates each container on the 'none'
+# network and connects it afterwards, which workers (whose rqworker
+# exits if it cannot reach redis) do not survive, and knows nothing of
+# worker hosts; so the lifecycle methods go through beebop_start and
+# beebop_stop instead.
+class BeebopConstellation(constellation.Constellation):
+    def start(self, pull_images=False, subset=None):
+        if subset is not None:
+            raise Exception("Starting a subset of containers is not "
+                            "supported; use ./beebop apply")
+        beebop_start(self, {"pull_images": pull_images})
+
+    def restart(self, pull_images=True):
+        if pull_images:
+            beebop_upgrade(self)
+        else:
+            beebop_stop(self, {"kill": False})
+            beebop_start(self, {})
+
+    def destroy(self):
+        beebop_stop(self, {"kill": True, "remove_network": True,
+                           "remove_volumes": True})
+
+
+# Each container is started once the containers it depends on are up
+# (running on the network and passing their readiness probe), or, for
+# a dependency written 'name:configured', once that container's
+# configure hook has also finished.  Configure hooks run as soon as
+# their own container is up, so independent steps such as the api
+# database check and proxy certificate setup happen at the same time,
+# but workers, which read the databases, wait until api_configure has
+# seeded or downloaded them.
+STARTUP_DEPENDENCIES = {
+    "redis": [],
+    "api": ["redis"],
+    "worker": ["redis", "api:configured"],
+    "server": ["api"],
+    "proxy": ["server"]
+}
+
+
 def beebop_start(obj, args):
-    obj.start(**args)
+    if any(obj.containers.exists(obj.prefix)):
+        raise Exception("Some containers exist")
+    resolve_secrets(obj)
+    if args.get("pull_images", False):
+        pull_images(obj)
+        pull_remote_images(obj)
+    with profile.phase("network"):
+        obj.network.create()
+    with profile.phase("volumes"):
+        obj.volumes.create()
+    start_containers(obj)
+    start_remote_workers(obj)
 
 
-def redis_configure(container, cfg):
-    print("[redis] Waiting for redis to come up")
-    docker_util.file_into_container(
-        "scripts/wait_for_redis", container, ".", "wait_for_redis")
-    docker_util.exec_safely(container, ["bash", "/wait_for_redis"])
+def resolve_secrets(obj):
+    if obj.vault_config:
+        with profile.phase("vault"):
+            vault.resolve_secrets(obj.data, obj.vault_config.client())
+
+
+def beebop_upgrade(obj):
+    pull_images(obj)
+    pull_remote_images(obj)
+    with profile.phase("stop"):
+        stop_remote_workers(obj)
+        obj.stop()
+    beebop_start(obj, {})
+
+
+def beebop_stop(obj, args):
+    # Remote workers first, so they are not left without redis
+    stop_remote_workers(obj, args["kill"])
+    obj.stop(**args)
+
+
+def start_containers(obj, dependencies=STARTUP_DEPENDENCIES):
+    t0 = time.time()
+    collection = obj.containers.collection
+    up = {x.name: threading.Event() for x in collection}
+    configured = {x.name: threading.Event() for x in collection}
+    failed = threading.Event()
+
+    def run(x):
+        for dep in dependencies.get(role(x.name), []):
+            name, _, state = dep.partition(":")
+            event = configured[name] if state == "configured" else up[name]
+            while not event.wait(0.1):
+                if failed.is_set():
+                    return
+        if isinstance(x, constellation.ConstellationService):
+            start_service(x, obj)
+        else:
+            container = start_container(x, x.name, obj)
+            wait_ready(x.name, READINESS_PROBES.get(x.name, is_running),
+                       container)
+            up[x.name].set()
+            if x.configure:
+                with profile.phase("configure", x.name):
+                    x.configure(container, obj.data)
+        up[x.name].set()
+        configured[x.name].set()
+
+    errors = []
+    with concurrent.futures.ThreadPoolExecutor(len(collection)) as pool:
+        futures = {pool.submit(run, x): x.name for x in collection}
+        for f in concurrent.futures.as_completed(futures):
+            try:
+                f.result()
+            except Exception as e:
+                failed.set()
+                errors.append("{}: {}".format(futures[f], e))
+    if errors:
+        raise Exception("Failed to start:\n  " + "\n  ".join(errors))
+    print("Started {} in {:.1f}s".format(obj.name, time.time() - t0))
+
+
+# Unlike constellation, which starts containers on the 'none' network
+# and then moves them, we create containers directly on our network
+# (with the container's role as alias) so they can reach their
+# dependencies from the moment their process starts.
+def start_container(x, name, obj):
+    cl = docker.client.from_env()
+    nm = "{}-{}".format(obj.prefix, name)
+    print("Starting {} ({})".format(name, str(x.image)))
+    nw = obj.network.name
+    mounts = [m.to_mount(obj.volumes) for m in x.mounts]
+    labels = dict(x.labels or {})
+    labels[CONFIG_LABEL] = config_digest(x.name, obj.data)
+    files = CONTAINER_FILES.get(x.name, lambda cfg: {})(obj.data)
+    resources = obj.data.resources.get(x.name, {})
+    kwargs = dict(
+        name=nm, mounts=mounts, network=nw, ports=x.ports,
+        environment=x.environment, entrypoint=x.entrypoint,
+        working_dir=x.working_dir, labels=labels,
+        networking_config={
+            nw: cl.api.create_endpoint_config(aliases=[x.name])},
+        **resources)
+    with profile.phase("create", name):
+        if not files:
+            return cl.containers.run(str(x.image), x.args, detach=True,
+                                     **kwargs)
+        container = cl.containers.create(str(x.image), x.args, **kwargs)
+        for path, txt in files.items():
+            readable_file_into_container(txt, container, path)
+        container.start()
+        return container
+
+
+# docker_util.string_into_container builds its archive from a temporary
+# file, so the file arrives as mode 0600; the processes that read these
+# files may drop root first (redis's entrypoint runs redis-server as the
+# redis user), so they are written world-readable.
+def readable_file_into_container(txt, container, path):
+    data = txt.encode("UTF-8")
+    info = tarfile.TarInfo(posixpath.basename(path))
+    info.size = len(data)
+    info.mode = 0o644
+    info.mtime = int(time.time())
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        tar.addfile(info, io.BytesIO(data))
+    buf.seek(0)
+    container.put_archive(posixpath.dirname(path), buf)
+
+
+# Containers are labelled with a digest of the configuration that their
+# configure hook reads (which is not otherwise visible on the container),
+# so that ./beebop apply can tell when they need recreating.  The digest
+# is of the yaml as read, so contains vault references, not secrets.
+CONFIG_LABEL = "beebop.config"
+CONFIG_SECTIONS = {
+    "redis": ["redis"],
+    "api": ["api", "download_ref_dbs_only"],
+    "server": ["server"],
+    "proxy": ["proxy"],
+    "worker": []
+}
+
+
+# The role of a container: its name, or 'worker' for any worker pool
+def role(name):
+    return name.split("-")[0]
+
+
+def config_digest(name, cfg):
+    dat = {k: cfg.data.get(k) for k in CONFIG_SECTIONS.get(name, [])}
+    # Resource limits are compared with the container directly
+    dat = {k: {i: j for i, j in v.items() if i != "resources"}
+           if isinstance(v, dict) else v for k, v in dat.items()}
+    return hashlib.sha256(
+        json.dumps(dat, sort_keys=True).encode("UTF-8")).hexdigest()
+
+
+def start_service(x, obj, scale=None):
+    print("Starting *service* {}".format(x.name))
+    n = x.scale if scale is None else scale
+    replicas = ["{}-{}".format(x.name, rand_str(8)) for i in range(n)]
+    with concurrent.futures.ThreadPoolExecutor(
+            max(min(len(replicas), 8), 1)) as pool:
+        containers = list(pool.map(
+            lambda name: start_container(x.base, name, obj), replicas))
+        list(pool.map(lambda c: wait_ready(c.name, is_running, c),
+                      containers))
+    return containers
+
+
+def docker_host_client(url, **kwargs):
+    return docker.DockerClient(base_url=url,
+                               use_ssh_client=url.startswith("ssh://"),
+                               **kwargs)
+
+
+def on_worker_hosts(obj, f):
+    """Run f(host, client) for each worker host at the same time,
+    returning the results in host order."""
+    hosts = obj.data.worker_hosts
+    if not hosts:
+        return []
+
+    def run(host):
+        with profile.phase("host", host["name"]):
+            return f(host, docker_host_client(host["url"]))
+    with concurrent.futures.ThreadPoolExecutor(len(hosts)) as pool:
+        futures = [pool.submit(run, x) for x in hosts]
+    errors = []
+    for host, f in zip(hosts, futures):
+        if f.exception():
+            errors.append("{}: {}".format(host["name"], f.exception()))
+    if errors:
+        raise Exception("Failed on worker hosts:\n  " +
+                        "\n  ".join(errors))
+    return [f.result() for f in futures]
+
+
+def remote_worker_prefix(obj, host):
+    return "{}-{}-{}-".format(obj.prefix, host["service"], host["name"])
+
+
+def pull_remote_images(obj):
+    def pull(host, client):
+        ref = str(obj.containers.find(host["service"]).image)
+        print("[{}] pulling {}".format(host["name"], ref))
+        client.images.pull(ref)
+    on_worker_hosts(obj, pull)
+
+
+def start_remote_workers(obj):
+    return sum(on_worker_hosts(
+        obj, lambda host, client: start_host_workers(obj, host, client)), [])
+
+
+def start_host_workers(obj, host, client, scale=None):
+    x = obj.containers.find(host["service"]).base
+    ref = str(x.image)
+    try:
+        client.images.get(ref)
+    except docker.errors.ImageNotFound:
+        print("[{}] pulling {}".format(host["name"], ref))
+        client.images.pull(ref)
+    n = host["count"] if scale is None else scale
+    print("[{}] starting {} workers".format(host["name"], n))
+    environment = dict(x.environment, REDIS_HOST=host["redis_host"])
+    mounts = [docker.types.Mount(STORAGE_PATH, host["storage_path"],
+                                 type="bind"),
+              docker.types.Mount(obj.data.api_dbs_path, host["dbs_path"],
+                                 type="bind", read_only=True)]
+    labels = {CONFIG_LABEL: config_digest(x.name, obj.data)}
+    resources = obj.data.resources.get(x.name, {})
+
+    def run(name):
+        with profile.phase("create", name):
+            return client.containers.run(
+                ref, x.args, name=name, detach=True, mounts=mounts,
+                environment=environment, entrypoint=x.entrypoint,
+                labels=labels, **resources)
+    names = [remote_worker_prefix(obj, host) + rand_str(8)
+             for i in range(n)]
+    with concurrent.futures.ThreadPoolExecutor(
+            max(min(n, 8), 1)) as pool:
+        containers = list(pool.map(run, names))
+        list(pool.map(lambda c: wait_ready(c.name, is_running, c),
+                      containers))
+    return containers
+
+
+def remote_workers(host, client, obj):
+    prefix = remote_worker_prefix(obj, host)
+    return [x for x in client.containers.list(
+        all=True, filters={"name": "^/" + prefix})
+        if x.name.startswith(prefix)]
+
+
+def stop_remote_workers(obj, kill=False):
+    def stop(host, client):
+        containers = remote_workers(host, client, obj)
+        if not containers:
+            return
+        print("[{}] stopping {} workers".format(host["name"],
+                                                len(containers)))
+
+        timeout = 0 if kill else obj.data.worker_upgrade["drain_timeout"]
+        with concurrent.futures.ThreadPoolExecutor(
+                min(len(containers), 8)) as pool:
+            list(pool.map(lambda c: stop_worker(c, timeout), containers))
+    on_worker_hosts(obj, stop)
+
+
+# RQ treats SIGTERM as a warm shutdown: it finishes the job it is
+# running and then exits. docker stop sends SIGTERM and only kills the
+# worker if it is still running after the timeout.
+def stop_worker(container, timeout):
+    container.stop(timeout=timeout)
+    container.remove()
+
+
+# Poll a readiness probe with exponential backoff, so that fast
+# services are picked up within milliseconds while slow ones are not
+# hammered.
+def wait_ready(name, probe, container, timeout=60, initial=0.05,
+               max_delay=2):
+    t0 = time.time()
+    delay = initial
+    with profile.phase("ready", name):
+        while not probe(container):
+            elapsed = time.time() - t0
+            if elapsed > timeout:
+                raise Exception("{} was not ready after {}s".format(
+                    name, timeout))
+            time.sleep(min(delay, timeout - elapsed))
+            delay = min(delay * 2, max_delay)
+    print("[{}] ready after {:.2f}s".format(name, time.time() - t0))
+
+
+def redis_connection(obj, timeout=5):
+    container = obj.containers.get("redis", obj.prefix)
+    if not container or container.status != "running":
+        raise Exception("redis is not running")
+    networks = container.attrs["NetworkSettings"]["Networks"]
+    return redis.Redis(host=networks[obj.network.name]["IPAddress"],
+                       socket_timeout=timeout, socket_connect_timeout=timeout)
+
+
+def running_container(obj, name):
+    container = obj.containers.get(name, obj.prefix)
+    if not container or container.status != "running":
+        raise Exception("'{}' is not running; start beebop first".format(
+            name))
+    return container
+
+
+def service_containers(obj, services=None):
+    """The running containers for the given services (or all of them),
+    as (label, container) pairs; a pool's role, such as 'worker',
+    selects every pool."""
+    names = [x.name for x in obj.containers.collection]
+    for s in services or []:
+        if s not in names and s not in [role(x) for x in names]:
+            raise Exception("Unknown service '{}' (expected one of {})".format(
+                s, ", ".join(names)))
+    ret = []
+    for x in obj.containers.collection:
+        if services and x.name not in services and \
+                role(x.name) not in services:
+            continue
+        found = x.get(obj.prefix)
+        if not isinstance(x, constellation.ConstellationService):
+            found = [found] if found else []
+        ret += [(c.name[len(obj.prefix) + 1:], c) for c in found
+                if c.status == "running"]
+    return ret
+
+
+AGE_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60,
+             "w": 7 * 24 * 60 * 60}
+
+
+def parse_age(txt):
+    m = re.fullmatch(r"(\d+)([smhdw])", txt)
+    if not m:
+        raise Exception(
+            "Invalid age '{}' (expected e.g. 90d, 12h or 30m)".format(txt))
+    return int(m.group(1)) * AGE_UNITS[m.group(2)]
+
+
+def is_running(container):
+    container.reload()
+    if container.status in ("exited", "dead"):
+        raise Exception("container '{}' is {}".format(
+            container.name, container.status))
+    return container.status == "running"
+
+
+def redis_ready(container):
+    if not is_running(container):
+        return False
+    res = container.exec_run(["redis-cli", "ping"])
+    return res[0] == 0 and b"PONG" in res[1]
+
+
+READINESS_PROBES = {
+    "redis": redis_ready
+}
+
+
+# The worker uses the same image as the api, so we pull each unique
+# reference once, concurrently, and only return once every pull has
+# succeeded so that no container is replaced with a partial set of
+# images.
+def pull_images(obj, max_workers=4):
+    images = {}
+    for x in obj.containers.collection:
+        images.setdefault(str(x.image), x.image)
+    print("Pulling {} images".format(len(images)))
+    progress = PullProgress()
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+        futures = {pool.submit(image_pull, image, progress): ref
+                   for ref, image in images.items()}
+        errors = []
+        for f in concurrent.futures.as_completed(futures):
+            try:
+                f.result()
+            except Exception as e:
+                errors.append("{}: {}".format(futures[f], e))
+    if errors:
+        raise Exception("Failed to pull images:\n  " + "\n  ".join(errors))
+    progress.summary()
+    return progress
+
+
+def image_pull(image, progress):
+    with profile.phase("pull", str(image)):
+        return image_pull_stream(image, progress)
+
+
+def image_pull_stream(image, progress):
+    client = docker.client.from_env()
+    ref = str(image)
+    try:
+        prev = client.images.get(ref).short_id
+    except docker.errors.ImageNotFound:
+        prev = None
+    stream = client.api.pull("{}/{}".format(image.repo, image.name),
+                             image.tag, stream=True, decode=True)
+    downloaded = {}
+    for event in stream:
+        if "error" in event:
+            raise Exception(event["error"])
+        if event.get("status") == "Downloading":
+            downloaded[event.get("id")] = \
+                event.get("progressDetail", {}).get("total") or 0
+        progress.update(ref, event)
+    # The pull is one streamed API response, so record the layer bytes
+    # the daemon fetched from the registry on its behalf
+    profile.add("bytes_pulled", sum(downloaded.values()))
+    curr = client.images.get(ref)
+    status = "unchanged" if prev == curr.short_id else "updated"
+    progress.done(ref, curr.id)
+    print("[{}] {} ({})".format(ref, curr.short_id, status))
+    return prev != curr.short_id
+
+
+class PullProgress:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.layers = {}
+        self.downloaded = {}
+        self.reused = set()
+        self.image_ids = {}
+
+    def update(self, ref, event):
+        layer = event.get("id")
+        status = event.get("status", "")
+        if not layer or status.startswith("Status"):
+            return
+        with self.lock:
+            if status == "Downloading":
+                total = event.get("progressDetail", {}).get("total")
+                if total:
+                    self.downloaded[layer] = total
+            elif status == "Already exists":
+                self.reused.add(layer)
+            # Only report layer state changes, not every byte downloaded
+            if self.layers.get(layer) == status:
+                return
+            self.layers[layer] = status
+        if status in ("Already exists", "Pull complete"):
+            size = self.downloaded.get(layer)
+            detail = " ({})".format(format_bytes(size)) if size else ""
+            print("[{}] {}: {}{}".format(ref, layer, status, detail))
+
+    def done(self, ref, image_id):
+        with self.lock:
+            self.image_ids[ref] = image_id
+
+    def summary(self):
+        # Docker does not report the size of layers that already exist,
+        # so only those downloaded by another image in this pull are
+        # counted as saved
+        saved = sum(self.downloaded.get(x, 0) for x in self.reused)
+        print("Pulled {} images: downloaded {} in {} layers, "
+              "reused {} layers (saving at least {})".format(
+                  len(self.image_ids),
+                  format_bytes(sum(self.downloaded.values())),
+                  len(self.downloaded), len(self.reused),
+                  format_bytes(saved)))
+        return saved
+
+
+def format_bytes(n):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if n < 1024 or unit == "GB":
+            break
+        n /= 1024
+    return "{:.1f} {}".format(n, unit)
 
 
 def api_configure(container, cfg: BeebopConfig):
-    print("[api] Downloading storage database")
-    args = ["./scripts/download_databases"]
-    if cfg.download_ref_dbs_only:
-        args.append("--refs")
-    mounts = [docker.types.Mount("/beebop/storage", cfg.volumes["storage"])]
-    container.client.containers.run(
-        str(cfg.api_ref), args, mounts=mounts, remove=True
-    )
+    if cfg.api_databases:
+        with databases_writer(container, cfg) as writer:
+            seed_databases(writer, cfg)
+            api_fetch_databases(writer, cfg)
+    else:
+        api_download_databases(container, cfg)
+    if cfg.api_warmup:
+        with profile.phase("warmup", "api"):
+            warm_databases(container, cfg)
+
+
+def api_download_databases(container, cfg):
+    # Without a list of databases we can only tell that a previous run
+    # of the download script completed against this volume, for at
+    # least the databases asked for now; the script names what it
+    # downloads, so a new version of it means new databases
+    script = download_script_digest(container)
+    manifest = read_databases_manifest(container, cfg)
+    if download_complete(manifest, cfg, script):
+        print("[api] Storage database already downloaded")
+        return
+    with databases_writer(container, cfg) as writer:
+        if seed_databases(writer, cfg):
+            manifest = read_databases_manifest(writer, cfg)
+            if download_complete(manifest, cfg, script):
+                return
+        print("[api] Downloading storage database")
+        args = [DOWNLOAD_SCRIPT]
+        if cfg.download_ref_dbs_only:
+            args.append("--refs")
+        container.client.containers.run(
+            str(cfg.api_ref), args, mounts=databases_mounts(cfg), remove=True
+        )
+        manifest["download_databases"] = {
+            "refs_only": cfg.download_ref_dbs_only, "script": script}
+        write_databases_manifest(writer, cfg, manifest)
+
+
+DOWNLOAD_SCRIPT = "./scripts/download_databases"
+
+
+def download_script_digest(container):
+    res = container.exec_run(["cat", DOWNLOAD_SCRIPT])
+    if res[0] != 0:
+        return None
+    return hashlib.sha256(res[1]).hexdigest()
+
+
+def download_complete(manifest, cfg, script):
+    done = manifest.get("download_databases")
+    return done is not None and script is not None and \
+        done.get("script") == script and \
+        (not done.get("refs_only") or cfg.download_ref_dbs_only)
+
+
+def api_fetch_databases(container, cfg):
+    databases = [x for x in cfg.api_databases
+                 if x["ref"] or not cfg.download_ref_dbs_only]
+    print("[api] Checking {} storage databases".format(len(databases)))
+    docker_util.file_into_container(
+        "scripts/fetch_databases", container, ".", "fetch_databases")
+    docker_util.string_into_container(json.dumps(databases), container,
+                                      "/fetch_databases.json")
+    docker_util.exec_safely(container, [
+        "python3", "/fetch_databases", cfg.api_dbs_location,
+        "/fetch_databases.json"])
+
+
+SEED_PATH = "/seed"
+
+
+def databases_mounts(cfg, seed=False):
+    mounts = [docker.types.Mount(STORAGE_PATH, cfg.volumes["storage"]),
+              docker.types.Mount(cfg.api_dbs_path, cfg.volumes["dbs"])]
+    if seed:
+        mounts.append(docker.types.Mount(SEED_PATH, cfg.volumes["storage"],
+                                         read_only=True))
+    return mounts
+
+
+# The api and workers mount the databases read-only, so changes are
+# made from a short-lived container of the api image that mounts them
+# read-write
+@contextlib.contextmanager
+def databases_writer(container, cfg):
+    name = "{}-dbs-writer".format(cfg.container_prefix)
+    # Left behind if an earlier start was interrupted
+    try:
+        container.client.containers.get(name).remove(force=True)
+    except docker.errors.NotFound:
+        pass
+    writer = container.client.containers.run(
+        str(cfg.api_ref), ["infinity"], entrypoint="sleep", name=name,
+        mounts=databases_mounts(cfg, seed=True), detach=True)
+    try:
+        yield writer
+    finally:
+        writer.remove(force=True)
+
+
+# Databases were kept in the storage volume before they had their own;
+# copy them across rather than downloading them again.  Deployments
+# older than the manifest have databases but no manifest, so anything
+# is copied into an empty volume, and a manifest written if none came.
+def seed_databases(writer, cfg):
+    rel = posixpath.relpath(cfg.api_dbs_path, STORAGE_PATH)
+    if rel.startswith(".."):
+        return False
+    script = ('if [ -z "$(ls -A "$1")" ] && '
+              '[ -n "$(ls -A "$0" 2>/dev/null)" ]; then '
+              'cp -a "$0/." "$1/" && echo copied; fi')
+    res = docker_util.exec_safely(writer, [
+        "sh", "-c", script, posixpath.join(SEED_PATH, rel),
+        cfg.api_dbs_path])
+    if b"copied" not in res[1]:
+        return False
+    print("[api] Copied databases from the storage volume")
+    if not read_databases_manifest(writer, cfg):
+        write_databases_manifest(writer, cfg, seeded_manifest(writer, cfg))
+    return True
+
+
+# The copied databases are taken to be those the configuration asks
+# for, as the old deployment downloaded them on every start
+def seeded_manifest(writer, cfg):
+    if not cfg.api_databases:
+        return {"download_databases": {
+            "refs_only": cfg.download_ref_dbs_only,
+            "script": download_script_digest(writer)}}
+    found = docker_util.exec_safely(
+        writer, ["ls", "-A", cfg.api_dbs_path])[1].decode("UTF-8").split()
+    return {"databases": {
+        x["name"]: {"url": x["url"], "size": x["size"],
+                    "sha256": x["sha256"]}
+        for x in cfg.api_databases if x["name"] in found}}
+
+
+# Reading the databases once pulls them into the host's page cache, so
+# the first job on each worker does not pay for cold reads
+def warm_databases(container, cfg):
+    names = [x["name"] for x in cfg.api_databases
+             if x["ref"] or not cfg.download_ref_dbs_only]
+    print("[api] Warming page cache")
+    docker_util.file_into_container(
+        "scripts/warm_databases", container, ".", "warm_databases")
+    exec_streaming(container, ["python3", "/warm_databases",
+                               cfg.api_dbs_path] + names)
+
+
+def databases_manifest_path(cfg):
+    return "{}/.manifest.json".format(cfg.api_dbs_location)
+
+
+def read_databases_manifest(container, cfg):
+    res = container.exec_run(["cat", databases_manifest_path(cfg)])
+    if res[0] != 0:
+        return {}
+    return json.loads(res[1].decode("UTF-8"))
+
+
+def write_databases_manifest(container, cfg, manifest):
+    string_to_path(container, json.dumps(manifest),
+                   databases_manifest_path(cfg))
+
+
+# Unlike docker_util.string_into_container, this accepts paths
+# relative to the container's working directory and creates any
+# missing directories.
+def string_to_path(container, txt, path):
+    docker_util.exec_safely(container, [
+        "sh", "-c", 'mkdir -p "$(dirname "$1")" && printf "%s" "$0" > "$1"',
+        txt, path])
+
+
+def exec_streaming(container, args):
+    api = container.client.api
+    exec_id = api.exec_create(container.id, args)["Id"]
+    for chunk in api.exec_start(exec_id, stream=True):
+        print(chunk.decode("UTF-8"), end="", flush=True)
+    if api.exec_inspect(exec_id)["ExitCode"] != 0:
+        raise Exception("Error running command (see above for log)")
+
+
+# Artifacts that are slow to build at configure time are kept in the
+# config-cache volume, under a digest of everything used to build them,
+# so that restarts and upgrades reuse them until their inputs change.
+CACHE_PATH = "/beebop/cache"
+
+
+def input_digest(inputs):
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True).encode("UTF-8")).hexdigest()
+
+
+def restore_cached(container, name, digest, files, check=None):
+    """Copy files into place from the cache if they were built from
+    inputs with this digest (and, given check, a shell command run on
+    the cache directory, it succeeds); returns False if they were
+    not."""
+    path = "{}/{}/{}".format(CACHE_PATH, name, digest)
+    cmd = ["test -d {}".format(path)] + \
+        ([check(path)] if check else []) + \
+        ["cp {}/{} {}".format(path, os.path.basename(f), f) for f in files]
+    code, output = container.exec_run(["sh", "-c", " && ".join(cmd)])
+    return code == 0
+
+
+def save_cached(container, name, digest, files):
+    # Only the latest version is kept; it is written to a temporary
+    # directory first so an interrupted save is never restored
+    path = "{}/{}".format(CACHE_PATH, name)
+    tmp = "{}/.{}".format(path, digest)
+    cmd = ["rm -rf {}".format(path), "mkdir -p {}".format(tmp)] + \
+        ["cp {} {}/".format(f, tmp) for f in files] + \
+        ["mv {} {}/{}".format(tmp, path, digest)]
+    docker_util.exec_safely(container, ["sh", "-c", " && ".join(cmd)])
 
 
 def server_configure(api):
@@ -216,7 +1278,55 @@ def proxy_configure(container, cfg):
         docker_util.string_into_container(cfg.proxy_ssl_key, container,
                                           "/run/proxy/key.pem")
     else:
-        print("Generating self-signed certificates for proxy")
         args = ["/usr/local/bin/build-self-signed-certificate", "/run/proxy",
                 "GB", "London", "IC", "bacpop", cfg.proxy_host]
-        docker_util.exec_safely(container, args)
+        files = ["/run/proxy/certificate.pem", "/run/proxy/key.pem"]
+        digest = input_digest(args)
+        if restore_cached(container, "proxy-certificate", digest, files,
+                          certificate_valid):
+            print("Reusing self-signed certificates for proxy")
+        else:
+            print("Generating self-signed certificates for proxy")
+            docker_util.exec_safely(container, args)
+            save_cached(container, "proxy-certificate", digest, files)
+    if cfg.proxy_performance:
+        proxy_performance_configure(container, cfg)
+
+
+# A cached self-signed certificate is only reused while it has at least
+# this long left before it expires
+CERTIFICATE_MIN_VALIDITY = 30 * 24 * 60 * 60
+
+
+def certificate_valid(path):
+    return "openssl x509 -checkend {} -noout -in {}/certificate.pem".format(
+        CERTIFICATE_MIN_VALIDITY, path)
+
+
+# The include is read in the http context of the image's nginx.conf,
+# and the location snippet is included in each of its locations; the
+# two settings that live elsewhere (the proxy_pass to the server, to
+# use the keepalive pool, and worker_connections in the events block)
+# are edited in place.
+def proxy_performance_configure(container, cfg):
+    print("[proxy] Applying performance settings")
+    settings = cfg.proxy_performance
+    server = "server:{}".format(cfg.server_port)
+    docker_util.string_into_container(proxy_conf(settings, server),
+                                      container, PROXY_CONF)
+    docker_util.string_into_container(proxy_location_conf(settings),
+                                      container, PROXY_LOCATION_CONF)
+    edits = [proxy_location_edit()]
+    if settings["keepalive"]:
+        edits.append("s#http://{}#http://{}#".format(server, PROXY_UPSTREAM))
+    if settings["worker_connections"]:
+        edits.append("s/worker_connections +[0-9]+;/worker_connections {};/"
+                     .format(settings["worker_connections"]))
+    docker_util.exec_safely(container, [
+        "sh", "-c", "sed -i -E {} /etc/nginx/nginx.conf "
+        "/etc/nginx/conf.d/*.conf".format(
+            " ".join("-e '{}'".format(x) for x in edits))])
+    docker_util.exec_safely(container, ["nginx", "-t"])
+    # nginx may not have started yet (it waits for the certificate), in
+    # which case it reads the new configuration when it does
+    container.exec_run(["nginx", "-s", "reload"])
@@ -0,0 +1,115 @@
+"""A journaled runner for the steps of a data migration.
+
+Completed steps are recorded in a journal file in the storage volume,
+so a migration that fails part way through resumes from where it got
+to. Steps declare the steps they depend on, and steps whose
+dependencies are satisfied run at the same time. Like beebop_redis,
+this only uses the standard library so that it can be copied next to
+a migration script and run inside the api container.
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+
+class Step:
+    def __init__(self, name, f, after, journal):
+        self.name = name
+        self.f = f
+        self.after = after
+        self.journal = journal
+
+
+class Migration:
+    def __init__(self, name, journal_path, logger):
+        self.name = name
+        self.journal_path = journal_path
+        self.logger = logger
+        self.steps = {}
+        self.lock = threading.Lock()
+        self.state = {}
+
+    def step(self, after=(), journal=True):
+        """Register a step. Steps with journal=False (e.g., building an
+        in-memory plan) are cheap and have no side effects, so they are
+        run every time rather than recorded."""
+        def register(f):
+            for x in after:
+                if x not in self.steps:
+                    raise Exception(f"Step '{f.__name__}' depends on"
+                                    f" unknown step '{x}'")
+            self.steps[f.__name__] = Step(f.__name__, f, after, journal)
+            return f
+        return register
+
+    def read_journal(self):
+        try:
+            with open(self.journal_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"migration": self.name, "steps": {}}
+
+    def write_journal(self, journal):
+        os.makedirs(os.path.dirname(self.journal_path), exist_ok=True)
+        with open(self.journal_path + ".tmp", "w") as f:
+            json.dump(journal, f, indent=2)
+        os.replace(self.journal_path + ".tmp", self.journal_path)
+
+    def run(self, dry_run=False, max_workers=4):
+        """Run all steps not yet recorded in the journal. With dry_run,
+        each step is called with dry_run=True and should only report
+        what it would do; nothing is recorded."""
+        journal = self.read_journal()
+        if journal.get("completed"):
+            self.logger.info(f"Migration {self.name} already completed")
+            return journal
+        done = {x for x in journal["steps"]}
+        if done:
+            self.logger.info(f"Resuming {self.name}; already completed:"
+                             f" {', '.join(sorted(done))}")
+        finished = set()
+        pending = dict(self.steps)
+        futures = {}
+
+        def run_step(step):
+            t0 = time.time()
+            if step.journal and step.name in done:
+                self.logger.info(f"Skipping completed step {step.name}")
+                return
+            self.logger.info(f"Running step {step.name}")
+            step.f(self.state, dry_run)
+            if step.journal and not dry_run:
+                with self.lock:
+                    journal["steps"][step.name] = {
+                        "completed": time.time(),
+                        "elapsed": time.time() - t0}
+                    self.write_journal(journal)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+            while pending or futures:
+                for name, step in list(pending.items()):
+                    if all(x in finished for x in step.after):
+                        futures[pool.submit(run_step, step)] = name
+                        del pending[name]
+                complete, _ = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in complete:
+                    name = futures.pop(f)
+                    f.result()
+                    finished.add(name)
+
+        if not dry_run:
+            journal["completed"] = time.time()
+            self.write_journal(journal)
+        return journal
+
+
+def parse_args(name, argv=None):
+    parser = argparse.ArgumentParser(description=f"Run migration {name}")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument(
+        "--journal", default=f"/beebop/storage/.migrations/{name}.json")
+    return parser.parse_args(argv)
@@ -0,0 +1,102 @@
+import heapq
+import queue
+import re
+import sys
+import threading
+import time
+
+from src.beebop_deploy import parse_age, service_containers
+
+# Lines held between the containers' log streams and the terminal; when
+# it is full the readers stop reading, so the docker daemon buffers the
+# rest rather than this process.
+QUEUE_SIZE = 1000
+# When following, a line is printed once it has waited this long, so
+# that lines from other containers written just before it (but read
+# just after) can be printed first.
+REORDER_WINDOW = 0.2
+
+
+def lines(chunks):
+    """Split a stream of byte chunks into lines, whatever the chunks'
+    boundaries."""
+    partial = b""
+    for chunk in chunks:
+        parts = (partial + chunk).split(b"\n")
+        partial = parts.pop()
+        yield from parts
+    if partial:
+        yield partial
+
+
+# Docker writes timestamps in a fixed width RFC3339 format, so they
+# sort correctly as bytes.
+def log_entries(label, container, follow=False, since=None, pattern=None):
+    """Yield (timestamp, label, text) for each line of a container's
+    log that matches pattern."""
+    chunks = container.logs(stream=True, follow=follow, timestamps=True,
+                            since=since)
+    for line in lines(chunks):
+        timestamp, _, text = line.partition(b" ")
+        text = text.decode("utf-8", "replace").rstrip("\r")
+        if pattern is None or pattern.search(text):
+            yield timestamp, label, text
+
+
+def merge_logs(streams):
+    """Merge finished log streams by timestamp, holding one line from
+    each in memory."""
+    return heapq.merge(*streams, key=lambda x: x[0])
+
+
+def follow_logs(streams, window=REORDER_WINDOW, maxsize=QUEUE_SIZE,
+                clock=time.monotonic):
+    """Read each log stream in its own thread, yielding lines roughly
+    in timestamp order until every stream ends."""
+    q = queue.Queue(maxsize)
+    done = object()
+
+    def read(stream):
+        try:
+            for x in stream:
+                q.put(x)
+        finally:
+            q.put(done)
+
+    for stream in streams:
+        threading.Thread(target=read, args=(stream,), daemon=True).start()
+    running = len(streams)
+    pending = []
+    while running or pending:
+        try:
+            x = q.get(timeout=window if pending else None)
+        except queue.Empty:
+            x = None
+        if x is done:
+            running -= 1
+        elif x is not None:
+            heapq.heappush(pending, (x[0], clock(), x))
+        # Hold at most a queue's worth of lines, and none once every
+        # stream has ended
+        while pending and (not running or len(pending) > maxsize or
+                           clock() - pending[0][1] >= window):
+            yield heapq.heappop(pending)[2]
+
+
+def beebop_logs(obj, args, out=sys.stdout):
+    containers = service_containers(obj, args["services"])
+    if not containers:
+        raise Exception("No containers are running")
+    since = int(time.time() - parse_age(args["since"])) \
+        if args["since"] else None
+    pattern = re.compile(args["grep"]) if args["grep"] else None
+    streams = [log_entries(label, container, args["follow"], since, pattern)
+               for label, container in containers]
+    width = max(len(label) for label, container in containers)
+    merge = follow_logs if args["follow"] else merge_logs
+    try:
+        for timestamp, label, text in merge(streams):
+            out.write("{:<{}} | {} {}\n".format(
+                label, width, timestamp.decode(), text))
+    except KeyboardInterrupt:
+        pass
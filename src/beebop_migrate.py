@@ -0,0 +1,101 @@
+import glob
+import json
+import os
+
+import constellation.docker_util as docker_util
+
+from src.beebop_deploy import \
+    exec_streaming, \
+    running_container, \
+    string_to_path
+
+MIGRATIONS_PATH = "migrations"
+JOURNAL_PATH = "/beebop/storage/.migrations"
+# Copied next to each python migration so that it can import them
+MIGRATION_HELPERS = ["src/beebop_journal.py",
+                     "src/beebop_redis.py",
+                     "src/beebop_storage.py"]
+
+
+# Migrations are either a directory with a migration.py, which runs in
+# the api container and journals its own steps, or a single shell
+# script, which runs in the redis container as one step.
+def find_migrations(path=MIGRATIONS_PATH):
+    ret = []
+    for p in sorted(os.listdir(path)):
+        full = os.path.join(path, p)
+        if os.path.exists(os.path.join(full, "migration.py")):
+            ret.append((p, full))
+        elif p.endswith(".sh"):
+            ret.append((p[:-3], full))
+    return ret
+
+
+def journal_path(name):
+    return "{}/{}.json".format(JOURNAL_PATH, name)
+
+
+def read_journal(api, name):
+    res = api.exec_run(["cat", journal_path(name)])
+    if res[0] != 0:
+        return {}
+    return json.loads(res[1].decode("UTF-8"))
+
+
+def beebop_migrate(obj, args):
+    api = running_container(obj, "api")
+    redis = running_container(obj, "redis")
+    found = find_migrations()
+    if args["name"] and args["name"] not in [x[0] for x in found]:
+        raise Exception("Unknown migration '{}'".format(args["name"]))
+    if args.get("mark_applied"):
+        mark_applied(api, args["name"])
+        return
+    for name, path in found:
+        if args["name"] and name != args["name"]:
+            continue
+        if read_journal(api, name).get("completed"):
+            print("[migrate] {} already applied".format(name))
+            continue
+        print("[migrate] {}{}".format(
+            name, " (dry run)" if args["dry_run"] else ""))
+        if os.path.isdir(path):
+            run_python_migration(api, name, path, args["dry_run"])
+        else:
+            run_shell_migration(api, redis, name, path, args["dry_run"])
+
+
+# For migrations applied by hand before they were journalled, so that
+# they are not run again
+def mark_applied(api, name):
+    if read_journal(api, name).get("completed"):
+        print("[migrate] {} already applied".format(name))
+        return
+    string_to_path(api, json.dumps({"migration": name, "completed": True,
+                                    "marked_applied": True}),
+                   journal_path(name))
+    print("[migrate] {} marked as applied".format(name))
+
+
+def run_python_migration(api, name, path, dry_run):
+    dest = "{}/{}".format(JOURNAL_PATH, name)
+    docker_util.exec_safely(api, ["mkdir", "-p", dest])
+    for f in sorted(glob.glob(os.path.join(path, "*.py"))) + \
+            MIGRATION_HELPERS:
+        docker_util.file_into_container(f, api, dest, os.path.basename(f))
+    args = ["python3", "{}/migration.py".format(dest),
+            "--journal", journal_path(name)]
+    if dry_run:
+        args.append("--dry-run")
+    exec_streaming(api, args)
+
+
+def run_shell_migration(api, redis, name, path, dry_run):
+    if dry_run:
+        print("Would run {} in the redis container".format(path))
+        return
+    with open(path) as f:
+        script = f.read()
+    exec_streaming(redis, ["bash", "-c", script])
+    string_to_path(api, json.dumps({"migration": name, "completed": True}),
+                   journal_path(name))
@@ -0,0 +1,200 @@
+import concurrent.futures
+import json
+import os
+import time
+
+import constellation.docker_util as docker_util
+
+from src.beebop_deploy import \
+    STORAGE_PATH, \
+    redis_connection, \
+    running_container, \
+    service_containers
+from src.beebop_scale import rq_queue_lengths, rq_workers
+
+# The samples file is moved to <file>.1 once it grows past this, so at
+# most twice this is kept on disk.
+ROTATE_BYTES = 10 * 1000 * 1000
+# df only reads the filesystem's counters, but du walks every file in
+# storage, so the storage total is refreshed every this many samples.
+DU_EVERY = 60
+
+
+class Sampler:
+    """Collect one sample at a time of container, queue and storage
+    use. CPU is worked out from the difference between samples, so
+    docker does not have to wait to measure it."""
+    def __init__(self, obj, r, du_every=DU_EVERY, clock=time.time,
+                 process_time=time.process_time):
+        self.obj = obj
+        self.r = r
+        self.du_every = du_every
+        self.clock = clock
+        self.process_time = process_time
+        self.cpu = {}
+        self.n = 0
+        self.storage_bytes = None
+        self.last = None
+
+    def sample(self):
+        t0 = self.clock()
+        p0 = self.process_time()
+        checks = {"containers": self.containers,
+                  "redis": self.redis,
+                  "storage": self.storage}
+        ret = {"time": t0}
+        with concurrent.futures.ThreadPoolExecutor(len(checks)) as pool:
+            futures = {k: pool.submit(f) for k, f in checks.items()}
+            for k, f in futures.items():
+                try:
+                    ret[k] = f.result()
+                except Exception as e:
+                    ret[k] = {"error": str(e)}
+        # The share of one cpu used by this process since the last
+        # sample, including the time spent waiting between samples
+        if self.last:
+            ret["overhead"] = (self.process_time() - self.last[1]) / \
+                max(self.clock() - self.last[0], 1e-9)
+        self.last = (t0, p0)
+        self.n += 1
+        return ret
+
+    def containers(self):
+        found = service_containers(self.obj)
+        if not found:
+            return {}
+        with concurrent.futures.ThreadPoolExecutor(
+                min(len(found), 8)) as pool:
+            stats = pool.map(lambda x: x[1].stats(stream=False,
+                                                  one_shot=True), found)
+            return {label: self.container_usage(label, x)
+                    for (label, container), x in zip(found, stats)}
+
+    def container_usage(self, label, stats):
+        cpu = stats["cpu_stats"]
+        total = cpu["cpu_usage"]["total_usage"]
+        system = cpu.get("system_cpu_usage", 0)
+        prev = self.cpu.get(label)
+        self.cpu[label] = (total, system)
+        ret = {"cpu_seconds": total / 1e9,
+               "mem": stats["memory_stats"].get("usage", 0),
+               "mem_limit": stats["memory_stats"].get("limit", 0)}
+        # As a number of cpus, as in docker stats
+        if prev and system > prev[1]:
+            ret["cpu"] = (total - prev[0]) / (system - prev[1]) * \
+                cpu.get("online_cpus", 1)
+        return ret
+
+    def redis(self):
+        queues = rq_queue_lengths(self.r)
+        pipe = self.r.pipeline(transaction=False)
+        for q in queues:
+            pipe.zcard("rq:failed:{}".format(q))
+            pipe.zcard("rq:wip:{}".format(q))
+        res = pipe.execute()
+        states = {}
+        for x in rq_workers(self.r).values():
+            state = x.get("state", "unknown")
+            states[state] = states.get(state, 0) + 1
+        return {"queues": {q: {"queued": n, "started": started,
+                               "failed": failed}
+                           for (q, n), failed, started in zip(
+                               queues.items(), res[0::2], res[1::2])},
+                "workers": states}
+
+    def storage(self):
+        api = running_container(self.obj, "api")
+        out = docker_util.exec_safely(api, [
+            "df", "-B1", "--output=used,avail", STORAGE_PATH])[1]
+        used, avail = out.decode().split("\n")[1].split()
+        ret = {"fs_used": int(used), "fs_avail": int(avail)}
+        if self.n % self.du_every == 0:
+            out = docker_util.exec_safely(api, [
+                "du", "-sb", STORAGE_PATH])[1]
+            self.storage_bytes = int(out.decode().split()[0])
+        if self.storage_bytes is not None:
+            ret["bytes"] = self.storage_bytes
+        return ret
+
+
+def append_sample(path, sample, rotate_bytes=ROTATE_BYTES):
+    if os.path.exists(path) and os.path.getsize(path) >= rotate_bytes:
+        os.replace(path, path + ".1")
+    with open(path, "a") as f:
+        f.write(json.dumps(sample, separators=(",", ":")) + "\n")
+
+
+def prometheus_text(sample, name):
+    """The sample in Prometheus' text format, for the node exporter's
+    textfile collector."""
+    lines = []
+
+    def metric(key, kind, help, values):
+        lines.append("# HELP beebop_{} {}".format(key, help))
+        lines.append("# TYPE beebop_{} {}".format(key, kind))
+        for labels, v in values:
+            labels = dict(labels, constellation=name)
+            lines.append("beebop_{}{{{}}} {}".format(key, ",".join(
+                '{}="{}"'.format(k, v) for k, v in sorted(labels.items())),
+                v))
+
+    containers = sample["containers"]
+    if "error" not in containers:
+        metric("container_cpu_seconds_total", "counter",
+               "CPU time used by the container",
+               [({"container": k}, x["cpu_seconds"])
+                for k, x in containers.items()])
+        metric("container_memory_bytes", "gauge",
+               "Memory used by the container",
+               [({"container": k}, x["mem"]) for k, x in containers.items()])
+    redis = sample["redis"]
+    if "error" not in redis:
+        metric("rq_jobs", "gauge", "RQ jobs by queue and state",
+               [({"queue": q, "state": state}, x[state])
+                for q, x in redis["queues"].items()
+                for state in ["queued", "started", "failed"]])
+        metric("rq_workers", "gauge", "RQ workers by state",
+               [({"state": k}, n) for k, n in redis["workers"].items()])
+    storage = sample["storage"]
+    if "error" not in storage:
+        metric("storage_filesystem_bytes", "gauge",
+               "Used and available space on the storage filesystem",
+               [({"type": "used"}, storage["fs_used"]),
+                ({"type": "avail"}, storage["fs_avail"])])
+        if "bytes" in storage:
+            metric("storage_bytes", "gauge", "Size of beebop's storage",
+                   [({}, storage["bytes"])])
+    metric("monitor_sample_timestamp_seconds", "gauge",
+           "When the sample was taken", [({}, sample["time"])])
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path, sample, name):
+    # The collector may read at any moment, so the file is replaced
+    # rather than rewritten
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(prometheus_text(sample, name))
+    os.replace(tmp, path)
+
+
+def beebop_monitor(obj, args, r=None, sampler=None, clock=time.monotonic,
+                   sleep=time.sleep):
+    sampler = sampler or Sampler(obj, r or redis_connection(obj))
+    print("[monitor] sampling every {}s to {}".format(
+        args["interval"], args["output"]))
+    due = clock()
+    n = 0
+    try:
+        while args["samples"] is None or n < args["samples"]:
+            sample = sampler.sample()
+            if args["prometheus"]:
+                write_prometheus(args["output"], sample, obj.name)
+            else:
+                append_sample(args["output"], sample)
+            n += 1
+            due += args["interval"]
+            if args["samples"] is None or n < args["samples"]:
+                sleep(max(due - clock(), 0))
+    except KeyboardInterrupt:
+        pass
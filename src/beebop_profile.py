@@ -0,0 +1,134 @@
+import contextlib
+import json
+import threading
+import time
+
+# The profile being recorded, if any; phase() is a no-op otherwise so
+# that it can be left in place around deploy steps.
+_active = None
+
+
+class Profile:
+    def __init__(self, action, config_name):
+        self.action = action
+        self.config_name = config_name
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.records = []
+        self.unattributed = new_record("other", None)
+        self.t0 = time.perf_counter()
+
+    def current(self):
+        stack = getattr(self.local, "stack", [])
+        return stack[-1] if stack else self.unattributed
+
+    def add(self, key, n):
+        with self.lock:
+            rec = self.current()
+            rec[key] = rec.get(key, 0) + n
+
+    def report(self):
+        records = self.records
+        if self.unattributed["api_calls"]:
+            records = records + [self.unattributed]
+        return {"action": self.action,
+                "config": self.config_name,
+                "time": time.time(),
+                "elapsed": time.perf_counter() - self.t0,
+                "api_calls": sum(x["api_calls"] for x in records),
+                "phases": records}
+
+
+def new_record(name, container):
+    return {"phase": name, "container": container, "elapsed": 0,
+            "api_calls": 0, "bytes_sent": 0, "bytes_received": 0}
+
+
+@contextlib.contextmanager
+def phase(name, container=None):
+    """Time a deploy phase, attributing docker API calls made on this
+    thread while it runs (to the innermost phase)."""
+    p = _active
+    if p is None:
+        yield
+        return
+    rec = new_record(name, container)
+    stack = p.local.__dict__.setdefault("stack", [])
+    stack.append(rec)
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        rec["elapsed"] = time.perf_counter() - t0
+        stack.pop()
+        with p.lock:
+            p.records.append(rec)
+
+
+def add(key, n):
+    if _active is not None:
+        _active.add(key, n)
+
+
+def record_api_call(request, response):
+    sent = len(request.body or b"")
+    received = int(response.headers.get("Content-Length") or 0)
+    with _active.lock:
+        rec = _active.current()
+        rec["api_calls"] += 1
+        rec["bytes_sent"] += sent
+        rec["bytes_received"] += received
+
+
+# docker's APIClient is a requests Session, so every API call made by
+# any client (including those constellation creates) goes through send
+@contextlib.contextmanager
+def docker_api_hook():
+    import docker
+    cls = docker.api.client.APIClient
+    own = "send" in vars(cls)
+    original = cls.send
+
+    def send(self, request, **kwargs):
+        response = original(self, request, **kwargs)
+        if _active is not None:
+            record_api_call(request, response)
+        return response
+
+    cls.send = send
+    try:
+        yield
+    finally:
+        if own:
+            cls.send = original
+        else:
+            del cls.send
+
+
+@contextlib.contextmanager
+def profiling(action, config_name, path):
+    global _active
+    _active = Profile(action, config_name)
+    try:
+        with docker_api_hook():
+            yield _active
+    finally:
+        p, _active = _active, None
+        report = p.report()
+        print_report(report)
+        with open(path_profile(path), "a") as f:
+            f.write(json.dumps(report) + "\n")
+
+
+def path_profile(path):
+    return path + "/.deploy_profile"
+
+
+def print_report(report):
+    print("Profile of '{}' ({:.2f}s, {} docker API calls):".format(
+        report["action"], report["elapsed"], report["api_calls"]))
+    for x in sorted(report["phases"], key=lambda x: -x["elapsed"]):
+        name = x["phase"] + (" " + x["container"] if x["container"] else "")
+        print("  {:<32} {:>8.2f}s {:>5} calls {:>10} B sent {:>10} B recv"
+              .format(name, x["elapsed"], x["api_calls"], x["bytes_sent"],
+                      x["bytes_received"]))
@@ -0,0 +1,24 @@
+import os
+
+import constellation.docker_util as docker_util
+
+from src.beebop_deploy import exec_streaming, parse_age, running_container
+
+OUTPUT_PATH = "/beebop/storage/poppunk_output"
+PRUNE_PATH = "/prune"
+# Run inside the api container, which can see both the storage volume
+# and redis
+PRUNE_FILES = ["scripts/prune_outputs", "src/beebop_redis.py"]
+
+
+def beebop_prune(obj, args):
+    seconds = parse_age(args["older_than"])
+    api = running_container(obj, "api")
+    docker_util.exec_safely(api, ["mkdir", "-p", PRUNE_PATH])
+    for f in PRUNE_FILES:
+        docker_util.file_into_container(f, api, PRUNE_PATH,
+                                        os.path.basename(f))
+    cmd = ["python3", "{}/prune_outputs".format(PRUNE_PATH)]
+    if args["dry_run"]:
+        cmd.append("--dry-run")
+    exec_streaming(api, cmd + [OUTPUT_PATH, str(seconds)])
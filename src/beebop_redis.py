@@ -0,0 +1,104 @@
+"""Batched helpers for rewriting beebop's Redis keys without blocking
+the server that live workers depend on.
+
+This module only depends on redis-py so that it can be copied next to
+a migration script and run inside the api container.
+"""
+import re
+import time
+
+DEFAULT_BATCH_SIZE = 500
+
+
+# Rough cost of a pipelined round trip, used to estimate how long a
+# rewrite will take
+ROUND_TRIP_SECONDS = 2e-3
+
+
+def estimate_seconds(n_keys, batch_size=DEFAULT_BATCH_SIZE, throttle=0):
+    n_batches = -(-n_keys // batch_size)
+    return n_batches * (2 * ROUND_TRIP_SECONDS + throttle) + \
+        n_keys * 1e-5
+
+
+def decode(key):
+    return key.decode("utf-8") if isinstance(key, bytes) else key
+
+
+def glob_escape(prefix):
+    """Escape prefix so that SCAN MATCH treats it literally."""
+    return re.sub(r"([*?\[\]\\])", r"\\\1", prefix)
+
+
+def scan_keys(r, pattern, batch_size=DEFAULT_BATCH_SIZE, throttle=0):
+    """Yield lists of keys matching pattern using cursor-based SCAN."""
+    cursor = 0
+    while True:
+        cursor, keys = r.scan(cursor, match=pattern, count=batch_size)
+        if keys:
+            yield keys
+        if cursor == 0:
+            break
+        if throttle:
+            time.sleep(throttle)
+
+
+def batches(items, batch_size=DEFAULT_BATCH_SIZE):
+    """Split an iterable into lists of at most batch_size items."""
+    batch = []
+    for x in items:
+        batch.append(x)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def copy_hashes(r, keys, rename, batch_size=DEFAULT_BATCH_SIZE,
+                throttle=0):
+    """Copy each hash in keys to rename(key), one pipeline round trip
+    to read and one to write per batch. Returns the keys copied."""
+    copied = []
+    for batch in batches(keys, batch_size):
+        pipe = r.pipeline(transaction=False)
+        for key in batch:
+            pipe.hgetall(key)
+        values = pipe.execute()
+        pipe = r.pipeline(transaction=False)
+        for key, value in zip(batch, values):
+            if value:
+                pipe.hset(rename(decode(key)), mapping=value)
+                copied.append(decode(key))
+        pipe.execute()
+        if throttle:
+            time.sleep(throttle)
+    return copied
+
+
+def copy_matching_hashes(r, pattern, rename, batch_size=DEFAULT_BATCH_SIZE,
+                         throttle=0):
+    """Copy every hash matching pattern to rename(key)."""
+    copied = []
+    for keys in scan_keys(r, pattern, batch_size, throttle):
+        copied += copy_hashes(r, keys, rename, batch_size, throttle)
+    return copied
+
+
+def unlink_keys(r, keys, batch_size=DEFAULT_BATCH_SIZE, throttle=0):
+    """Remove keys with UNLINK, which frees memory in the background
+    rather than blocking the server. Returns the number removed."""
+    removed = 0
+    for batch in batches(keys, batch_size):
+        removed += r.unlink(*batch)
+        if throttle:
+            time.sleep(throttle)
+    return removed
+
+
+def unlink_matching(r, pattern, batch_size=DEFAULT_BATCH_SIZE, throttle=0):
+    """Remove every key matching pattern."""
+    removed = 0
+    for keys in scan_keys(r, pattern, batch_size, throttle):
+        removed += unlink_keys(r, keys, batch_size, throttle)
+    return removed
@@ -0,0 +1,163 @@
+import concurrent.futures
+import socket
+import time
+
+import constellation.docker_util as docker_util
+
+from src.beebop_deploy import \
+    READINESS_PROBES, \
+    is_running, \
+    on_worker_hosts, \
+    pull_images, \
+    pull_remote_images, \
+    remote_workers, \
+    resolve_secrets, \
+    start_container, \
+    start_host_workers, \
+    start_service, \
+    stop_worker, \
+    wait_ready
+from src.beebop_scale import worker_containers, worker_services
+
+
+# Containers that are reached through their network alias, so a new
+# copy can be started next to the old one before the old one is
+# removed. The proxy publishes host ports and redis holds state, so
+# those are restarted instead (and only if their image changed).
+SERVICE_PORTS = {
+    "api": lambda cfg: 5000,
+    "server": lambda cfg: cfg.server_port
+}
+
+
+def rolling_upgrade(obj):
+    """Pull images and replace only the containers whose image changed,
+    keeping beebop available: api and server are swapped once their
+    replacement accepts connections, and workers are replaced in
+    batches, each finishing its current job before it exits."""
+    t0 = time.time()
+    resolve_secrets(obj)
+    latest = pull_images(obj).image_ids
+    pull_remote_images(obj)
+    # Listed before redis restarts, after which the workers lose their
+    # connection and exit
+    workers = {x.name: worker_containers(obj, x)
+               for x in worker_services(obj)}
+    redis_restarted = False
+    for name in ["redis", "api", "server", "proxy"]:
+        x = obj.containers.find(name)
+        old = x.get(obj.prefix)
+        if not old:
+            raise Exception("'{}' is not running; start beebop first".format(
+                name))
+        if old.attrs["Image"] == latest[str(x.image)]:
+            print("[{}] image unchanged".format(name))
+        elif name in SERVICE_PORTS:
+            swap_container(x, old, obj)
+        else:
+            restart_container(x, old, obj)
+            redis_restarted = redis_restarted or name == "redis"
+    for x in worker_services(obj):
+        image_id = latest[str(x.image)]
+        replace_workers(obj, x, [c for c in workers[x.name]
+                                 if redis_restarted or
+                                 c.attrs["Image"] != image_id],
+                        **obj.data.worker_upgrade)
+    # Image ids are content digests, so are the same on every host
+    replace_host_workers(
+        obj, lambda host, c: redis_restarted or c.attrs["Image"] != latest[
+            str(obj.containers.find(host["service"]).image)],
+        **obj.data.worker_upgrade)
+    print("Upgraded {} in {:.1f}s".format(obj.name, time.time() - t0))
+
+
+def restart_container(x, old, obj):
+    if old:
+        print("[{}] restarting".format(x.name))
+        docker_util.container_stop(old, False, x.name)
+        old.remove()
+    container = start_container(x, x.name, obj)
+    wait_ready(x.name, READINESS_PROBES.get(x.name, is_running), container)
+    if x.configure:
+        x.configure(container, obj.data)
+
+
+def swap_container(x, old, obj):
+    print("[{}] starting replacement".format(x.name))
+    new = start_container(x, x.name + "-next", obj)
+    wait_ready(x.name, is_running, new)
+    if x.configure:
+        x.configure(new, obj.data)
+    port = SERVICE_PORTS[x.name](obj.data)
+    wait_ready(x.name, accepts_connections(obj, port), new)
+    # Both containers now answer to the alias; have the proxy pick up
+    # the new one before the old one goes, and drop it afterwards
+    reload_proxy(obj, x.name)
+    docker_util.container_stop(old, False, x.name)
+    old.remove()
+    new.rename(old.name)
+    reload_proxy(obj, x.name)
+
+
+def accepts_connections(obj, port):
+    def probe(container):
+        container.reload()
+        networks = container.attrs["NetworkSettings"]["Networks"]
+        ip = networks[obj.network.name]["IPAddress"]
+        try:
+            socket.create_connection((ip, port), timeout=1).close()
+            return True
+        except OSError:
+            return False
+    return probe
+
+
+# nginx resolves the server's alias when it loads its configuration;
+# a reload re-resolves it without dropping connections
+def reload_proxy(obj, name):
+    if name != "server":
+        return
+    proxy = obj.containers.get("proxy", obj.prefix)
+    if proxy and proxy.status == "running":
+        docker_util.exec_safely(proxy, ["nginx", "-s", "reload"])
+
+
+def replace_workers(obj, worker, old, batch_size, drain_timeout):
+    if not old:
+        print("[{}] unchanged".format(worker.name))
+        return
+    print("[{}] replacing {} workers, {} at a time".format(
+        worker.name, len(old), batch_size))
+    for i in range(0, len(old), batch_size):
+        batch = old[i:i + batch_size]
+        start_service(worker, obj, len(batch))
+        with concurrent.futures.ThreadPoolExecutor(len(batch)) as pool:
+            list(pool.map(lambda c: drain_worker(c, drain_timeout), batch))
+
+
+def replace_host_workers(obj, outdated, batch_size, drain_timeout):
+    """Replace, in batches, the workers on each worker host for which
+    outdated(host, container) is true."""
+    def replace(host, client):
+        old = [c for c in remote_workers(host, client, obj)
+               if outdated(host, c)]
+        if not old:
+            print("[{}] workers unchanged".format(host["name"]))
+            return
+        print("[{}] replacing {} workers, {} at a time".format(
+            host["name"], len(old), batch_size))
+        for i in range(0, len(old), batch_size):
+            batch = old[i:i + batch_size]
+            start_host_workers(obj, host, client, len(batch))
+            with concurrent.futures.ThreadPoolExecutor(len(batch)) as pool:
+                list(pool.map(lambda c: drain_worker(c, drain_timeout),
+                              batch))
+    on_worker_hosts(obj, replace)
+
+
+def drain_worker(container, timeout):
+    print("[worker] draining {}".format(container.name))
+    t0 = time.time()
+    stop_worker(container, timeout)
+    print("[worker] {} finished after {:.1f}s".format(
+        container.name, time.time() - t0))
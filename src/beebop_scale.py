@@ -0,0 +1,149 @@
+import time
+
+import constellation
+
+from src.beebop_deploy import redis_connection, start_service, stop_worker
+from src.beebop_redis import decode
+
+
+def worker_services(obj):
+    return [x for x in obj.containers.collection
+            if isinstance(x, constellation.ConstellationService)]
+
+
+def worker_service(obj, pool=None):
+    """The service running the given worker pool; pool may only be
+    omitted when there is a single pool."""
+    if pool is not None:
+        return obj.containers.find("worker-" + pool)
+    services = worker_services(obj)
+    if len(services) > 1:
+        raise Exception("Several worker pools are configured ({}); "
+                        "choose one with --pool".format(", ".join(
+                            x.name[len("worker-"):] for x in services)))
+    return services[0]
+
+
+def worker_containers(obj, service=None):
+    return (service or worker_service(obj)).get(obj.prefix)
+
+
+# RQ registers each worker as a hash "rq:worker:<name>" listed in the
+# set "rq:workers"; the hostname field is the container's hostname.
+def rq_workers(r):
+    keys = list(r.smembers("rq:workers"))
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        pipe.hgetall(key)
+    ret = {}
+    for key, x in zip(keys, pipe.execute()):
+        x = {decode(k): decode(v) for k, v in x.items()}
+        if "hostname" in x:
+            ret[x["hostname"]] = x
+    return ret
+
+
+def rq_queue_lengths(r, names=None):
+    queues = sorted(decode(x) for x in r.smembers("rq:queues"))
+    if names is not None:
+        queues = [x for x in queues if x[len("rq:queue:"):] in names]
+    pipe = r.pipeline(transaction=False)
+    for key in queues:
+        pipe.llen(key)
+    return {key[len("rq:queue:"):]: n
+            for key, n in zip(queues, pipe.execute())}
+
+
+def idle_workers(containers, workers):
+    return [x for x in containers
+            if workers.get(x.attrs["Config"]["Hostname"], {}).get(
+                "state") == "idle"]
+
+
+def scale_workers(obj, n, r=None, service=None):
+    """Resize a worker service to n replicas without touching any
+    other container. Only workers that RQ reports as idle are removed,
+    so fewer than requested may be removed; returns the new count."""
+    service = service or worker_service(obj)
+    containers = worker_containers(obj, service)
+    current = len(containers)
+    if n > current:
+        print("Scaling {} from {} to {}".format(service.name, current, n))
+        start_service(service, obj, n - current)
+        return n
+    if n < current:
+        r = r or redis_connection(obj)
+        idle = idle_workers(containers, rq_workers(r))[:current - n]
+        if len(idle) < current - n:
+            print("Only {} of {} workers are idle".format(
+                len(idle), current - n))
+        print("Scaling {} from {} to {}".format(
+            service.name, current, current - len(idle)))
+        for x in idle:
+            stop_worker(x, obj.data.worker_upgrade["drain_timeout"])
+        return current - len(idle)
+    print("Already running {} {} replicas".format(current, service.name))
+    return current
+
+
+class Autoscaler:
+    """Grow or shrink a worker service between min and max replicas
+    to match the number of queued (on its queues) and running jobs,
+    waiting at least cooldown_up (cooldown_down) seconds between
+    changes."""
+    def __init__(self, obj, r, settings, clock=time.monotonic,
+                 service=None):
+        self.obj = obj
+        self.r = r
+        self.service = service or worker_service(obj)
+        self.min = settings["min"]
+        self.max = settings["max"]
+        self.interval = settings["interval"]
+        self.cooldown_up = settings["cooldown_up"]
+        self.cooldown_down = settings["cooldown_down"]
+        self.clock = clock
+        self.last_change = None
+
+    def desired(self, queued, busy):
+        return max(self.min, min(self.max, busy + queued))
+
+    def cooling_down(self, cooldown):
+        return self.last_change is not None and \
+            self.clock() - self.last_change < cooldown
+
+    def step(self):
+        containers = worker_containers(self.obj, self.service)
+        current = len(containers)
+        queued = sum(rq_queue_lengths(self.r, self.service.base.args)
+                     .values())
+        workers = rq_workers(self.r)
+        busy = current - len(idle_workers(containers, workers))
+        target = self.desired(queued, busy)
+        if target > current and not self.cooling_down(self.cooldown_up):
+            print("[autoscale] {} queued, {} busy".format(queued, busy))
+            scale_workers(self.obj, target, self.r, self.service)
+            self.last_change = self.clock()
+        elif target < current and \
+                not self.cooling_down(self.cooldown_down):
+            print("[autoscale] {} queued, {} busy".format(queued, busy))
+            if scale_workers(self.obj, target, self.r,
+                             self.service) < current:
+                self.last_change = self.clock()
+        return target
+
+    def run(self):
+        print("Autoscaling {} between {} and {}".format(
+            self.service.name, self.min, self.max))
+        while True:
+            self.step()
+            time.sleep(self.interval)
+
+
+def beebop_scale(obj, args):
+    service = worker_service(obj, args.get("pool"))
+    if args["autoscale"]:
+        r = redis_connection(obj)
+        Autoscaler(obj, r, obj.data.worker_autoscale,
+                   service=service).run()
+    else:
+        scale_workers(obj, args["count"], service=service)
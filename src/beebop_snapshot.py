@@ -0,0 +1,164 @@
+"""Export and import beebop's Redis keys as a compressed stream of
+DUMP payloads, a batch at a time, so that memory use does not depend
+on the number of keys.
+
+The file is gzip-compressed: a header line of json, followed by chunks
+of a 4 byte count and that many records, each a length-prefixed key, a
+signed 8 byte TTL in milliseconds (0 for none) and a length-prefixed
+DUMP payload.
+"""
+import gzip
+import json
+import os
+import struct
+import time
+
+import redis
+
+from src.beebop_deploy import redis_connection
+from src.beebop_redis import DEFAULT_BATCH_SIZE, batches, glob_escape, \
+    scan_keys
+
+MAGIC = b"BEEBOP-REDIS 1\n"
+COUNT = struct.Struct(">I")
+TTL = struct.Struct(">q")
+
+
+class Throughput:
+    """Count keys and bytes, printing the rate every interval
+    seconds."""
+    def __init__(self, verb, interval=5, clock=time.monotonic):
+        self.verb = verb
+        self.interval = interval
+        self.clock = clock
+        self.t0 = self.last = clock()
+        self.keys = 0
+        self.bytes = 0
+
+    def add(self, keys, n):
+        self.keys += keys
+        self.bytes += n
+        if self.clock() - self.last >= self.interval:
+            self.last = self.clock()
+            self.report("...")
+
+    def report(self, suffix=""):
+        elapsed = max(self.clock() - self.t0, 1e-9)
+        print("{} {} keys ({:.1f} MB) in {:.1f}s ({:.0f} keys/s, "
+              "{:.1f} MB/s){}".format(
+                  self.verb, self.keys, self.bytes / 1e6, elapsed,
+                  self.keys / elapsed, self.bytes / 1e6 / elapsed, suffix))
+
+
+def write_bytes(f, x):
+    f.write(COUNT.pack(len(x)))
+    f.write(x)
+
+
+def read_exactly(f, n):
+    x = f.read(n)
+    if len(x) != n:
+        raise Exception("Snapshot is truncated")
+    return x
+
+
+def read_bytes(f):
+    return read_exactly(f, COUNT.unpack(read_exactly(f, COUNT.size))[0])
+
+
+def export_keys(r, f, prefix="beebop:", batch_size=DEFAULT_BATCH_SIZE,
+                progress=None):
+    """Write every key starting with prefix to the binary stream f.
+    Keys that disappear or expire during the export are skipped.
+    Returns the number of keys written."""
+    progress = progress or Throughput("Exported")
+    f.write(MAGIC)
+    f.write(json.dumps({"prefix": prefix, "time": time.time()}).encode() +
+            b"\n")
+    for keys in scan_keys(r, glob_escape(prefix) + "*", batch_size):
+        pipe = r.pipeline(transaction=False)
+        for key in keys:
+            pipe.dump(key)
+            pipe.pttl(key)
+        res = pipe.execute()
+        # A key may expire between SCAN, DUMP and PTTL (PTTL -2); -1
+        # is a key with no expiry
+        records = [(key, dump, ttl) for key, dump, ttl in
+                   zip(keys, res[0::2], res[1::2])
+                   if dump is not None and ttl != -2]
+        f.write(COUNT.pack(len(records)))
+        n = 0
+        for key, dump, ttl in records:
+            write_bytes(f, key)
+            f.write(TTL.pack(0 if ttl == -1 else ttl))
+            write_bytes(f, dump)
+            n += len(key) + len(dump)
+        progress.add(len(records), n)
+    progress.report()
+    return progress.keys
+
+
+def read_header(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise Exception("Not a beebop redis snapshot")
+    return json.loads(f.readline())
+
+
+def read_records(f):
+    """Yield (key, ttl, dump) from the binary stream f, after the
+    header, one chunk in memory at a time."""
+    while True:
+        x = f.read(COUNT.size)
+        if not x:
+            return
+        if len(x) != COUNT.size:
+            raise Exception("Snapshot is truncated")
+        for i in range(COUNT.unpack(x)[0]):
+            key = read_bytes(f)
+            ttl = TTL.unpack(read_exactly(f, TTL.size))[0]
+            yield key, ttl, read_bytes(f)
+
+
+def import_keys(r, f, prefix="beebop:", batch_size=DEFAULT_BATCH_SIZE,
+                replace=False, progress=None):
+    """RESTORE the keys in the binary stream f that start with prefix,
+    batch_size per pipeline. Existing keys are kept unless replace is
+    set. Returns the numbers of keys restored and skipped."""
+    progress = progress or Throughput("Imported")
+    read_header(f)
+    records = (x for x in read_records(f)
+               if x[0].startswith(prefix.encode()))
+    skipped = 0
+    for batch in batches(records, batch_size):
+        pipe = r.pipeline(transaction=False)
+        for key, ttl, dump in batch:
+            pipe.restore(key, ttl, dump, replace=replace)
+        restored = 0
+        for res in pipe.execute(raise_on_error=False):
+            if isinstance(res, redis.ResponseError):
+                if not str(res).startswith("BUSYKEY"):
+                    raise res
+                skipped += 1
+            else:
+                restored += 1
+        progress.add(restored, sum(len(x[0]) + len(x[2]) for x in batch))
+    progress.report(", {} existing keys kept".format(skipped)
+                    if skipped else "")
+    return progress.keys, skipped
+
+
+def beebop_redis_export(obj, args):
+    r = redis_connection(obj, timeout=None)
+    # Written alongside and then moved, so an interrupted export never
+    # leaves a partial file under the requested name
+    tmp = args["file"] + ".tmp"
+    with gzip.open(tmp, "wb") as f:
+        export_keys(r, f, args["prefix"], args["batch_size"])
+    os.replace(tmp, args["file"])
+
+
+def beebop_redis_import(obj, args):
+    r = redis_connection(obj, timeout=None)
+    with gzip.open(args["file"], "rb") as f:
+        import_keys(r, f, args["prefix"], args["batch_size"],
+                    args["replace"])
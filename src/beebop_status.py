@@ -0,0 +1,246 @@
+import concurrent.futures
+import json
+import ssl
+import time
+import urllib.request
+
+import docker
+import constellation
+
+from src.beebop_deploy import \
+    docker_host_client, \
+    redis_connection, \
+    remote_workers
+from src.beebop_scale import rq_queue_lengths, rq_workers
+
+# Every check runs at the same time and gives up after this long, and
+# the report does not wait more than twice this for any check, so a
+# stuck docker daemon or redis cannot hold up the others.
+STATUS_TIMEOUT = 1
+
+
+def beebop_status(obj, args):
+    report = health_report(obj)
+    if args["json"]:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+def health_report(obj, r=None, timeout=STATUS_TIMEOUT):
+    t0 = time.time()
+    # Each check makes its own client, as connecting is itself a call
+    # to the daemon that may hang
+    checks = {
+        "network": lambda: network_status(obj, docker_client(timeout)),
+        "volumes": lambda: volume_status(obj, docker_client(timeout)),
+        "containers": lambda: container_status(obj, docker_client(timeout)),
+        "images": lambda: image_status(obj, docker_client(timeout)),
+        "redis": lambda: redis_status(obj, r, timeout),
+        "api": lambda: api_status(obj.data, timeout),
+        "hosts": lambda: host_status(obj, timeout)
+    }
+    report = {"name": obj.name, "prefix": obj.prefix}
+    pool = concurrent.futures.ThreadPoolExecutor(len(checks))
+    futures = {k: pool.submit(f) for k, f in checks.items()}
+    deadline = t0 + 2 * timeout
+    for k, f in futures.items():
+        try:
+            report[k] = f.result(timeout=max(deadline - time.time(), 0))
+        except concurrent.futures.TimeoutError:
+            report[k] = {"error": "timeout"}
+        except Exception as e:
+            report[k] = {"error": str(e)}
+    # Checks that timed out are left to finish in the background
+    pool.shutdown(wait=False)
+    # Compare each container's image with the image its tag now points
+    # to locally, so that containers left behind by a pull show up
+    images = report.pop("images")
+    if isinstance(report["containers"], list):
+        for x in report["containers"]:
+            latest = images.get(x["image"], {}).get("id")
+            x["image_current"] = x["image_id"] == latest if latest else None
+            x["image_digest"] = images.get(x["image"], {}).get("digest")
+    report["elapsed"] = time.time() - t0
+    return report
+
+
+def docker_client(timeout):
+    return docker.client.from_env(timeout=timeout)
+
+
+def exists(collection, name):
+    try:
+        collection.get(name)
+        return True
+    except docker.errors.NotFound:
+        return False
+
+
+def network_status(obj, client):
+    name = obj.network.name
+    return {"name": name, "exists": exists(client.networks, name)}
+
+
+def volume_status(obj, client):
+    return [{"role": x.role, "name": x.name,
+             "exists": exists(client.volumes, x.name)}
+            for x in obj.volumes.collection]
+
+
+# A single list call returns the summary of every container (including
+# all worker replicas), rather than inspecting each one in turn.
+def container_status(obj, client):
+    found = {x["Names"][0].lstrip("/"): x for x in client.api.containers(
+        all=True, filters={"name": "^/{}-".format(obj.prefix)})}
+    ret = []
+    for x in obj.containers.collection:
+        name = "{}-{}".format(obj.prefix, x.name)
+        if isinstance(x, constellation.ConstellationService):
+            names = sorted(k for k in found if k.startswith(name + "-"))
+        else:
+            names = [name] if name in found else []
+        if not names:
+            ret.append({"role": x.name, "name": name, "status": "missing",
+                        "image": str(x.image), "image_id": None})
+        for nm in names:
+            ret.append({"role": x.name, "name": nm,
+                        "status": found[nm]["State"],
+                        "uptime": found[nm]["Status"],
+                        "image": str(x.image),
+                        "image_id": found[nm]["ImageID"]})
+    return ret
+
+
+def image_status(obj, client):
+    refs = {str(x.image) for x in obj.containers.collection}
+
+    def get(ref):
+        try:
+            image = client.images.get(ref)
+        except docker.errors.ImageNotFound:
+            return {}
+        digests = image.attrs.get("RepoDigests") or [None]
+        return {"id": image.id, "digest": digests[0]}
+
+    with concurrent.futures.ThreadPoolExecutor(len(refs)) as pool:
+        return dict(zip(refs, pool.map(get, refs)))
+
+
+def redis_status(obj, r=None, timeout=STATUS_TIMEOUT):
+    r = r or redis_connection(obj, timeout)
+    t0 = time.time()
+    r.ping()
+    ping = time.time() - t0
+    queues = rq_queue_lengths(r)
+    pipe = r.pipeline(transaction=False)
+    for q in queues:
+        pipe.zcard("rq:failed:{}".format(q))
+    failed = pipe.execute()
+    states = {}
+    for x in rq_workers(r).values():
+        state = x.get("state", "unknown")
+        states[state] = states.get(state, 0) + 1
+    return {"ping_ms": ping * 1000,
+            "queues": {q: {"queued": n, "failed": f}
+                       for (q, n), f in zip(queues.items(), failed)},
+            "workers": states}
+
+
+def api_status(cfg, timeout=STATUS_TIMEOUT):
+    # The server's /version asks the api for its version, so this is a
+    # round trip through the proxy, server and api
+    url = "{}/version".format(cfg.server_url)
+    # Certificates may be self-signed outside production; we only want
+    # to know that the stack answers
+    context = ssl._create_unverified_context()
+    t0 = time.time()
+    with urllib.request.urlopen(url, timeout=timeout,
+                                context=context) as res:
+        res.read()
+        code = res.status
+    return {"url": url, "status": code,
+            "latency_ms": (time.time() - t0) * 1000}
+
+
+def host_status(obj, timeout):
+    hosts = obj.data.worker_hosts
+    if not hosts:
+        return []
+
+    def check(host):
+        ret = {"name": host["name"], "url": host["url"],
+               "expected": host["count"]}
+        try:
+            client = docker_host_client(host["url"], timeout=timeout)
+            ret["workers"] = [{"name": x.name, "status": x.status}
+                              for x in remote_workers(host, client, obj)]
+        except Exception as e:
+            ret["error"] = str(e)
+        return ret
+    with concurrent.futures.ThreadPoolExecutor(len(hosts)) as pool:
+        return list(pool.map(check, hosts))
+
+
+def print_report(report):
+    print("Constellation {} (checked in {:.2f}s)".format(
+        report["name"], report["elapsed"]))
+    nw = report["network"]
+    print("  * Network:")
+    if "error" in nw:
+        print("    - error: {}".format(nw["error"]))
+    else:
+        print("    - {}: {}".format(
+            nw["name"], "created" if nw["exists"] else "missing"))
+    print("  * Volumes:")
+    if isinstance(report["volumes"], dict):
+        print("    - error: {}".format(report["volumes"]["error"]))
+    else:
+        for x in report["volumes"]:
+            print("    - {} ({}): {}".format(
+                x["role"], x["name"],
+                "created" if x["exists"] else "missing"))
+    print("  * Containers:")
+    if isinstance(report["containers"], dict):
+        print("    - error: {}".format(report["containers"]["error"]))
+    else:
+        for x in report["containers"]:
+            image = {True: "current", False: "outdated"}.get(
+                x.get("image_current"), "unknown")
+            print("    - {} ({}): {}{}".format(
+                x["role"], x["name"], x["status"],
+                ", image " + image if x["status"] != "missing" else ""))
+    redis = report["redis"]
+    print("  * Redis:")
+    if "error" in redis:
+        print("    - error: {}".format(redis["error"]))
+    else:
+        print("    - ping: {:.1f}ms".format(redis["ping_ms"]))
+        print("    - workers: {}".format(", ".join(
+            "{} ({})".format(k, v) for k, v in
+            sorted(redis["workers"].items())) or "none"))
+        for q, x in sorted(redis["queues"].items()):
+            print("    - queue {}: {} queued, {} failed".format(
+                q, x["queued"], x["failed"]))
+    api = report["api"]
+    print("  * API:")
+    if "error" in api:
+        print("    - error: {}".format(api["error"]))
+    else:
+        print("    - {}: {} in {:.0f}ms".format(
+            api["url"], api["status"], api["latency_ms"]))
+    hosts = report["hosts"]
+    if hosts:
+        print("  * Worker hosts:")
+    if isinstance(hosts, dict):
+        print("    - error: {}".format(hosts["error"]))
+    else:
+        for x in hosts:
+            if "error" in x:
+                print("    - {} ({}): error: {}".format(
+                    x["name"], x["url"], x["error"]))
+            else:
+                print("    - {} ({}): {} of {} workers running".format(
+                    x["name"], x["url"], len([w for w in x["workers"]
+                                              if w["status"] == "running"]),
+                    x["expected"]))
@@ -0,0 +1,207 @@
+"""Helpers for migrating the poppunk_output tree in the storage volume.
+
+The tree is read once into an in-memory index; migrations then plan
+their file operations from the index and apply them in one pass.
+Like beebop_redis, this only depends on the standard library so that
+it can be copied next to a migration script and run inside the api
+container.
+"""
+import fcntl
+import json
+import os
+import shutil
+
+
+def scan_files(path, prefix=""):
+    """Return the relative paths of all files below path."""
+    files = set()
+    with os.scandir(path) as it:
+        for entry in it:
+            name = prefix + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                files |= scan_files(entry.path, name + "/")
+            else:
+                files.add(name)
+    return files
+
+
+def index_folders(base_folder):
+    """Index base_folder as {folder: {subfolder: {relative files}}}.
+
+    Only directories directly below base_folder (one per project) and
+    their subdirectories are indexed; each file is visited once.
+    """
+    index = {}
+    with os.scandir(base_folder) as projects:
+        for project in projects:
+            if not project.is_dir(follow_symlinks=False):
+                continue
+            subfolders = {}
+            with os.scandir(project.path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        subfolders[entry.name] = scan_files(entry.path)
+            index[project.name] = subfolders
+    return index
+
+
+def apply_operation(op, src, dst):
+    if op == "copy":
+        shutil.copyfile(src, dst)
+    elif op == "rename":
+        os.rename(src, dst)
+    elif op == "move":
+        shutil.move(src, dst)
+    else:
+        raise Exception("Unknown operation '{}'".format(op))
+
+
+def run_operations(base_folder, plans, logger):
+    """Apply planned (op, src, dst) operations, given relative to
+    base_folder, in order. They are not run concurrently: on a real
+    disk, metadata operations are serialised by the filesystem and
+    threads only add contention."""
+    n = 0
+    for ops in plans.values():
+        for op, src, dst in ops:
+            apply_operation(op, os.path.join(base_folder, src),
+                            os.path.join(base_folder, dst))
+            logger.info(f"{op}: {src} → {dst}")
+            n += 1
+    return n
+
+
+# Rough per-operation costs on the storage volume, used to estimate
+# how long a planned migration will take
+ESTIMATED_SECONDS = {"copy": 2e-3, "rename": 5e-4, "move": 5e-4}
+
+
+def estimate_seconds(plans):
+    return sum(ESTIMATED_SECONDS.get(op, 1e-3)
+               for ops in plans.values() for op, src, dst in ops)
+
+
+MANIFEST = "manifest.json"
+FICLONE = 0x40049409
+
+
+def clone_file(src, dst):
+    """Copy a file, sharing its blocks (reflink) where the filesystem
+    supports it."""
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def link_file(src, dst):
+    """Hard link src to dst, falling back on a copy."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        clone_file(src, dst)
+
+
+def link_tree(src, dst):
+    os.makedirs(dst)
+    with os.scandir(src) as it:
+        for entry in it:
+            target = os.path.join(dst, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                link_tree(entry.path, target)
+            else:
+                link_file(entry.path, target)
+
+
+def under(path, paths):
+    while path:
+        if path in paths:
+            return True
+        path = os.path.dirname(path)
+    return False
+
+
+def snapshot_plan(plans, changed=()):
+    """Work out which existing paths the planned operations will move
+    or rename (saved), which they will create (created), and which are
+    modified in place (changed)."""
+    saved = []
+    created = []
+    seen = set()
+    for ops in plans.values():
+        for op, src, dst in ops:
+            # Anything below a path created by an earlier operation is
+            # covered by backing up that operation's source
+            if op != "copy" and not under(src, seen):
+                saved.append(src)
+            created.append(dst)
+            seen.add(dst)
+    return {"saved": saved, "created": created, "changed": list(changed)}
+
+
+def create_snapshot(base_folder, backup_folder, plans, logger, changed=()):
+    """Back up only the paths that plans (and in-place changes to
+    changed) will touch. Files that are moved or renamed keep their
+    contents, so are hard linked; files changed in place are cloned.
+    A manifest records what to undo in restore_snapshot."""
+    manifest = snapshot_plan(plans, changed)
+    os.makedirs(backup_folder)
+    for path in manifest["saved"] + manifest["changed"]:
+        src = os.path.join(base_folder, path)
+        dst = os.path.join(backup_folder, path)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.isdir(src):
+            link_tree(src, dst)
+        elif path in manifest["changed"]:
+            clone_file(src, dst)
+        else:
+            link_file(src, dst)
+    with open(os.path.join(backup_folder, MANIFEST), "w") as f:
+        json.dump(manifest, f)
+    logger.info(f"Backed up {len(manifest['saved'])} moved and"
+                f" {len(manifest['changed'])} changed paths")
+    return manifest
+
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def restore_snapshot(base_folder, backup_folder, logger):
+    """Undo a migration backed up with create_snapshot: remove the
+    paths it created and put back the paths it moved or changed.
+    Backups without a manifest are full copies of base_folder (made
+    before create_snapshot existed), and replace it entirely."""
+    if not os.path.exists(os.path.join(backup_folder, MANIFEST)):
+        restore_copy(base_folder, backup_folder, logger)
+        return
+    with open(os.path.join(backup_folder, MANIFEST)) as f:
+        manifest = json.load(f)
+    for path in reversed(manifest["created"]):
+        remove_path(os.path.join(base_folder, path))
+    for path in manifest["saved"] + manifest["changed"]:
+        src = os.path.join(backup_folder, path)
+        if not os.path.lexists(src):
+            continue
+        dst = os.path.join(base_folder, path)
+        remove_path(dst)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        os.replace(src, dst)
+    logger.info(f"Restored {len(manifest['saved'])} moved and"
+                f" {len(manifest['changed'])} changed paths")
+
+
+def restore_copy(base_folder, backup_folder, logger):
+    # The current tree is moved aside rather than removed first, so
+    # that an interrupted restore never leaves neither copy in place
+    old = base_folder + ".rollback"
+    if os.path.exists(base_folder):
+        os.rename(base_folder, old)
+    os.rename(backup_folder, base_folder)
+    if os.path.exists(old):
+        shutil.rmtree(old)
+    logger.info(f"Restored {base_folder} from a full backup")
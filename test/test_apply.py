@@ -0,0 +1,128 @@
+import docker
+
+from conftest import FakeDocker
+from src import beebop_apply
+from src import beebop_deploy
+from src import beebop_rolling
+
+
+def constellation(options=None):
+    cfg = beebop_deploy.BeebopConfig("config", "fake", options=options)
+    obj = beebop_deploy.beebop_constellation(cfg)
+    for x in obj.containers.collection:
+        x.configure = None
+    return obj
+
+
+def start(fake_docker):
+    fake_docker.containers.exec_handler = lambda c, cmd: (0, b"PONG")
+    beebop_deploy.beebop_start(constellation(), {"pull_images": True})
+
+
+def test_apply_with_no_changes_does_nothing(fake_docker):
+    start(fake_docker)
+    runs = len(fake_docker.containers.runs)
+    plan = beebop_apply.beebop_apply(constellation(),
+                                     {"pull_images": False, "dry_run": False})
+    assert plan == []
+    assert len(fake_docker.containers.runs) == runs
+
+
+def test_apply_recreates_only_what_changed(fake_docker, monkeypatch):
+    start(fake_docker)
+    monkeypatch.setattr(beebop_rolling, "accepts_connections",
+                        lambda obj, port: lambda container: True)
+    store = fake_docker.containers.store
+    before = dict(store)
+    obj = constellation({"server": {"client_url": "https://example.com"},
+                         "worker": {"count": 3}})
+
+    plan = beebop_apply.beebop_apply(obj, {"pull_images": False,
+                                           "dry_run": True})
+    assert [(x["name"], x["action"], x.get("reasons")) for x in plan] == [
+        ("worker", "scale", None),
+        ("server", "recreate", ["configuration"])]
+    assert store == before
+
+    beebop_apply.beebop_apply(obj, {"pull_images": False, "dry_run": False})
+    for name in ["beebop-redis", "beebop-api", "beebop-proxy"]:
+        assert store[name] is before[name]
+    assert store["beebop-server"] is not before["beebop-server"]
+    assert len([x for x in store if x.startswith("beebop-worker-")]) == 3
+    assert beebop_apply.plan_changes(obj) == []
+
+
+def test_apply_replaces_containers_with_new_image(fake_docker, monkeypatch):
+    start(fake_docker)
+    monkeypatch.setattr(beebop_rolling, "accepts_connections",
+                        lambda obj, port: lambda container: True)
+    obj = constellation()
+    fake_docker.api.layers[str(obj.data.api_ref)] = [("v2", 10)]
+    plan = beebop_apply.beebop_apply(obj, {"pull_images": True,
+                                           "dry_run": False})
+    assert [(x["name"], x["action"]) for x in plan] == [
+        ("api", "recreate"), ("worker", "replace")]
+    assert beebop_apply.plan_changes(obj) == []
+
+
+def test_apply_creates_missing_containers(fake_docker):
+    start(fake_docker)
+    fake_docker.containers.store.pop("beebop-proxy")
+    plan = beebop_apply.plan_changes(constellation())
+    assert plan == [{"name": "proxy", "action": "create"}]
+
+
+def test_apply_recreates_containers_with_new_resource_limits(fake_docker):
+    start(fake_docker)
+    obj = constellation({"redis": {"resources": {"memory": "1g"}}})
+    plan = beebop_apply.beebop_apply(obj, {"pull_images": False,
+                                           "dry_run": False})
+    # workers are replaced too, as they lose their redis connection
+    assert [(x["name"], x["action"], x["reasons"]) for x in plan] == [
+        ("redis", "recreate", ["resources"]),
+        ("worker", "replace", ["redis"])]
+    assert fake_docker.containers.store["beebop-redis"].attrs[
+        "HostConfig"]["Memory"] == 1024 ** 3
+    assert beebop_apply.plan_changes(obj) == []
+
+
+def test_apply_replaces_host_workers_with_redis(fake_docker, monkeypatch):
+    remote = FakeDocker()
+    monkeypatch.setattr(docker, "DockerClient",
+                        lambda base_url, **kwargs: remote)
+    hosts = [{"name": "node1", "url": "ssh://node1", "count": 2,
+              "redis_host": "10.0.0.1", "storage_path": "/mnt/beebop",
+              "dbs_path": "/mnt/dbs"}]
+    worker = {"hosts": hosts, "redis_bind": "10.0.0.1"}
+    fake_docker.containers.exec_handler = lambda c, cmd: (0, b"PONG")
+    beebop_deploy.beebop_start(constellation({"worker": worker}),
+                               {"pull_images": True})
+    before = set(remote.containers.store)
+    obj = constellation({"worker": worker,
+                         "redis": {"resources": {"memory": "1g"}}})
+    plan = beebop_apply.beebop_apply(obj, {"pull_images": False,
+                                           "dry_run": False})
+    assert [(x["name"], x["action"], x["reasons"]) for x in plan] == [
+        ("redis", "recreate", ["resources"]),
+        ("worker", "replace", ["redis"]),
+        ("worker hosts", "replace", ["redis"])]
+    assert len(remote.containers.store) == 2
+    assert not set(remote.containers.store) & before
+
+
+def test_apply_compares_published_address(fake_docker):
+    hosts = [{"name": "node1", "url": "ssh://node1", "count": 1,
+              "redis_host": "10.0.0.1", "storage_path": "/mnt/beebop",
+              "dbs_path": "/mnt/dbs"}]
+    obj = constellation({"worker": {"hosts": hosts,
+                                    "redis_bind": "10.0.0.1"}})
+    x = obj.containers.find("redis")
+    mounts = [m.to_mount(obj.volumes) for m in x.mounts]
+    container = fake_docker.containers.run("redis", name="beebop-redis",
+                                           ports=x.ports, mounts=mounts)
+    assert beebop_apply.container_diff(x, container, obj, None) == []
+    container = fake_docker.containers.run("redis", name="beebop-redis",
+                                           ports={"6379/tcp": 6379},
+                                           mounts=mounts)
+    assert beebop_apply.container_diff(x, container, obj, None) == \
+        ["ports"]
@@ -0,0 +1,33 @@
+import importlib.machinery
+import importlib.util
+
+loader = importlib.machinery.SourceFileLoader(
+    "benchmark_proxy", "scripts/benchmark_proxy")
+benchmark_proxy = importlib.util.module_from_spec(
+    importlib.util.spec_from_loader(loader.name, loader))
+loader.exec_module(benchmark_proxy)
+
+
+def test_measure_downloads_each_file_over_one_connection():
+    upstream = benchmark_proxy.Upstream(100000)
+    try:
+        for path in benchmark_proxy.FILES:
+            res = benchmark_proxy.measure(upstream.port, path, 3)
+            assert res["bytes"] == upstream.sizes[path] >= 100000
+            assert 0 < res["p50"] <= res["p99"]
+    finally:
+        upstream.close()
+
+
+def test_nginx_conf_uses_keepalive_pool_when_configured():
+    settings = benchmark_proxy.deploy.proxy_performance(
+        {"proxy": {"performance": {}}})
+    conf = benchmark_proxy.nginx_conf(8480, 9000, settings)
+    assert "server 127.0.0.1:9000;" in conf
+    assert "proxy_pass http://beebop_server;" in conf
+    location = conf[conf.index("location / {"):]
+    assert 'proxy_set_header Connection "";' in location
+    assert "add_header Cache-Control" in location
+    conf = benchmark_proxy.nginx_conf(8480, 9000, None)
+    assert "gzip" not in conf
+    assert "proxy_pass http://127.0.0.1:9000;" in conf
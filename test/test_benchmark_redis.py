@@ -0,0 +1,71 @@
+import importlib.machinery
+import importlib.util
+
+import docker
+import fakeredis
+
+from conftest import FakeDocker
+
+loader = importlib.machinery.SourceFileLoader(
+    "benchmark_redis", "scripts/benchmark_redis")
+benchmark_redis = importlib.util.module_from_spec(
+    importlib.util.spec_from_loader(loader.name, loader))
+loader.exec_module(benchmark_redis)
+
+
+# fakeredis does not implement CONFIG
+class ConfigurableRedis(fakeredis.FakeRedis):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.settings = {"save": "3600 1", "appendonly": "no",
+                         "appendfsync": "everysec"}
+        self.history = []
+
+    def config_get(self, pattern):
+        return {pattern: self.settings[pattern]}
+
+    def config_set(self, name, value):
+        self.history.append((name, value))
+        self.settings[name] = value
+
+
+def test_benchmark_runs_each_profile_and_restores_settings():
+    r = ConfigurableRedis()
+    results = benchmark_redis.run(r, benchmark_redis.PROFILES, 20, 10)
+    assert sorted(results) == sorted(benchmark_redis.PROFILES)
+    for x in results.values():
+        assert set(x) == {"enqueue", "dequeue"}
+        assert 0 < x["enqueue"]["p50"] <= x["enqueue"]["max"]
+    assert r.settings == {"save": "3600 1", "appendonly": "no",
+                          "appendfsync": "everysec"}
+    assert ("appendfsync", "always") in r.history
+    # the benchmark leaves no keys behind
+    assert r.keys("*") == []
+
+
+def test_benchmark_uses_a_throwaway_redis_by_default(monkeypatch):
+    client = FakeDocker()
+    run = client.containers.run
+
+    def run_published(image, **kwargs):
+        container = run(image, **kwargs)
+        container.attrs["NetworkSettings"] = {
+            "Ports": {"6379/tcp": [{"HostIp": "127.0.0.1",
+                                    "HostPort": "49153"}]}}
+        return container
+    client.containers.run = run_published
+    monkeypatch.setattr(docker.client, "from_env", lambda **kwargs: client)
+    connected = []
+
+    def connect(host, port):
+        connected.append((host, port))
+        return ConfigurableRedis()
+    monkeypatch.setattr(benchmark_redis.redis, "Redis", connect)
+
+    benchmark_redis.main(["--jobs", "5", "--profile", "rdb"])
+    assert connected == [("127.0.0.1", 49153)]
+    image, command, kwargs = client.containers.runs[0]
+    assert image == "redis:7"
+    # published on a random local port only
+    assert kwargs["ports"] == {"6379/tcp": ("127.0.0.1", None)}
+    assert not client.containers.store
@@ -1,6 +1,12 @@
+import docopt
 import io
+import os
+import pickle
 import pytest
+import shutil
 import string
+import subprocess
+import sys
 
 from contextlib import redirect_stdout
 from unittest import mock
@@ -11,35 +17,203 @@ from src import beebop_deploy
 
 def test_cli_parse():
     assert beebop_cli.parse(["start"]) == \
-        ("config", None, "start", {"pull_images": False}, {})
+        ("config", None, "start", {"pull_images": False, "profile": False},
+         {})
     assert beebop_cli.parse(["start", "--pull"]) == \
-        ("config", None, "start", {"pull_images": True}, {})
+        ("config", None, "start", {"pull_images": True, "profile": False},
+         {})
     assert beebop_cli.parse(["start", "prod"]) == \
-        ("config", "prod", "start", {"pull_images": False}, {})
+        ("config", "prod", "start", {"pull_images": False, "profile": False},
+         {})
+    assert beebop_cli.parse(["start", "prod", "--profile"]) == \
+        ("config", "prod", "start", {"pull_images": False, "profile": True},
+         {})
     assert beebop_cli.parse(["stop"]) == \
         ("config", None, "stop", {"kill": False, "remove_network": False,
-                                  "remove_volumes": False}, {})
+                                  "remove_volumes": False, "profile": False},
+         {})
     assert beebop_cli.parse(["stop", "--kill", "--network"]) == \
         ("config", None, "stop", {"kill": True, "remove_network": True,
-                                  "remove_volumes": False}, {})
+                                  "remove_volumes": False, "profile": False},
+         {})
 
     assert beebop_cli.parse(["destroy"]) == \
         ("config", None, "stop", {"kill": True, "remove_network": True,
                                   "remove_volumes": True}, {})
 
-    assert beebop_cli.parse(["status"]) == ("config", None, "status", {}, {})
-    assert beebop_cli.parse(["upgrade"]) == ("config", None, "upgrade", {}, {})
+    assert beebop_cli.parse(["status"]) == \
+        ("config", None, "status", {"json": False}, {})
+    assert beebop_cli.parse(["status", "--json"]) == \
+        ("config", None, "status", {"json": True}, {})
+    assert beebop_cli.parse(["upgrade"]) == \
+        ("config", None, "upgrade", {"rolling": False, "profile": False}, {})
+    assert beebop_cli.parse(["upgrade", "--rolling"]) == \
+        ("config", None, "upgrade", {"rolling": True, "profile": False}, {})
+    assert beebop_cli.parse(["apply", "--dry-run"]) == \
+        ("config", None, "apply", {"pull_images": False, "dry_run": True},
+         {})
+    assert beebop_cli.parse(["migrate", "--dry-run"]) == \
+        ("config", None, "migrate",
+         {"dry_run": True, "name": None, "mark_applied": False}, {})
+    assert beebop_cli.parse(["migrate", "20250227_viz_move"]) == \
+        ("config", None, "migrate",
+         {"dry_run": False, "name": "20250227_viz_move",
+          "mark_applied": False}, {})
+    assert beebop_cli.parse(["migrate", "--mark-applied",
+                             "20250227_viz_move"]) == \
+        ("config", None, "migrate",
+         {"dry_run": False, "name": "20250227_viz_move",
+          "mark_applied": True}, {})
+    assert beebop_cli.parse(["scale", "3"]) == \
+        ("config", None, "scale",
+         {"autoscale": False, "count": 3, "pool": None}, {})
+    assert beebop_cli.parse(["scale", "--auto"]) == \
+        ("config", None, "scale",
+         {"autoscale": True, "count": None, "pool": None}, {})
+    assert beebop_cli.parse(["scale", "2", "--pool=short"])[3] == \
+        {"autoscale": False, "count": 2, "pool": "short"}
+    assert beebop_cli.parse(["prune", "--older-than=90d", "--dry-run"]) == \
+        ("config", None, "prune", {"older_than": "90d", "dry_run": True}, {})
+    assert beebop_cli.parse(["redis-export", "x.gz"]) == \
+        ("config", None, "redis-export",
+         {"file": "x.gz", "prefix": "beebop:", "batch_size": 500}, {})
+    assert beebop_cli.parse(["redis-import", "x.gz", "--prefix=beebop:hash:",
+                             "--batch-size=100", "--replace"]) == \
+        ("config", None, "redis-import",
+         {"file": "x.gz", "prefix": "beebop:hash:", "batch_size": 100,
+          "replace": True}, {})
+    assert beebop_cli.parse(["logs"]) == \
+        ("config", None, "logs",
+         {"follow": False, "since": None, "grep": None, "services": []}, {})
+    assert beebop_cli.parse(["logs", "--follow", "--since=30m",
+                             "--grep=job [0-9]+", "api", "worker"]) == \
+        ("config", None, "logs",
+         {"follow": True, "since": "30m", "grep": "job [0-9]+",
+          "services": ["api", "worker"]}, {})
+    assert beebop_cli.parse(["monitor", "--interval=10", "--prometheus",
+                             "--output=/var/lib/node/beebop.prom"]) == \
+        ("config", None, "monitor",
+         {"interval": 10, "output": "/var/lib/node/beebop.prom",
+          "prometheus": True, "samples": None}, {})
 
 
-def test_args_passed_to_start():
-    with mock.patch('src.beebop_cli.beebop_start') as f:
+def test_bad_scale_count_exits_with_usage():
+    for count in ["two", "-1", "1.5"]:
+        with pytest.raises(docopt.DocoptExit, match="Usage"):
+            beebop_cli.parse(["scale", "--", count])
+    assert beebop_cli.parse(["scale", "0"])[3]["count"] == 0
+
+
+def test_bad_batch_size_exits_with_usage():
+    for size in ["0", "-5", "abc"]:
+        with pytest.raises(docopt.DocoptExit, match="Usage"):
+            beebop_cli.parse(["redis-export", "x.gz",
+                              "--batch-size={}".format(size)])
+
+
+def test_args_passed_to_start(tmp_path, monkeypatch):
+    # main() saves the configuration it starts with, so run it against
+    # a copy rather than the repo's config directory
+    shutil.copytree("config", str(tmp_path / "config"),
+                    ignore=shutil.ignore_patterns(".*"))
+    monkeypatch.chdir(tmp_path)
+    with mock.patch('src.beebop_deploy.beebop_start') as f:
         beebop_cli.main(["start", "prod"])
 
     assert f.called
     assert f.call_args[0][1] == {"pull_images": False}
 
-    with mock.patch('src.beebop_cli.beebop_start') as f:
+    with mock.patch('src.beebop_deploy.beebop_start') as f:
         beebop_cli.main(["start", "prod", "--pull"])
 
     assert f.called
     assert f.call_args[0][1] == {"pull_images": True}
+
+
+def test_config_is_cached_until_yaml_changes(tmp_path, monkeypatch):
+    path = str(tmp_path)
+    for f in ["beebop.yml", "fake.yml"]:
+        shutil.copy("config/" + f, path)
+    built = []
+    init = beebop_deploy.BeebopConfig.__init__
+
+    def counted(self, *args, **kwargs):
+        built.append(args)
+        init(self, *args, **kwargs)
+    monkeypatch.setattr(beebop_deploy.BeebopConfig, "__init__", counted)
+
+    cfg = beebop_cli.cached_config(path, "fake", {})
+    cached = beebop_cli.cached_config(path, "fake", {})
+    assert len(built) == 1
+    assert cached.container_prefix == cfg.container_prefix
+
+    beebop_cli.cached_config(path, "fake", {"worker": {"count": 1}})
+    assert len(built) == 2
+
+    with open(path + "/fake.yml", "a") as x:
+        x.write("\n# changed\n")
+    beebop_cli.cached_config(path, "fake", {})
+    assert len(built) == 3
+
+    beebop_cli.cached_config(path, "fake", {}, ttl=0)
+    assert len(built) == 4
+
+
+def test_corrupt_config_cache_is_rebuilt(tmp_path):
+    path = str(tmp_path)
+    for f in ["beebop.yml", "fake.yml"]:
+        shutil.copy("config/" + f, path)
+    cfg = beebop_cli.cached_config(path, "fake", {})
+    with open(beebop_cli.path_config_cache(path), "rb") as f:
+        data = f.read()
+    # as if the write had been interrupted
+    with open(beebop_cli.path_config_cache(path), "wb") as f:
+        f.write(data[:len(data) // 2])
+    rebuilt = beebop_cli.cached_config(path, "fake", {})
+    assert rebuilt.container_prefix == cfg.container_prefix
+    assert beebop_cli.cached_config(path, "fake", {}).container_prefix == \
+        cfg.container_prefix
+    assert sorted(os.listdir(path)) == [".config_cache", "beebop.yml",
+                                        "fake.yml"]
+
+
+def test_config_cache_keeps_vault_references(tmp_path):
+    path = str(tmp_path)
+    for f in ["beebop.yml", "prod.yml"]:
+        shutil.copy("config/" + f, path)
+    beebop_cli.cached_config(path, "prod", {})
+    with open(beebop_cli.path_config_cache(path), "rb") as f:
+        cfg = pickle.load(f)["data"]
+    assert cfg.session_secret.startswith("VAULT:")
+
+
+# Modules that commands may need, but that parsing must never load
+DEPLOY_MODULES = ["constellation", "docker", "redis", "requests", "timeago",
+                  "yaml", "src.beebop_deploy"]
+# Generous, so that this only fails when something heavy creeps in
+MAX_IMPORT_MICROSECONDS = 100000
+
+
+def import_times(code):
+    res = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                         capture_output=True, text=True, check=True)
+    ret = {}
+    for line in res.stderr.splitlines():
+        fields = line[len("import time:"):].split("|")
+        if len(fields) == 3 and fields[1].strip().isdigit():
+            ret[fields[2].strip()] = int(fields[1])
+    return ret
+
+
+def test_cli_parse_imports_no_deploy_modules():
+    times = import_times(
+        "from src import beebop_cli\n"
+        "beebop_cli.parse(['status'])\n"
+        "try:\n"
+        "    beebop_cli.main(['--help'])\n"
+        "except SystemExit:\n"
+        "    pass\n")
+    loaded = [x for x in times if x.split(".")[0] in DEPLOY_MODULES or
+              x in DEPLOY_MODULES]
+    assert loaded == []
+    assert times["src.beebop_cli"] < MAX_IMPORT_MICROSECONDS
@@ -0,0 +1,576 @@
+import hashlib
+import json
+import subprocess
+import time
+
+import docker
+import pytest
+
+from conftest import FakeDocker
+from src import beebop_deploy
+from src import beebop_status
+
+
+def test_pull_images_pulls_each_reference_once(fake_docker):
+    cfg = beebop_deploy.BeebopConfig("config", "fake")
+    obj = beebop_deploy.beebop_constellation(cfg)
+    progress = beebop_deploy.pull_images(obj)
+    # api and worker share an image
+    assert fake_docker.calls["pull"] == 4
+    assert sorted(progress.image_ids) == sorted(
+        [str(cfg.redis_ref), str(cfg.api_ref), str(cfg.server_ref),
+         str(cfg.proxy_ref)])
+
+
+def test_pull_images_reports_reused_layers(fake_docker):
+    cfg = beebop_deploy.BeebopConfig("config", "fake")
+    shared = [("base", 1000)]
+    for ref in [cfg.api_ref, cfg.server_ref]:
+        fake_docker.api.layers[str(ref)] = shared + [(ref.name, 10)]
+    obj = beebop_deploy.beebop_constellation(cfg)
+    progress = beebop_deploy.pull_images(obj, max_workers=1)
+    assert progress.reused == {"base"}
+    assert progress.downloaded["base"] == 1000
+    assert progress.summary() == 1000
+    # layers already on the host before the pull are of unknown size
+    progress = beebop_deploy.pull_images(obj, max_workers=1)
+    assert progress.summary() == 0
+
+
+def test_pull_failure_prevents_start(fake_docker):
+    cfg = beebop_deploy.BeebopConfig("config", "fake")
+    obj = beebop_deploy.beebop_constellation(cfg)
+
+    def pull(repository, tag=None, **kwargs):
+        fake_docker.count("pull")
+        return iter([{"error": "manifest unknown"}])
+    fake_docker.api.pull = pull
+    with pytest.raises(Exception, match="manifest unknown"):
+        beebop_deploy.beebop_start(obj, {"pull_images": True})
+    assert fake_docker.calls["run"] == 0
+
+
+def test_api_configure_skips_completed_download(fake_docker):
+    cfg = beebop_deploy.BeebopConfig("config", "fake")
+    container = fake_docker.containers.run(str(cfg.api_ref), name="api")
+    manifest = {}
+    script = {"data": b"wget GPS_v9_ref.tar.gz"}
+
+    def exec_handler(container, cmd):
+        if cmd[:2] == ["cat", "./scripts/download_databases"]:
+            return (0, script["data"])
+        if cmd[0] == "cat":
+            if not manifest:
+                return (1, b"")
+            return (0, manifest["data"].encode("UTF-8"))
+        if "printf" in cmd[2]:
+            manifest["data"] = cmd[3]
+        return (0, b"")
+    fake_docker.containers.exec_handler = exec_handler
+
+    # left behind by an interrupted start
+    stale = fake_docker.containers.run(str(cfg.api_ref),
+                                       name="beebop-dbs-writer")
+    beebop_deploy.api_configure(container, cfg)
+    assert stale.removed
+    assert fake_docker.containers.runs[-1][1] == \
+        ["./scripts/download_databases", "--refs"]
+    # written through a container with the databases volume read-write
+    assert "beebop-dbs-writer" not in fake_docker.containers.store
+    assert not any(m.get("ReadOnly") for m in
+                   fake_docker.containers.runs[-1][2]["mounts"])
+    runs = len(fake_docker.containers.runs)
+    beebop_deploy.api_configure(container, cfg)
+    assert len(fake_docker.containers.runs) == runs
+    # a new api image does not change the databases
+    upgraded = fake_docker.containers.run("api:v2", name="api")
+    runs = len(fake_docker.containers.runs)
+    beebop_deploy.api_configure(upgraded, cfg)
+    assert len(fake_docker.containers.runs) == runs
+    # but asking for more of them does
+    cfg.download_ref_dbs_only = False
+    beebop_deploy.api_configure(container, cfg)
+    assert fake_docker.containers.runs[-1][1] == \
+        ["./scripts/download_databases"]
+    runs = len(fake_docker.containers.runs)
+    cfg.download_ref_dbs_only = True
+    beebop_deploy.api_configure(container, cfg)
+    assert len(fake_docker.containers.runs) == runs
+    # nor does an api image whose download script fetches new databases
+    script["data"] = b"wget GPS_v10_ref.tar.gz"
+    beebop_deploy.api_configure(upgraded, cfg)
+    assert fake_docker.containers.runs[-1][1] == \
+        ["./scripts/download_databases", "--refs"]
+    runs = len(fake_docker.containers.runs)
+    beebop_deploy.api_configure(upgraded, cfg)
+    assert len(fake_docker.containers.runs) == runs
+
+
+def test_api_configure_seeds_databases_without_a_manifest(fake_docker):
+    cfg = beebop_deploy.BeebopConfig("config", "fake")
+    container = fake_docker.containers.run(str(cfg.api_ref), name="api")
+    written = {}
+
+    # A deployment from before the manifest: databases in the storage
+    # volume, and an empty databases volume
+    def exec_handler(container, cmd):
+        if cmd == ["cat", "./scripts/download_databases"]:
+            return (0, b"wget GPS_v9_ref.tar.gz")
+        if cmd[0] == "cat":
+            return (0, written[cmd[1]]) if cmd[1] in written else (1, b"")
+        if "cp -a" in " ".join(cmd):
+            return 0, b"copied\n"
+        if "printf" in " ".join(cmd):
+            written[cmd[4]] = cmd[3].encode()
+        return 0, b""
+    fake_docker.containers.exec_handler = exec_handler
+    beebop_deploy.api_configure(container, cfg)
+    assert "./scripts/download_databases" not in [
+        (x[1] or [None])[0] for x in fake_docker.containers.runs]
+    script = hashlib.sha256(b"wget GPS_v9_ref.tar.gz").hexdigest()
+    assert json.loads(written["./storage/dbs/.manifest.json"]) == \
+        {"download_databases": {"refs_only": True, "script": script}}
+
+
+def test_start_follows_dependency_graph(fake_docker):
+    cfg = beebop_deploy.BeebopConfig("config", "fake")
+    obj = beebop_deploy.beebop_constellation(cfg)
+    started = []
+    for x in obj.containers.collection:
+        x.configure = None
+    fake_docker.containers.exec_handler = lambda c, cmd: (0, b"PONG")
+    run = fake_docker.containers.run
+
+    def record(image, command=None, name=None, **kwargs):
+        started.append(name)
+        return run(image, command, name=name, **kwargs)
+    fake_docker.containers.run = record
+
+    beebop_deploy.beebop_start(obj, {})
+    assert started[0] == "beebop-redis"
+    assert started.index("beebop-api") < started.index("beebop-server")
+    assert started.index("beebop-server") < started.index("beebop-proxy")
+    assert len([x for x in started if x.startswith("beebop-worker-")]) == 2
+    assert "beebop_nw" in fake_docker.networks.store
+    assert "beebop_storage" in fake_docker.volumes.store
+    # containers go straight onto the network with their alias
+    kwargs = fake_docker.containers.runs[0][2]
+    assert kwargs["network"] == "beebop_nw"
+    assert kwargs["networking_config"] == {"beebop_nw": {"aliases": ["redis"]}}
+
+    with pytest.raises(Exception, match="Some containers exist"):
+        beebop_deploy.beebop_start(obj, {})
+
+
+def test_workers_wait_for_api_configure(fake_docker):
+    cfg = beebop_deploy.BeebopConfig("config", "fake")
+    obj = beebop_deploy.beebop_constellation(cfg)
+    events = []
+    for x in obj.containers.collection:
+        x.configure = None
+    fake_docker.containers.exec_handler = lambda c, cmd: (0, b"PONG")
+    run = fake_docker.containers.run
+
+    def record(image, command=None, name=None, **kwargs):
+        events.append(name)
+        return run(image, command, name=name, **kwargs)
+    fake_docker.containers.run = record
+
+    def configure(container, cfg):
+        # the server does not read the databases, so need not wait
+        while "beebop-server" not in events:
+            time.sleep(0.01)
+        events.append("api configured")
+    obj.containers.find("api").configure = configure
+    beebop_deploy.beebop_start(obj, {})
+    workers = [i for i, x in enumerate(events)
+               if x.startswith("beebop-worker-")]
+    assert len(workers) == 2
+    assert min(workers) > events.index("api configured")
+
+
+def test_constellation_lifecycle_uses_beebop_start(fake_docker):
+    cfg = beebop_deploy.BeebopConfig("config", "fake")
+    obj = beebop_deploy.beebop_constellation(cfg)
+    for x in obj.containers.collection:
+        x.configure = None
+    fake_docker.containers.exec_handler = lambda c, cmd: (0, b"PONG")
+    with pytest.raises(Exception, match="subset"):
+        obj.start(subset=["api"])
+    obj.start()
+    workers = [x for x in fake_docker.containers.store
+               if x.startswith("beebop-worker-")]
+    assert len(workers) == 2
+    # never started on 'none' and connected afterwards
+    assert fake_docker.calls["connect"] == 0
+    obj.destroy()
+    assert not fake_docker.containers.store
+    assert "beebop_nw" not in fake_docker.networks.store
+    assert not fake_docker.volumes.store
+
+
+def test_start_stops_at_failed_dependency(fake_docker):
+    cfg = beebop_deploy.BeebopConfig("config", "fake")
+    obj = beebop_deploy.beebop_constellation(cfg)
+    fake_docker.containers.exec_handler = lambda c, cmd: (0, b"PONG")
+
+    def fail(container, cfg):
+        raise Exception("no databases")
+    obj.containers.find("api").configure = fail
+    obj.containers.find("proxy").configure = None
+    with pytest.raises(Exception, match="api: no databases"):
+        beebop_deploy.beebop_start(obj, {})
+
+
+def test_wait_ready_backs_off(monkeypatch):
+    delays = []
+    monkeypatch.setattr(beebop_deploy.time, "sleep", delays.append)
+    attempts = iter([False] * 6 + [True])
+    beebop_deploy.wait_ready("x", lambda c: next(attempts), None,
+                             max_delay=1)
+    assert delays == [0.05, 0.1, 0.2, 0.4, 0.8, 1]
+
+
+def test_redis_conf_rendered_and_injected_before_start(fake_docker):
+    options = {"redis": {"config": {"maxmemory": "2gb",
+                                    "maxmemory_policy": "volatile-lru",
+                                    "appendonly": True,
+                                    "save": []}}}
+    cfg = beebop_deploy.BeebopConfig("config", "fake", options=options)
+    assert beebop_deploy.redis_conf(cfg.redis_config).splitlines()[1:] == [
+        "maxmemory 2gb",
+        "maxmemory-policy volatile-lru",
+        "appendonly yes",
+        "appendfsync everysec",
+        'save ""']
+    obj = beebop_deploy.beebop_constellation(cfg)
+    redis = obj.containers.find("redis")
+    container = beebop_deploy.start_container(redis, "redis", obj)
+    assert container.status == "running"
+    assert container.attrs["Config"]["Cmd"] == ["redis-server",
+                                                "/etc/redis.conf"]
+    assert container.files["/etc/redis.conf"].decode() == \
+        beebop_deploy.redis_conf(cfg.redis_config)
+    # redis-server runs as the redis user, not root
+    assert container.modes["/etc/redis.conf"] == 0o644
+
+
+def test_redis_settings_checked_against_image_version():
+    options = {"redis": {"config": {"io_threads": 4}}}
+    with pytest.raises(ValueError, match="io_threads needs redis 6"):
+        beebop_deploy.BeebopConfig("config", "fake", options=options)
+    for tag in ["6.2", "7-alpine", "latest"]:
+        options["redis"]["image"] = {"tag": tag}
+        cfg = beebop_deploy.BeebopConfig("config", "fake", options=options)
+        assert "io-threads 4" in beebop_deploy.redis_conf(cfg.redis_config)
+    assert beebop_deploy.redis_version("5.0.14") == 5
+    assert beebop_deploy.redis_version("latest") is None
+
+
+def test_redis_config_is_optional_and_validated():
+    cfg = beebop_deploy.BeebopConfig("config", "fake")
+    assert cfg.redis_config is None
+    assert beebop_deploy.beebop_constellation(cfg).containers.find(
+        "redis").args is None
+    options = {"redis": {"config": {"maxmemory_policy": "sometimes"}}}
+    with pytest.raises(ValueError, match="maxmemory_policy"):
+        beebop_deploy.BeebopConfig("config", "fake", options=options)
+
+
+def test_resources_and_worker_pools_passed_to_containers(fake_docker):
+    options = {"api": {"resources": {"cpus": 1.5, "memory": "4g"}},
+               "worker": {"pools": {
+                   "short": {"count": 2, "queues": ["visualise"]},
+                   "long": {"count": 1, "queues": ["assign", "network"],
+                            "resources": {"cpuset": "0-3",
+                                          "cpu_shares": 512}}}}}
+    cfg = beebop_deploy.BeebopConfig("config", "fake", options=options)
+    assert cfg.worker_count == 3
+    obj = beebop_deploy.beebop_constellation(cfg)
+    for x in obj.containers.collection:
+        x.configure = None
+    fake_docker.containers.exec_handler = lambda c, cmd: (0, b"PONG")
+    beebop_deploy.beebop_start(obj, {})
+
+    store = fake_docker.containers.store
+    host_config = store["beebop-api"].attrs["HostConfig"]
+    assert host_config["NanoCpus"] == 1500000000
+    assert host_config["Memory"] == 4 * 1024 ** 3
+    assert store["beebop-redis"].attrs["HostConfig"]["NanoCpus"] == 0
+    short = [x for x in store.values()
+             if x.name.startswith("beebop-worker-short-")]
+    long = [x for x in store.values()
+            if x.name.startswith("beebop-worker-long-")]
+    assert len(short) == 2 and len(long) == 1
+    assert short[0].attrs["Config"]["Cmd"] == ["visualise"]
+    assert long[0].attrs["Config"]["Cmd"] == ["assign", "network"]
+    assert long[0].attrs["HostConfig"]["CpusetCpus"] == "0-3"
+    assert long[0].attrs["HostConfig"]["CpuShares"] == 512
+    assert short[0].attrs["HostConfig"]["CpuShares"] == 0
+
+
+def test_resources_and_worker_pools_are_validated():
+    options = {"server": {"resources": {"gpus": 1}}}
+    with pytest.raises(ValueError, match="Unknown resource 'gpus'"):
+        beebop_deploy.BeebopConfig("config", "fake", options=options)
+    options = {"worker": {"pools": {"short-jobs": {
+        "count": 1, "queues": ["visualise"]}}}}
+    with pytest.raises(ValueError, match="Invalid worker pool name"):
+        beebop_deploy.BeebopConfig("config", "fake", options=options)
+    options = {"worker": {"pools": {"short": {"count": 1}}}}
+    with pytest.raises(ValueError, match="queue names"):
+        beebop_deploy.BeebopConfig("config", "fake", options=options)
+
+
+def test_proxy_performance_include_rendered_and_applied(fake_docker):
+    options = {"proxy": {"performance": {"brotli": True,
+                                         "worker_connections": 4096}}}
+    cfg = beebop_deploy.BeebopConfig("config", "fake", options=options)
+    conf = beebop_deploy.proxy_conf(cfg.proxy_performance, "server:4000")
+    assert "gzip_comp_level 5;" in conf
+    assert "brotli on;" in conf
+    assert "application/graphml+xml" in conf
+    assert "    server server:4000;\n    keepalive 32;\n" in conf
+    assert "ssl_session_cache shared:beebop_ssl:10m;" in conf
+    # headers are set per location, as nginx does not inherit them into
+    # locations that set their own
+    assert "add_header" not in conf and "proxy_set_header" not in conf
+
+    commands = []
+    fake_docker.containers.exec_handler = \
+        lambda c, cmd: commands.append(cmd) or (0, b"")
+    proxy = fake_docker.containers.run("proxy", name="beebop-proxy")
+    beebop_deploy.proxy_configure(proxy, cfg)
+    assert proxy.files[beebop_deploy.PROXY_CONF].decode() == \
+        beebop_deploy.proxy_conf(cfg.proxy_performance,
+                                 "server:{}".format(cfg.server_port))
+    assert proxy.files[beebop_deploy.PROXY_LOCATION_CONF].decode() == \
+        beebop_deploy.proxy_location_conf(cfg.proxy_performance)
+    edit = commands[-3][2]
+    assert beebop_deploy.proxy_location_edit() in edit
+    assert "s#http://server:{}#http://beebop_server#".format(
+        cfg.server_port) in edit
+    assert "worker_connections 4096;" in edit
+    assert commands[-2:] == [["nginx", "-t"], ["nginx", "-s", "reload"]]
+
+
+def test_proxy_location_settings_included_in_each_location(tmp_path):
+    settings = beebop_deploy.proxy_performance(
+        {"proxy": {"performance": {}}})
+    location = beebop_deploy.proxy_location_conf(settings)
+    assert "add_header Cache-Control $beebop_cache_control;" in location
+    assert 'proxy_set_header Connection "";' in location
+    assert "proxy_http_version 1.1;" in location
+    conf = tmp_path / "nginx.conf"
+    conf.write_text("\n".join([
+        "http {",
+        "    server {",
+        "        location / {",
+        "            proxy_set_header Host $host;",
+        "            proxy_pass http://server:4000;",
+        "        }",
+        "        location /static {",
+        "            add_header X-Frame-Options DENY;",
+        "        }",
+        "    }",
+        "}"]))
+    include = "include {};".format(beebop_deploy.PROXY_LOCATION_CONF)
+    for i in range(2):
+        subprocess.run(["sed", "-i", "-E", "-e",
+                        beebop_deploy.proxy_location_edit(), str(conf)],
+                       check=True)
+    lines = conf.read_text().splitlines()
+    assert lines[2] == "        location / { " + include
+    assert lines[6] == "        location /static { " + include
+    assert conf.read_text().count(include) == 2
+
+
+def test_proxy_performance_is_optional(fake_docker):
+    cfg = beebop_deploy.BeebopConfig("config", "fake")
+    assert cfg.proxy_performance is None
+    proxy = fake_docker.containers.run("proxy", name="beebop-proxy")
+    beebop_deploy.proxy_configure(proxy, cfg)
+    assert beebop_deploy.PROXY_CONF not in proxy.files
+    options = {"proxy": {"performance": {"gzip": True, "keepalive": 0}}}
+    cfg = beebop_deploy.BeebopConfig("config", "fake", options=options)
+    assert "upstream" not in beebop_deploy.proxy_conf(
+        cfg.proxy_performance, "server:4000")
+
+
+def test_proxy_certificate_reused_until_host_changes_or_expiry(fake_docker):
+    cfg = beebop_deploy.BeebopConfig("config", "fake")
+    assert "beebop_config_cache" in [
+        x.name for x in beebop_deploy.beebop_constellation(cfg).volumes
+        .collection]
+    saved = set()
+    commands = []
+    expired = []
+
+    def exec_handler(container, cmd):
+        commands.append(cmd)
+        script = cmd[-1]
+        if script.startswith("test -d "):
+            if script.split()[2] not in saved:
+                return 1, b""
+            assert "openssl x509 -checkend" in script
+            return (1 if expired else 0), b""
+        if script.startswith("rm -rf "):
+            saved.add(script.split(" && ")[-1].split()[-1])
+        return 0, b""
+    fake_docker.containers.exec_handler = exec_handler
+
+    def builds():
+        return len([x for x in commands
+                    if x[0] == "/usr/local/bin/build-self-signed-certificate"])
+
+    proxy = fake_docker.containers.run("proxy", name="beebop-proxy")
+    beebop_deploy.proxy_configure(proxy, cfg)
+    beebop_deploy.proxy_configure(proxy, cfg)
+    assert builds() == 1
+    assert "cp /beebop/cache/proxy-certificate/" in commands[-1][-1]
+    cfg.proxy_host = "beebop.example.com"
+    beebop_deploy.proxy_configure(proxy, cfg)
+    assert builds() == 2
+    # and again once it is close to expiry
+    expired.append(True)
+    beebop_deploy.proxy_configure(proxy, cfg)
+    assert builds() == 3
+
+
+def test_workers_started_and_stopped_across_hosts(fake_docker, monkeypatch):
+    remotes = {"ssh://node1": FakeDocker(), "tcp://node2:2376": FakeDocker()}
+    monkeypatch.setattr(docker, "DockerClient",
+                        lambda base_url, **kwargs: remotes[base_url])
+    hosts = [{"name": "node1", "url": "ssh://node1", "count": 3,
+              "redis_host": "beebop.example.com",
+              "storage_path": "/mnt/beebop", "dbs_path": "/mnt/dbs"},
+             {"name": "node2", "url": "tcp://node2:2376", "count": 1,
+              "redis_host": "10.0.0.1", "storage_path": "/mnt/beebop",
+              "dbs_path": "/mnt/dbs"}]
+    cfg = beebop_deploy.BeebopConfig(
+        "config", "fake",
+        options={"worker": {"hosts": hosts, "redis_bind": "10.0.0.1"}})
+    obj = beebop_deploy.beebop_constellation(cfg)
+    for x in obj.containers.collection:
+        x.configure = None
+    fake_docker.containers.exec_handler = lambda c, cmd: (0, b"PONG")
+    beebop_deploy.beebop_start(obj, {})
+
+    assert fake_docker.containers.store["beebop-redis"].attrs["HostConfig"][
+        "PortBindings"] == {"6379/tcp": [{"HostIp": "10.0.0.1",
+                                          "HostPort": "6379"}]}
+    node1 = remotes["ssh://node1"].containers.store
+    assert len(node1) == 3
+    assert all(x.startswith("beebop-worker-node1-") for x in node1)
+    worker = list(node1.values())[0]
+    assert "REDIS_HOST=beebop.example.com" in worker.attrs["Config"]["Env"]
+    assert worker.attrs["Mounts"][0]["Destination"] == "/beebop/storage"
+    assert worker.kwargs["mounts"][0]["Source"] == "/mnt/beebop"
+    assert worker.kwargs["mounts"][1]["ReadOnly"]
+    assert len(remotes["tcp://node2:2376"].containers.store) == 1
+    # the image was missing on the hosts
+    assert remotes["ssh://node1"].calls["pull"] == 1
+
+    report = beebop_status.host_status(obj, 1)
+    assert [(x["name"], x["expected"], len(x["workers"])) for x in report] \
+        == [("node1", 3, 3), ("node2", 1, 1)]
+
+    stopped = list(node1.values())
+    beebop_deploy.beebop_stop(obj, {"kill": False, "remove_network": False,
+                                    "remove_volumes": False})
+    assert not node1
+    # busy workers are given time to finish their job
+    assert all(x.stopped_with == {"timeout": 600} for x in stopped)
+    assert not remotes["tcp://node2:2376"].containers.store
+    assert not fake_docker.containers.store
+
+
+def test_worker_hosts_are_validated():
+    host = {"name": "node1", "url": "ssh://node1", "count": 1,
+            "redis_host": "beebop", "storage_path": "/mnt/beebop",
+            "dbs_path": "/mnt/dbs"}
+    options = {"worker": {"hosts": [host], "redis_bind": "10.0.0.1",
+                          "pools": {
+                              "short": {"count": 1, "queues": ["visualise"]},
+                              "long": {"count": 1, "queues": ["assign"]}}}}
+    with pytest.raises(ValueError, match="needs a pool"):
+        beebop_deploy.BeebopConfig("config", "fake", options=options)
+    host["pool"] = "long"
+    cfg = beebop_deploy.BeebopConfig("config", "fake", options=options)
+    assert cfg.worker_hosts[0]["service"] == "worker-long"
+    # redis is never published on every interface or a public address
+    for address in ["0.0.0.0", "::", "8.8.8.8", "redis.example.com"]:
+        options["worker"]["redis_bind"] = address
+        with pytest.raises(ValueError, match="redis_bind"):
+            beebop_deploy.BeebopConfig("config", "fake", options=options)
+    del options["worker"]["redis_bind"]
+    with pytest.raises(Exception, match="redis_bind"):
+        beebop_deploy.BeebopConfig("config", "fake", options=options)
+    options["worker"]["redis_bind"] = "127.0.0.1"
+    cfg = beebop_deploy.BeebopConfig("config", "fake", options=options)
+    assert beebop_deploy.beebop_constellation(cfg).containers.find(
+        "redis").ports == {"6379/tcp": ("127.0.0.1", 6379)}
+
+
+def test_databases_mounted_read_only_and_warmed(fake_docker):
+    databases = [{"name": "GPS_v9_ref", "url": "https://example.com/a",
+                  "ref": True},
+                 {"name": "GPS_v9_full", "url": "https://example.com/b"}]
+    cfg = beebop_deploy.BeebopConfig(
+        "config", "fake",
+        options={"api": {"databases": databases, "warmup": True}})
+    assert cfg.api_dbs_path == "/beebop/storage/dbs"
+    obj = beebop_deploy.beebop_constellation(cfg)
+    for name in ["api", "worker"]:
+        x = obj.containers.find(name)
+        mounts = [m.to_mount(obj.volumes) for m in
+                  (x.base if name == "worker" else x).mounts]
+        assert {"Target": "/beebop/storage/dbs", "Source": "beebop_dbs",
+                "Type": "volume", "ReadOnly": True}.items() <= \
+            mounts[1].items()
+
+    commands = []
+    written = {}
+
+    # The storage volume has both databases but, like deployments from
+    # before the manifest, no manifest
+    def exec_handler(container, cmd):
+        commands.append((container.name, cmd))
+        if cmd[0] == "cat":
+            return (0, written[cmd[1]]) if cmd[1] in written else (1, b"")
+        if cmd[0] == "ls":
+            return 0, b"GPS_v9_ref\nGPS_v9_full\n.download\n"
+        if "printf" in " ".join(cmd):
+            written[cmd[4]] = cmd[3].encode()
+        return 0, b"copied\n" if "cp -a" in " ".join(cmd) else b""
+    fake_docker.containers.exec_handler = exec_handler
+    api = fake_docker.containers.run(str(cfg.api_ref), name="beebop-api")
+    beebop_deploy.api_configure(api, cfg)
+    # so that fetch_databases keeps the copies rather than fetching them
+    assert json.loads(written["./storage/dbs/.manifest.json"]) == {
+        "databases": {
+            "GPS_v9_ref": {"url": "https://example.com/a", "size": None,
+                           "sha256": None},
+            "GPS_v9_full": {"url": "https://example.com/b", "size": None,
+                            "sha256": None}}}
+
+    writer = [x for x in fake_docker.containers.runs
+              if x[1] == ["infinity"]][0]
+    assert writer[2]["entrypoint"] == "sleep"
+    assert "beebop-dbs-writer" not in fake_docker.containers.store
+    # existing databases are copied from the storage volume, and then
+    # brought up to date, in the writer
+    assert [x[1][3:] for x in commands if x[0] == "beebop-dbs-writer"][0] \
+        == ["/seed/dbs", "/beebop/storage/dbs"]
+    assert ("beebop-dbs-writer",
+            ["python3", "/fetch_databases", "./storage/dbs",
+             "/fetch_databases.json"]) in commands
+    assert commands[-1] == ("beebop-api", [
+        "python3", "/warm_databases", "/beebop/storage/dbs", "GPS_v9_ref"])
+
+
+def test_parse_age():
+    assert beebop_deploy.parse_age("90d") == 90 * 24 * 60 * 60
+    assert beebop_deploy.parse_age("12h") == 12 * 60 * 60
+    with pytest.raises(Exception, match="Invalid age"):
+        beebop_deploy.parse_age("ninety days")
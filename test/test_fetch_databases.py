@@ -0,0 +1,96 @@
+import importlib.machinery
+import importlib.util
+import io
+import json
+import os
+import tarfile
+
+import pytest
+
+loader = importlib.machinery.SourceFileLoader(
+    "fetch_databases", "scripts/fetch_databases")
+fetch_databases = importlib.util.module_from_spec(
+    importlib.util.spec_from_loader(loader.name, loader))
+loader.exec_module(fetch_databases)
+
+
+def fake_fetch(contents):
+    fetched = []
+
+    def fetch(url, dest):
+        fetched.append(url)
+        with open(dest, "wb") as f:
+            f.write(contents[url])
+    return fetch, fetched
+
+
+def database(name, contents):
+    return {"name": name, "url": "https://example.com/" + name,
+            "size": len(contents), "sha256": None}
+
+
+def test_sync_fetches_only_missing_databases(tmp_path):
+    dbs = str(tmp_path)
+    a = database("a", b"aaa")
+    b = database("b", b"bbbb")
+    fetch, fetched = fake_fetch({a["url"]: b"aaa", b["url"]: b"bbbb"})
+    assert fetch_databases.sync_databases([a], dbs, fetch) == ["a"]
+    assert fetch_databases.sync_databases([a, b], dbs, fetch) == ["b"]
+    assert fetched == [a["url"], b["url"]]
+    with open(os.path.join(dbs, ".manifest.json")) as f:
+        manifest = json.load(f)
+    assert manifest["databases"]["b"]["size"] == 4
+    assert fetch_databases.sync_databases([a, b], dbs, fetch) == []
+
+
+def test_sync_refetches_stale_databases(tmp_path):
+    dbs = str(tmp_path)
+    a = database("a", b"aaa")
+    fetch, fetched = fake_fetch({a["url"]: b"aaa",
+                                 a["url"] + "2": b"aaaa"})
+    fetch_databases.sync_databases([a], dbs, fetch)
+    a2 = database("a", b"aaaa")
+    a2["url"] = a["url"] + "2"
+    assert fetch_databases.sync_databases([a2], dbs, fetch) == ["a"]
+    os.remove(os.path.join(dbs, "a"))
+    assert fetch_databases.sync_databases([a2], dbs, fetch) == ["a"]
+
+
+def test_sync_rejects_bad_checksum(tmp_path):
+    dbs = str(tmp_path)
+    a = database("a", b"aaa")
+    a["sha256"] = "0" * 64
+    fetch, fetched = fake_fetch({a["url"]: b"aaa"})
+    with pytest.raises(Exception, match="checksum mismatch"):
+        fetch_databases.sync_databases([a], dbs, fetch)
+    assert fetch_databases.read_manifest(dbs) == {}
+
+
+@pytest.mark.parametrize("filters", [True, False])
+def test_archives_cannot_write_outside_dbs(tmp_path, monkeypatch, filters):
+    if not filters:
+        monkeypatch.delattr(tarfile, "data_filter", raising=False)
+    dbs = tmp_path / "dbs"
+    dbs.mkdir()
+    archive = str(tmp_path / "a.tar")
+    with tarfile.open(archive, "w") as tar:
+        data = b"evil"
+        info = tarfile.TarInfo("../evil")
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    with tarfile.open(archive) as tar:
+        with pytest.raises(Exception):
+            fetch_databases.safe_extract(tar, str(dbs))
+    assert not (tmp_path / "evil").exists()
+
+    with tarfile.open(archive, "w") as tar:
+        info = tarfile.TarInfo("a/link")
+        info.type = tarfile.SYMTYPE
+        info.linkname = "../../../etc/passwd"
+        tar.addfile(info)
+        info = tarfile.TarInfo("a/db")
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    with tarfile.open(archive) as tar:
+        with pytest.raises(Exception):
+            fetch_databases.safe_extract(tar, str(dbs))
@@ -11,7 +11,7 @@ def test_start_beebop():
     cfg = beebop_deploy.BeebopConfig("config", "fake")
     obj = beebop_deploy.beebop_constellation(cfg)
     obj.status()
-    obj.start()
+    beebop_deploy.beebop_start(obj, {})
 
     assert docker_util.network_exists("beebop_nw")
     assert docker_util.volume_exists("beebop_storage")
@@ -35,7 +35,8 @@ def test_start_beebop():
     assert res.status_code == 200
     assert json.loads(res.content)["message"] == "Welcome to beebop!"
 
-    obj.destroy()
+    beebop_deploy.beebop_stop(obj, {"kill": True, "remove_network": True,
+                                    "remove_volumes": True})
 
     assert not docker_util.network_exists("beebop_nw")
     assert not docker_util.volume_exists("beebop_storage")
@@ -0,0 +1,76 @@
+import json
+import logging
+import threading
+
+import pytest
+
+from src import beebop_journal
+
+
+def make_migration(path, calls, fail=None):
+    migration = beebop_journal.Migration(
+        "test", str(path / "journal.json"), logging.getLogger("test"))
+
+    def record(name):
+        def f(state, dry_run):
+            calls.append((name, dry_run))
+            if name == fail:
+                raise Exception("failed " + name)
+        f.__name__ = name
+        return f
+
+    migration.step(journal=False)(record("plan"))
+    migration.step(after=["plan"])(record("backup"))
+    migration.step()(record("redis_keys"))
+    migration.step(after=["backup"])(record("files"))
+    return migration
+
+
+def test_migration_resumes_after_failure(tmp_path):
+    calls = []
+    with pytest.raises(Exception, match="failed files"):
+        make_migration(tmp_path, calls, fail="files").run()
+    assert {x[0] for x in calls} == {"plan", "backup", "redis_keys", "files"}
+    with open(tmp_path / "journal.json") as f:
+        assert set(json.load(f)["steps"]) == {"backup", "redis_keys"}
+
+    calls = []
+    journal = make_migration(tmp_path, calls).run()
+    assert sorted(x[0] for x in calls) == ["files", "plan"]
+    assert journal["completed"]
+
+    calls = []
+    make_migration(tmp_path, calls).run()
+    assert calls == []
+
+
+def test_dry_run_records_nothing(tmp_path):
+    calls = []
+    make_migration(tmp_path, calls).run(dry_run=True)
+    assert all(x[1] for x in calls)
+    assert not (tmp_path / "journal.json").exists()
+
+
+def test_independent_steps_run_concurrently(tmp_path):
+    migration = beebop_journal.Migration(
+        "test", str(tmp_path / "journal.json"), logging.getLogger("test"))
+    barrier = threading.Barrier(2, timeout=5)
+
+    @migration.step()
+    def redis_keys(state, dry_run):
+        barrier.wait()
+
+    @migration.step()
+    def files(state, dry_run):
+        barrier.wait()
+
+    migration.run()
+
+
+def test_steps_must_depend_on_known_steps(tmp_path):
+    migration = beebop_journal.Migration(
+        "test", str(tmp_path / "journal.json"), logging.getLogger("test"))
+    with pytest.raises(Exception, match="unknown step 'plan'"):
+        @migration.step(after=["plan"])
+        def files(state, dry_run):
+            pass
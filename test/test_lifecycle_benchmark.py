@@ -0,0 +1,111 @@
+import collections
+import json
+import os
+import time
+
+import docker
+import pytest
+
+from conftest import FakeDocker
+from src import beebop_apply
+from src import beebop_deploy
+
+# Runs the deploy lifecycle against the fake docker client at each
+# worker count, recording wall time and docker API calls per operation,
+# so regressions in deploy time show up without a daemon or network.
+# Run with -s to see the table; set BEEBOP_BENCHMARK_OUTPUT to a file
+# to append the results to it as a json line.
+WORKER_COUNTS = [1, 2, 5, 10, 20, 50]
+OPERATIONS = ["constellation", "start", "configure", "apply", "upgrade",
+              "stop"]
+# The most docker API calls each extra worker may add to an operation
+CALLS_PER_WORKER = {"constellation": 0, "start": 2, "configure": 0,
+                    "apply": 0, "upgrade": 4, "stop": 2}
+# Generous, as there is no real docker behind these; they catch sleeps
+# and serial waits rather than small slowdowns
+SECONDS_BUDGET = {"constellation": 1, "start": 5, "configure": 2,
+                  "apply": 2, "upgrade": 10, "stop": 5}
+
+
+def exec_handler(container, cmd):
+    if cmd == ["redis-cli", "ping"]:
+        return 0, b"PONG"
+    # No databases manifest or cached certificate yet
+    if cmd[0] == "cat" or cmd[-1].startswith("test -d "):
+        return 1, b""
+    return 0, b""
+
+
+def lifecycle(n):
+    client = FakeDocker()
+    client.containers.exec_handler = exec_handler
+    results = {}
+
+    def run(name, f):
+        before = collections.Counter(client.calls)
+        t0 = time.perf_counter()
+        ret = f()
+        calls = client.calls - before
+        results[name] = {"seconds": time.perf_counter() - t0,
+                         "calls": sum(calls.values()),
+                         "by_call": dict(calls)}
+        return ret
+
+    def configure():
+        for x in obj.containers.collection:
+            if getattr(x, "configure", None):
+                x.configure(x.get(obj.prefix), obj.data)
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(docker.client, "from_env", lambda **kwargs: client)
+        cfg = beebop_deploy.BeebopConfig(
+            "config", "fake", options={"worker": {"count": n}})
+        obj = run("constellation",
+                  lambda: beebop_deploy.beebop_constellation(cfg))
+        run("start", lambda: beebop_deploy.beebop_start(
+            obj, {"pull_images": True}))
+        run("configure", configure)
+        run("apply", lambda: beebop_apply.plan_changes(obj))
+        run("upgrade", lambda: beebop_deploy.beebop_upgrade(obj))
+        run("stop", obj.stop)
+    return results
+
+
+@pytest.fixture(scope="module")
+def benchmark():
+    results = {n: lifecycle(n) for n in WORKER_COUNTS}
+    print("\n{:<14} {:>7} {:>10} {:>7}".format(
+        "operation", "workers", "ms", "calls"))
+    for name in OPERATIONS:
+        for n in WORKER_COUNTS:
+            x = results[n][name]
+            print("{:<14} {:>7} {:>10.1f} {:>7}".format(
+                name, n, x["seconds"] * 1000, x["calls"]))
+    path = os.environ.get("BEEBOP_BENCHMARK_OUTPUT")
+    if path:
+        with open(path, "a") as f:
+            f.write(json.dumps({"time": time.time(),
+                                "results": results}) + "\n")
+    return results
+
+
+def test_lifecycle_api_calls_grow_linearly_with_workers(benchmark):
+    for name in OPERATIONS:
+        base = benchmark[WORKER_COUNTS[0]][name]["calls"]
+        for n in WORKER_COUNTS[1:]:
+            extra = n - WORKER_COUNTS[0]
+            assert benchmark[n][name]["calls"] <= \
+                base + CALLS_PER_WORKER[name] * extra, (name, n)
+
+
+def test_lifecycle_within_time_budget(benchmark):
+    for n in WORKER_COUNTS:
+        for name in OPERATIONS:
+            assert benchmark[n][name]["seconds"] < SECONDS_BUDGET[name], \
+                (name, n)
+
+
+def test_lifecycle_starts_and_removes_every_container(benchmark):
+    for n in WORKER_COUNTS:
+        assert benchmark[n]["start"]["by_call"]["run"] >= n + 4
+        assert benchmark[n]["stop"]["by_call"]["remove"] == n + 4
@@ -0,0 +1,104 @@
+import io
+import threading
+
+import pytest
+
+from src import beebop_deploy
+from src import beebop_logs
+
+
+def ts(i):
+    return "2026-10-18T12:00:{:02d}.000000000Z".format(i).encode()
+
+
+def entry(i, text):
+    return ts(i) + b" " + text + b"\n"
+
+
+def constellation(fake_docker):
+    cfg = beebop_deploy.BeebopConfig(
+        "config", "fake", options={"worker": {"count": 2}})
+    obj = beebop_deploy.beebop_constellation(cfg)
+    for name in ["api", "server", "proxy", "redis", "worker-aaaa",
+                 "worker-bbbb"]:
+        fake_docker.containers.run("image", name="beebop-" + name)
+    return obj
+
+
+def test_lines_splits_chunks_on_newlines():
+    chunks = [b"one\ntw", b"o\n", b"", b"thr", b"ee"]
+    assert list(beebop_logs.lines(chunks)) == [b"one", b"two", b"three"]
+
+
+def test_logs_are_merged_by_timestamp(fake_docker):
+    obj = constellation(fake_docker)
+    store = fake_docker.containers.store
+    store["beebop-api"].log = [entry(1, b"api starting"),
+                               entry(4, b"job 1 queued")]
+    store["beebop-worker-aaaa"].log = [entry(2, b"worker up") + ts(5),
+                                       b" job 1 done\n"]
+    store["beebop-worker-bbbb"].log = [entry(3, b"worker up")]
+    store["beebop-proxy"].status = "exited"
+    out = io.StringIO()
+    args = {"follow": False, "since": None, "grep": None, "services": []}
+    beebop_logs.beebop_logs(obj, args, out)
+    assert out.getvalue().splitlines() == [
+        "api         | {} api starting".format(ts(1).decode()),
+        "worker-aaaa | {} worker up".format(ts(2).decode()),
+        "worker-bbbb | {} worker up".format(ts(3).decode()),
+        "api         | {} job 1 queued".format(ts(4).decode()),
+        "worker-aaaa | {} job 1 done".format(ts(5).decode())]
+    assert "logs_with" not in vars(store["beebop-proxy"])
+    assert store["beebop-api"].logs_with == {
+        "stream": True, "follow": False, "timestamps": True, "since": None}
+
+
+def test_logs_filter_services_and_lines(fake_docker):
+    obj = constellation(fake_docker)
+    store = fake_docker.containers.store
+    for name, x in store.items():
+        x.log = [entry(1, b"job 1 from " + name.encode()),
+                 entry(2, b"ping")]
+    out = io.StringIO()
+    args = {"follow": False, "since": "30m", "grep": "^job",
+            "services": ["worker", "server"]}
+    beebop_logs.beebop_logs(obj, args, out)
+    assert sorted(x.split(" ")[-1] for x in out.getvalue().splitlines()) == \
+        ["beebop-server", "beebop-worker-aaaa", "beebop-worker-bbbb"]
+    assert "logs_with" not in vars(store["beebop-api"])
+    assert store["beebop-server"].logs_with["since"] > 0
+    with pytest.raises(Exception, match="Unknown service 'db'"):
+        beebop_deploy.service_containers(obj, ["db"])
+
+
+def test_follow_reorders_within_window_and_bounds_the_queue():
+    t = [0]
+    streams = [iter([(ts(2), "a", "second"), (ts(4), "a", "fourth")]),
+               iter([(ts(1), "b", "first"), (ts(3), "b", "third")])]
+    got = list(beebop_logs.follow_logs(streams, window=10,
+                                       clock=lambda: t[0]))
+    # both streams end well inside the window, so the order is exact
+    assert [x[2] for x in got] == ["first", "second", "third", "fourth"]
+
+    # a reader blocks once the queue is full, until lines are taken
+    read = []
+
+    def stream():
+        for i in range(100):
+            read.append(i)
+            yield (ts(0), "c", str(i))
+
+    release = threading.Event()
+
+    def slow():
+        release.wait()
+        return
+        yield
+
+    merged = beebop_logs.follow_logs([stream(), slow()], window=0,
+                                     maxsize=5)
+    first = next(merged)
+    assert first[2] == "0"
+    assert len(read) < 10
+    release.set()
+    assert len(list(merged)) == 99
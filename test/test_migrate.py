@@ -0,0 +1,84 @@
+import json
+
+import pytest
+
+from src import beebop_deploy
+from src import beebop_migrate
+
+
+def test_find_migrations():
+    assert beebop_migrate.find_migrations() == [
+        ("20241008_default_species",
+         "migrations/20241008_default_species.sh"),
+        ("20250227_viz_move", "migrations/20250227_viz_move")]
+
+
+def test_migrate_runs_pending_migrations(fake_docker):
+    cfg = beebop_deploy.BeebopConfig("config", "fake")
+    obj = beebop_deploy.beebop_constellation(cfg)
+    with pytest.raises(Exception, match="start beebop first"):
+        beebop_migrate.beebop_migrate(obj, {"dry_run": False, "name": None})
+
+    api = fake_docker.containers.run("api", name="beebop-api")
+    fake_docker.containers.run("redis", name="beebop-redis")
+    journals = {}
+    commands = []
+
+    def exec_handler(container, cmd):
+        commands.append((container.name, cmd[0]))
+        if cmd[0] == "cat":
+            if cmd[1] in journals:
+                return (0, journals[cmd[1]].encode("UTF-8"))
+            return (1, b"")
+        if cmd[0] == "sh":
+            journals[cmd[4]] = cmd[3]
+        return (0, b"")
+    fake_docker.containers.exec_handler = exec_handler
+
+    beebop_migrate.beebop_migrate(obj, {"dry_run": False, "name": None})
+    assert ("beebop-redis", "bash") in commands
+    assert ("beebop-api", "python3") in commands
+    assert "/beebop/storage/.migrations/20250227_viz_move/migration.py" in \
+        api.files
+    assert json.loads(journals[beebop_migrate.journal_path(
+        "20241008_default_species")])["completed"]
+
+    commands.clear()
+    beebop_migrate.beebop_migrate(
+        obj, {"dry_run": False, "name": "20241008_default_species"})
+    assert ("beebop-redis", "bash") not in commands
+
+    with pytest.raises(Exception, match="Unknown migration"):
+        beebop_migrate.beebop_migrate(obj, {"dry_run": True, "name": "x"})
+
+
+def test_migrations_applied_by_hand_can_be_marked(fake_docker):
+    cfg = beebop_deploy.BeebopConfig("config", "fake")
+    obj = beebop_deploy.beebop_constellation(cfg)
+    fake_docker.containers.run("api", name="beebop-api")
+    fake_docker.containers.run("redis", name="beebop-redis")
+    journals = {}
+    commands = []
+
+    def exec_handler(container, cmd):
+        commands.append((container.name, cmd[0]))
+        if cmd[0] == "cat":
+            if cmd[1] in journals:
+                return (0, journals[cmd[1]].encode("UTF-8"))
+            return (1, b"")
+        if cmd[0] == "sh":
+            journals[cmd[4]] = cmd[3]
+        return (0, b"")
+    fake_docker.containers.exec_handler = exec_handler
+
+    for name in ["20241008_default_species", "20250227_viz_move"]:
+        beebop_migrate.beebop_migrate(
+            obj, {"dry_run": False, "name": name, "mark_applied": True})
+    assert json.loads(journals[beebop_migrate.journal_path(
+        "20250227_viz_move")]) == {"migration": "20250227_viz_move",
+                                   "completed": True,
+                                   "marked_applied": True}
+    commands.clear()
+    beebop_migrate.beebop_migrate(obj, {"dry_run": False, "name": None})
+    assert ("beebop-redis", "bash") not in commands
+    assert ("beebop-api", "python3") not in commands
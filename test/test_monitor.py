@@ -0,0 +1,142 @@
+import json
+
+import fakeredis
+
+from src import beebop_deploy
+from src import beebop_monitor
+
+
+def constellation(fake_docker):
+    cfg = beebop_deploy.BeebopConfig(
+        "config", "fake", options={"worker": {"count": 2}})
+    obj = beebop_deploy.beebop_constellation(cfg)
+    for name in ["api", "server", "proxy", "redis", "worker-aaaa",
+                 "worker-bbbb"]:
+        fake_docker.containers.run("image", name="beebop-" + name)
+    commands = []
+
+    def exec_handler(container, cmd):
+        commands.append(cmd)
+        if cmd[0] == "df":
+            return 0, b"      Used     Avail\n 1000 9000\n"
+        if cmd[0] == "du":
+            return 0, "{}\t/beebop/storage\n".format(
+                500 + len(commands)).encode()
+        return 0, b""
+    fake_docker.containers.exec_handler = exec_handler
+    return obj, commands
+
+
+def rq(r):
+    r.sadd("rq:queues", "rq:queue:beebop")
+    r.rpush("rq:queue:beebop", "a", "b", "c")
+    r.zadd("rq:wip:beebop", {"d": 1})
+    r.zadd("rq:failed:beebop", {"e": 1, "f": 1})
+    for i, state in enumerate(["busy", "idle", "idle"]):
+        r.sadd("rq:workers", "rq:worker:{}".format(i))
+        r.hset("rq:worker:{}".format(i),
+               mapping={"hostname": str(i), "state": state})
+
+
+def test_sampler_collects_containers_redis_and_storage(fake_docker):
+    obj, commands = constellation(fake_docker)
+    r = fakeredis.FakeRedis()
+    rq(r)
+    t = [100]
+    sampler = beebop_monitor.Sampler(obj, r, du_every=2, clock=lambda: t[0],
+                                     process_time=lambda: t[0] / 1000)
+    api = fake_docker.containers.store["beebop-api"]
+    api.usage = {"cpu": 1e9, "system": 100e9, "mem": 2000}
+    first = sampler.sample()
+    assert first["time"] == 100
+    assert first["containers"]["api"] == {
+        "cpu_seconds": 1, "mem": 2000, "mem_limit": 8 * 1024 ** 3}
+    assert sorted(first["containers"]) == [
+        "api", "proxy", "redis", "server", "worker-aaaa", "worker-bbbb"]
+    assert first["redis"] == {
+        "queues": {"beebop": {"queued": 3, "started": 1, "failed": 2}},
+        "workers": {"busy": 1, "idle": 2}}
+    assert first["storage"]["fs_used"] == 1000
+    assert first["storage"]["fs_avail"] == 9000
+    assert "overhead" not in first
+
+    t[0] = 110
+    api.usage = {"cpu": 3e9, "system": 140e9, "mem": 3000}
+    second = sampler.sample()
+    # 2s of the container's cpu over 40s of all four cpus' time
+    assert second["containers"]["api"]["cpu"] == 0.2
+    assert round(second["overhead"], 6) == 0.001
+    # du is only run every du_every samples
+    assert second["storage"]["bytes"] == first["storage"]["bytes"]
+    assert [x[0] for x in commands] == ["df", "du", "df"]
+    sampler.sample()
+    assert [x[0] for x in commands][-2:] == ["df", "du"]
+
+
+def test_sampler_reports_errors_and_keeps_going(fake_docker):
+    obj, commands = constellation(fake_docker)
+    fake_docker.containers.store["beebop-api"].status = "exited"
+    r = fakeredis.FakeRedis()
+    r.smembers = lambda key: r.execute_command("NOSUCHCOMMAND")
+    sample = beebop_monitor.Sampler(obj, r).sample()
+    assert "not running" in sample["storage"]["error"]
+    assert "error" in sample["redis"]
+    assert "api" not in sample["containers"]
+    assert "worker-aaaa" in sample["containers"]
+
+
+def test_append_sample_rotates_file(tmp_path):
+    path = str(tmp_path / "monitor")
+    for i in range(5):
+        beebop_monitor.append_sample(path, {"time": i, "x": "y" * 20},
+                                     rotate_bytes=60)
+    with open(path) as f:
+        assert [json.loads(x)["time"] for x in f] == [4]
+    with open(path + ".1") as f:
+        assert [json.loads(x)["time"] for x in f] == [2, 3]
+
+
+def test_monitor_appends_samples(fake_docker, tmp_path):
+    obj, commands = constellation(fake_docker)
+    r = fakeredis.FakeRedis()
+    rq(r)
+    t = [0]
+    slept = []
+
+    def sleep(s):
+        slept.append(s)
+        t[0] += s
+    path = str(tmp_path / "monitor")
+    args = {"interval": 60, "output": path, "prometheus": False,
+            "samples": 3}
+    beebop_monitor.beebop_monitor(obj, args, r, clock=lambda: t[0],
+                                  sleep=sleep)
+    assert slept == [60, 60]
+    with open(path) as f:
+        samples = [json.loads(x) for x in f]
+    assert len(samples) == 3
+    assert "overhead" in samples[-1]
+    assert samples[0]["redis"]["workers"] == {"busy": 1, "idle": 2}
+
+
+def test_monitor_writes_prometheus_textfile(fake_docker, tmp_path):
+    obj, commands = constellation(fake_docker)
+    r = fakeredis.FakeRedis()
+    rq(r)
+    path = str(tmp_path / "beebop.prom")
+    args = {"interval": 60, "output": path, "prometheus": True,
+            "samples": 1}
+    beebop_monitor.beebop_monitor(obj, args, r)
+    with open(path) as f:
+        text = f.read()
+    lines = text.splitlines()
+    assert 'beebop_rq_jobs{constellation="beebop",queue="beebop",' \
+        'state="queued"} 3' in lines
+    assert 'beebop_rq_workers{constellation="beebop",state="idle"} 2' \
+        in lines
+    assert 'beebop_container_memory_bytes{constellation="beebop",' \
+        'container="worker-aaaa"} 0' in lines
+    assert 'beebop_storage_filesystem_bytes{constellation="beebop",' \
+        'type="avail"} 9000' in lines
+    assert lines.count("# TYPE beebop_rq_jobs gauge") == 1
+    assert not (tmp_path / "beebop.prom.tmp").exists()
@@ -0,0 +1,81 @@
+import json
+
+import docker
+import requests
+
+from src import beebop_deploy
+from src import beebop_profile
+
+
+def test_phase_is_noop_without_profile():
+    with beebop_profile.phase("pull", "redis"):
+        beebop_profile.add("bytes_pulled", 10)
+    assert beebop_profile._active is None
+
+
+def test_profile_start_records_each_phase(fake_docker, tmp_path):
+    cfg = beebop_deploy.BeebopConfig("config", "fake")
+    fake_docker.api.layers[str(cfg.api_ref)] = [("base", 1000)]
+    obj = beebop_deploy.beebop_constellation(cfg)
+    for x in obj.containers.collection:
+        x.configure = None
+    obj.containers.find("proxy").configure = lambda container, cfg: None
+    fake_docker.containers.exec_handler = lambda c, cmd: (0, b"PONG")
+
+    with beebop_profile.profiling("start", "fake", str(tmp_path)):
+        beebop_deploy.beebop_start(obj, {"pull_images": True})
+    with beebop_profile.profiling("start", "fake", str(tmp_path)):
+        pass
+
+    with open(beebop_profile.path_profile(str(tmp_path))) as f:
+        reports = [json.loads(x) for x in f]
+    assert len(reports) == 2
+    report = reports[0]
+    assert report["action"] == "start"
+    assert report["config"] == "fake"
+    phases = {(x["phase"], x["container"]): x for x in report["phases"]}
+    assert phases[("pull", str(cfg.api_ref))]["bytes_pulled"] == 1000
+    for name in ["redis", "api", "server", "proxy"]:
+        assert ("create", name) in phases
+        assert ("ready", name) in phases
+    assert ("configure", "proxy") in phases
+    assert ("configure", "api") not in phases
+    assert len([x for x in phases if x[0] == "create" and
+                x[1].startswith("worker-")]) == 2
+    assert ("network", None) in phases
+    assert reports[1]["phases"] == []
+
+
+class FakeAdapter(requests.adapters.BaseAdapter):
+    def send(self, request, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.headers["Content-Length"] = "7"
+        response._content = b'"hello"'
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def test_profile_counts_docker_api_calls(tmp_path):
+    client = docker.api.client.APIClient(base_url="tcp://127.0.0.1:1",
+                                         version="1.41")
+    client.mount("http://", FakeAdapter())
+    with beebop_profile.profiling("status", None, str(tmp_path)) as p:
+        with beebop_profile.phase("status"):
+            client.get("http://127.0.0.1:1/containers/json")
+            client.post("http://127.0.0.1:1/containers/create",
+                        data=b"{}")
+        client.get("http://127.0.0.1:1/version")
+    report = p.report()
+    assert report["api_calls"] == 3
+    status, other = report["phases"]
+    assert status["phase"] == "status"
+    assert status["api_calls"] == 2
+    assert status["bytes_sent"] == 2
+    assert status["bytes_received"] == 14
+    assert other["phase"] == "other"
+    assert other["api_calls"] == 1
+    assert "send" not in vars(docker.api.client.APIClient)
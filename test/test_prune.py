@@ -0,0 +1,111 @@
+import importlib.machinery
+import importlib.util
+import os
+
+import fakeredis
+import pytest
+
+from src import beebop_deploy
+from src import beebop_prune
+
+DAY = 24 * 60 * 60
+
+
+@pytest.fixture
+def prune_outputs(monkeypatch):
+    monkeypatch.syspath_prepend("src")
+    loader = importlib.machinery.SourceFileLoader(
+        "prune_outputs", "scripts/prune_outputs")
+    module = importlib.util.module_from_spec(
+        importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(module)
+    return module
+
+
+def output(base, name, age, now, size=100):
+    path = os.path.join(base, name, "network")
+    os.makedirs(path)
+    with open(os.path.join(path, "network.csv"), "wb") as f:
+        f.write(b"x" * size)
+    for p in [path, os.path.dirname(path), os.path.join(path, "network.csv")]:
+        os.utime(p, (now - age, now - age))
+
+
+def project(r, name, status="finished"):
+    r.hset("beebop:hash:job:assign", name, "assign-" + name)
+    r.hset("beebop:hash:job:visualise:" + name, "3", "vis-" + name)
+    r.hset("rq:job:assign-" + name,
+           mapping={"status": status, "origin": "beebop"})
+    r.hset("rq:job:vis-" + name,
+           mapping={"status": "finished", "origin": "beebop"})
+    r.zadd("rq:finished:beebop", {"vis-" + name: 1})
+    if status == "finished":
+        r.zadd("rq:finished:beebop", {"assign-" + name: 1})
+
+
+def test_prune_removes_old_outputs_and_their_redis_entries(prune_outputs,
+                                                           tmp_path):
+    now = 1000 * DAY
+    base = str(tmp_path)
+    r = fakeredis.FakeRedis()
+    output(base, "old", 100 * DAY, now, 1000)
+    output(base, "busy", 100 * DAY, now)
+    output(base, "new", DAY, now)
+    for name in ["old", "busy", "new"]:
+        project(r, name, "started" if name == "busy" else "finished")
+
+    res = prune_outputs.prune(r, base, 90 * DAY, dry_run=True, now=now)
+    assert res == {"folders": 1, "bytes": 1000, "redis": 4}
+    assert sorted(os.listdir(base)) == ["busy", "new", "old"]
+    assert r.hexists("beebop:hash:job:assign", "old")
+
+    res = prune_outputs.prune(r, base, 90 * DAY, batch_size=1, now=now)
+    assert res == {"folders": 1, "bytes": 1000, "redis": 4}
+    assert sorted(os.listdir(base)) == ["busy", "new"]
+    assert sorted(r.hkeys("beebop:hash:job:assign")) == [b"busy", b"new"]
+    assert not r.exists("beebop:hash:job:visualise:old")
+    assert not r.exists("rq:job:assign-old", "rq:job:vis-old")
+    assert r.exists("rq:job:vis-busy")
+    # no dangling registry entries are left for RQ to report
+    assert sorted(r.zrange("rq:finished:beebop", 0, -1)) == [
+        b"assign-new", b"vis-busy", b"vis-new"]
+
+
+def test_job_index_reads_hashes_incrementally(prune_outputs, monkeypatch):
+    r = fakeredis.FakeRedis()
+    for i in range(20):
+        project(r, "p{}".format(i))
+    monkeypatch.setattr(r, "hgetall", None)
+    index = prune_outputs.job_index(r, batch_size=3)
+    assert len(index) == 20
+    assert index["p7"][1] == {"assign-p7", "vis-p7"}
+
+
+def test_throttle_limits_deletion_rate(prune_outputs):
+    t = [0]
+    slept = []
+    throttle = prune_outputs.Throttle(100, clock=lambda: t[0],
+                                      sleep=slept.append)
+    throttle(50)
+    assert slept == [0.5]
+    # behind the limit, so no need to wait
+    t[0] = 2
+    throttle(100)
+    assert slept == [0.5]
+    throttle(300)
+    assert slept == [0.5, 2.5]
+
+
+def test_prune_runs_in_api_container(fake_docker):
+    cfg = beebop_deploy.BeebopConfig("config", "fake")
+    obj = beebop_deploy.beebop_constellation(cfg)
+    api = fake_docker.containers.run("api", name="beebop-api")
+    commands = []
+    fake_docker.containers.exec_handler = \
+        lambda c, cmd: commands.append(cmd) or (0, b"")
+    beebop_prune.beebop_prune(obj, {"older_than": "90d", "dry_run": True})
+    assert "/prune/prune_outputs" in api.files
+    assert "/prune/beebop_redis.py" in api.files
+    assert commands[-1] == ["python3", "/prune/prune_outputs", "--dry-run",
+                            "/beebop/storage/poppunk_output",
+                            str(90 * DAY)]
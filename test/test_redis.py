@@ -0,0 +1,56 @@
+import importlib.util
+import logging
+
+import fakeredis
+
+from src import beebop_redis
+
+
+def redis_with_jobs(n):
+    r = fakeredis.FakeRedis()
+    r.hset("beebop:hash:job:microreact", mapping={"p1": "j1", "p2": "j2"})
+    for i in range(n):
+        r.hset("beebop:hash:job:microreact:p{}".format(i),
+               mapping={"1": "a", "2": "b"})
+    r.set("beebop:other", "x")
+    return r
+
+
+def test_scan_keys_batches():
+    r = redis_with_jobs(25)
+    found = [key for batch in
+             beebop_redis.scan_keys(r, "beebop:hash:job:microreact:*", 10)
+             for key in batch]
+    assert len(set(found)) == 25
+
+
+def test_copy_matching_hashes_uses_pipelines():
+    r = redis_with_jobs(25)
+    copied = beebop_redis.copy_matching_hashes(
+        r, "beebop:hash:job:microreact:*",
+        lambda key: key.replace("microreact", "visualise"), batch_size=10)
+    assert len(set(copied)) == 25
+    assert r.hgetall("beebop:hash:job:visualise:p3") == \
+        {b"1": b"a", b"2": b"b"}
+
+
+def test_unlink_matching():
+    r = redis_with_jobs(25)
+    beebop_redis.unlink_matching(r, "beebop:hash:job:microreact:*", 7)
+    assert r.keys("beebop:hash:job:microreact:*") == []
+    assert r.exists("beebop:hash:job:microreact")
+    assert r.exists("beebop:other")
+    assert beebop_redis.unlink_keys(r, ["beebop:other", "missing"]) == 1
+
+
+def test_viz_move_redis_migration(monkeypatch):
+    monkeypatch.syspath_prepend("src")
+    spec = importlib.util.spec_from_file_location(
+        "migration", "migrations/20250227_viz_move/migration.py")
+    migration = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(migration)
+    r = redis_with_jobs(5)
+    migration.update_redis_keys(logging.getLogger(), r, throttle=0)
+    assert r.hgetall("beebop:hash:job:visualise") == \
+        {b"p1": b"j1", b"p2": b"j2"}
+    assert len(r.keys("beebop:hash:job:visualise:*")) == 5
@@ -0,0 +1,130 @@
+import docker
+
+from conftest import FakeDocker
+from src import beebop_deploy
+from src import beebop_rolling
+
+
+def start(fake_docker):
+    fake_docker.containers.exec_handler = lambda c, cmd: (0, b"PONG")
+    cfg = beebop_deploy.BeebopConfig("config", "fake")
+    obj = beebop_deploy.beebop_constellation(cfg)
+    for x in obj.containers.collection:
+        x.configure = None
+    beebop_deploy.beebop_start(obj, {"pull_images": True})
+    return obj
+
+
+def test_rolling_upgrade_replaces_only_changed_containers(fake_docker,
+                                                          monkeypatch):
+    obj = start(fake_docker)
+    execs = []
+    fake_docker.containers.exec_handler = \
+        lambda c, cmd: execs.append((c.name, cmd)) or (0, b"")
+    monkeypatch.setattr(beebop_rolling, "accepts_connections",
+                        lambda obj, port: lambda container: True)
+    before = dict(fake_docker.containers.store)
+    old_workers = [x for x in before if x.startswith("beebop-worker-")]
+    # new api/worker and server images are published
+    for ref in [obj.data.api_ref, obj.data.server_ref]:
+        fake_docker.api.layers[str(ref)] = [(ref.name + "-v2", 10)]
+
+    beebop_rolling.rolling_upgrade(obj)
+
+    store = fake_docker.containers.store
+    for name in ["beebop-redis", "beebop-proxy"]:
+        assert store[name] is before[name]
+        assert store[name].status == "running"
+    for name in ["beebop-api", "beebop-server"]:
+        assert store[name] is not before[name]
+        assert before[name].status == "exited"
+        assert store[name].image.id == fake_docker.images.get(
+            store[name].attrs["Config"]["Image"]).id
+    assert "beebop-api-next" not in store
+    # the new containers answer to the same alias as the old
+    aliases = [kw["networking_config"]["beebop_nw"]["aliases"]
+               for image, cmd, kw in fake_docker.containers.runs]
+    assert aliases.count(["server"]) == 2
+    assert execs.count(("beebop-proxy", ["nginx", "-s", "reload"])) == 2
+
+    workers = [x for x in store if x.startswith("beebop-worker-")]
+    assert len(workers) == 2
+    assert not set(workers) & set(old_workers)
+    for name in old_workers:
+        assert before[name].stopped_with == {"timeout": 600}
+
+
+def test_rolling_upgrade_with_no_changes_restarts_nothing(fake_docker):
+    obj = start(fake_docker)
+    runs = len(fake_docker.containers.runs)
+    beebop_rolling.rolling_upgrade(obj)
+    assert len(fake_docker.containers.runs) == runs
+    assert fake_docker.calls["stop"] == 0
+
+
+def test_rolling_upgrade_replaces_workers_when_redis_restarts(fake_docker,
+                                                              monkeypatch):
+    obj = start(fake_docker)
+    store = fake_docker.containers.store
+    before = dict(store)
+    old_workers = [x for x in before if x.startswith("beebop-worker-")]
+    fake_docker.api.layers[str(obj.data.redis_ref)] = [("redis-v2", 10)]
+    restart = beebop_rolling.restart_container
+
+    # the workers' connections die with the old redis, and they exit
+    def restart_and_disconnect(x, old, obj):
+        restart(x, old, obj)
+        for name in old_workers:
+            before[name].status = "exited"
+    monkeypatch.setattr(beebop_rolling, "restart_container",
+                        restart_and_disconnect)
+    beebop_rolling.rolling_upgrade(obj)
+
+    assert store["beebop-redis"] is not before["beebop-redis"]
+    for name in ["beebop-api", "beebop-server", "beebop-proxy"]:
+        assert store[name] is before[name]
+    workers = [x for x in store if x.startswith("beebop-worker-")]
+    assert len(workers) == 2
+    assert not set(workers) & set(old_workers)
+    assert all(store[x].status == "running" for x in workers)
+
+
+def test_rolling_upgrade_replaces_host_workers_when_redis_restarts(
+        fake_docker, monkeypatch):
+    remote = FakeDocker()
+    monkeypatch.setattr(docker, "DockerClient",
+                        lambda base_url, **kwargs: remote)
+    hosts = [{"name": "node1", "url": "ssh://node1", "count": 2,
+              "redis_host": "10.0.0.1", "storage_path": "/mnt/beebop",
+              "dbs_path": "/mnt/dbs"}]
+    fake_docker.containers.exec_handler = lambda c, cmd: (0, b"PONG")
+    cfg = beebop_deploy.BeebopConfig(
+        "config", "fake",
+        options={"worker": {"hosts": hosts, "redis_bind": "10.0.0.1"}})
+    obj = beebop_deploy.beebop_constellation(cfg)
+    for x in obj.containers.collection:
+        x.configure = None
+    beebop_deploy.beebop_start(obj, {"pull_images": True})
+    before = dict(remote.containers.store)
+    assert len(before) == 2
+
+    runs = len(remote.containers.runs)
+    beebop_rolling.rolling_upgrade(obj)
+    assert len(remote.containers.runs) == runs
+
+    fake_docker.api.layers[str(cfg.redis_ref)] = [("redis-v2", 10)]
+    restart = beebop_rolling.restart_container
+
+    def restart_and_disconnect(x, old, obj):
+        restart(x, old, obj)
+        for c in before.values():
+            c.status = "exited"
+    monkeypatch.setattr(beebop_rolling, "restart_container",
+                        restart_and_disconnect)
+    beebop_rolling.rolling_upgrade(obj)
+
+    after = remote.containers.store
+    assert len(after) == 2
+    assert not set(after) & set(before)
+    assert all(x.startswith("beebop-worker-node1-") for x in after)
+    assert all(x.status == "running" for x in after.values())
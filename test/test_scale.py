@@ -0,0 +1,93 @@
+import fakeredis
+import pytest
+
+from src import beebop_deploy
+from src import beebop_scale
+
+
+def start_workers(fake_docker, n):
+    cfg = beebop_deploy.BeebopConfig("config", "fake")
+    obj = beebop_deploy.beebop_constellation(cfg)
+    beebop_deploy.start_service(obj.containers.find("worker"), obj, n)
+    return obj
+
+
+def register(r, containers, state):
+    for i, x in enumerate(containers):
+        key = "rq:worker:{}".format(x.name)
+        r.sadd("rq:workers", key)
+        r.hset(key, mapping={"hostname": x.attrs["Config"]["Hostname"],
+                             "state": state})
+
+
+def test_scale_up_leaves_other_containers_alone(fake_docker):
+    obj = start_workers(fake_docker, 2)
+    fake_docker.containers.run("redis", name="beebop-redis")
+    assert beebop_scale.scale_workers(obj, 5) == 5
+    assert len(beebop_scale.worker_containers(obj)) == 5
+    assert fake_docker.calls["stop"] == 0
+    assert fake_docker.containers.get("beebop-redis").status == "running"
+
+
+def test_scale_down_removes_only_idle_workers(fake_docker):
+    obj = start_workers(fake_docker, 4)
+    r = fakeredis.FakeRedis()
+    containers = beebop_scale.worker_containers(obj)
+    register(r, containers[:1], "idle")
+    register(r, containers[1:], "busy")
+    assert beebop_scale.scale_workers(obj, 1, r) == 3
+    remaining = beebop_scale.worker_containers(obj)
+    assert containers[0] not in remaining
+    assert len(remaining) == 3
+    assert containers[0].stopped_with == {"timeout": 600}
+
+
+def test_autoscaler_follows_queue_with_cooldowns(fake_docker):
+    obj = start_workers(fake_docker, 1)
+    r = fakeredis.FakeRedis()
+    now = [0]
+    settings = {"min": 1, "max": 4, "interval": 1,
+                "cooldown_up": 10, "cooldown_down": 60}
+    autoscaler = beebop_scale.Autoscaler(obj, r, settings, lambda: now[0])
+
+    r.sadd("rq:queues", "rq:queue:default")
+    r.rpush("rq:queue:default", *["job{}".format(i) for i in range(10)])
+    assert autoscaler.step() == 4
+    assert len(beebop_scale.worker_containers(obj)) == 4
+
+    # queue drains, but we wait for the cooldown before shrinking
+    r.delete("rq:queue:default")
+    register(r, beebop_scale.worker_containers(obj), "idle")
+    now[0] = 30
+    autoscaler.step()
+    assert len(beebop_scale.worker_containers(obj)) == 4
+    now[0] = 61
+    assert autoscaler.step() == 1
+    assert len(beebop_scale.worker_containers(obj)) == 1
+
+
+def test_autoscaler_only_counts_its_pools_queues(fake_docker):
+    options = {"worker": {"pools": {
+        "short": {"count": 1, "queues": ["visualise"]},
+        "long": {"count": 1, "queues": ["assign"]}}}}
+    cfg = beebop_deploy.BeebopConfig("config", "fake", options=options)
+    obj = beebop_deploy.beebop_constellation(cfg)
+    with pytest.raises(Exception, match="choose one with --pool"):
+        beebop_scale.worker_service(obj)
+    short = beebop_scale.worker_service(obj, "short")
+    long = beebop_scale.worker_service(obj, "long")
+    beebop_deploy.start_service(short, obj)
+    beebop_deploy.start_service(long, obj)
+    r = fakeredis.FakeRedis()
+    register(r, beebop_scale.worker_containers(obj, short) +
+             beebop_scale.worker_containers(obj, long), "idle")
+    r.sadd("rq:queues", "rq:queue:assign", "rq:queue:visualise")
+    r.rpush("rq:queue:assign", *["job{}".format(i) for i in range(3)])
+    settings = {"min": 1, "max": 4, "interval": 1,
+                "cooldown_up": 10, "cooldown_down": 60}
+    assert beebop_scale.Autoscaler(obj, r, settings,
+                                   service=short).step() == 1
+    assert beebop_scale.Autoscaler(obj, r, settings,
+                                   service=long).step() == 3
+    assert len(beebop_scale.worker_containers(obj, short)) == 1
+    assert len(beebop_scale.worker_containers(obj, long)) == 3
@@ -0,0 +1,134 @@
+import gzip
+import io
+
+import fakeredis
+import pytest
+
+from src import beebop_snapshot
+
+
+def populate(r, n):
+    for i in range(n):
+        r.hset("beebop:hash:job:assign", "p{}".format(i), "job{}".format(i))
+        r.set("beebop:result:{}".format(i), "x" * 100)
+    r.set("beebop:session", "s", px=60000)
+    r.set("rq:job:other", "not ours")
+
+
+def snapshot(r, **kwargs):
+    f = io.BytesIO()
+    n = beebop_snapshot.export_keys(r, f, **kwargs)
+    f.seek(0)
+    return n, f
+
+
+def test_export_and_import_round_trip():
+    r = fakeredis.FakeRedis()
+    populate(r, 50)
+    n, f = snapshot(r, batch_size=7)
+    assert n == 52
+
+    target = fakeredis.FakeRedis()
+    target.set("beebop:result:0", "newer")
+    assert beebop_snapshot.import_keys(target, f, batch_size=10) == (51, 1)
+    assert target.get("beebop:result:0") == b"newer"
+    assert target.get("beebop:result:49") == b"x" * 100
+    assert target.hlen("beebop:hash:job:assign") == 50
+    assert 0 < target.pttl("beebop:session") <= 60000
+    assert target.pttl("beebop:result:1") == -1
+    assert not target.exists("rq:job:other")
+
+    f.seek(0)
+    assert beebop_snapshot.import_keys(target, f, replace=True) == (52, 0)
+    assert target.get("beebop:result:0") == b"x" * 100
+
+
+def test_export_skips_keys_that_expire_during_export():
+    r = fakeredis.FakeRedis()
+    r.set("beebop:expiring", "x", px=60000)
+    r.set("beebop:persistent", "y")
+    pipeline = r.pipeline
+
+    # the key expires after DUMP but before PTTL
+    def expiring_pipeline(**kwargs):
+        pipe = pipeline(**kwargs)
+        execute = pipe.execute
+
+        def expire_then_execute(**kwargs):
+            keys = [x[0][1] for x in pipe.command_stack]
+            res = execute(**kwargs)
+            return [-2 if i % 2 and keys[i] == b"beebop:expiring" else x
+                    for i, x in enumerate(res)]
+        pipe.execute = expire_then_execute
+        return pipe
+    r.pipeline = expiring_pipeline
+    n, f = snapshot(r)
+    assert n == 1
+    target = fakeredis.FakeRedis()
+    beebop_snapshot.import_keys(target, f)
+    assert target.keys() == [b"beebop:persistent"]
+    assert target.pttl("beebop:persistent") == -1
+
+
+def test_prefix_filters_export_and_import():
+    r = fakeredis.FakeRedis()
+    populate(r, 5)
+    n, f = snapshot(r, prefix="beebop:result:")
+    assert n == 5
+    n, f = snapshot(r)
+    target = fakeredis.FakeRedis()
+    assert beebop_snapshot.import_keys(target, f, prefix="beebop:hash:") == \
+        (1, 0)
+    assert target.keys() == [b"beebop:hash:job:assign"]
+
+
+def test_prefix_is_matched_literally():
+    r = fakeredis.FakeRedis()
+    for key in ["beebop:[a]:1", "beebop:a:1", "beebop:*x", "beebop:yx",
+                "beebop:\\q"]:
+        r.set(key, "v")
+    for prefix, expected in [("beebop:[a]", 1), ("beebop:*", 1),
+                             ("beebop:\\", 1), ("beebop:", 5)]:
+        n, f = snapshot(r, prefix=prefix)
+        assert n == expected
+        target = fakeredis.FakeRedis()
+        assert beebop_snapshot.import_keys(target, f, prefix=prefix)[0] == n
+
+
+def test_import_streams_a_batch_at_a_time():
+    r = fakeredis.FakeRedis()
+    populate(r, 100)
+    n, f = snapshot(r, batch_size=10)
+    beebop_snapshot.read_header(f)
+    records = beebop_snapshot.read_records(f)
+    first = next(records)
+    # only the first chunk has been read from the stream
+    assert first[0].startswith(b"beebop:")
+    assert f.tell() < len(f.getvalue()) / 2
+
+
+def test_import_rejects_other_and_truncated_files():
+    r = fakeredis.FakeRedis()
+    with pytest.raises(Exception, match="Not a beebop redis snapshot"):
+        beebop_snapshot.import_keys(r, io.BytesIO(b"REDIS0009"))
+    populate(r, 10)
+    n, f = snapshot(r)
+    truncated = io.BytesIO(f.getvalue()[:-10])
+    with pytest.raises(Exception, match="truncated"):
+        beebop_snapshot.import_keys(fakeredis.FakeRedis(), truncated)
+
+
+def test_export_writes_gzip_file(tmp_path, monkeypatch):
+    r = fakeredis.FakeRedis()
+    populate(r, 3)
+    monkeypatch.setattr(beebop_snapshot, "redis_connection",
+                        lambda obj, timeout: r)
+    path = str(tmp_path / "beebop.snapshot.gz")
+    args = {"file": path, "prefix": "beebop:", "batch_size": 500}
+    beebop_snapshot.beebop_redis_export(None, args)
+    with gzip.open(path, "rb") as f:
+        assert beebop_snapshot.read_header(f)["prefix"] == "beebop:"
+    assert not (tmp_path / "beebop.snapshot.gz.tmp").exists()
+    r.flushall()
+    beebop_snapshot.beebop_redis_import(None, dict(args, replace=False))
+    assert r.get("beebop:result:2") == b"x" * 100
@@ -0,0 +1,120 @@
+import io
+import json
+import threading
+import time
+import urllib.error
+from contextlib import redirect_stdout
+
+import docker
+import fakeredis
+
+from src import beebop_deploy
+from src import beebop_status
+
+
+class FakeResponse:
+    status = 200
+
+    def read(self):
+        return b'{"status": "success"}'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def start(fake_docker):
+    cfg = beebop_deploy.BeebopConfig("config", "fake")
+    obj = beebop_deploy.beebop_constellation(cfg)
+    for x in obj.containers.collection:
+        x.configure = None
+    fake_docker.containers.exec_handler = lambda c, cmd: (0, b"PONG")
+    beebop_deploy.beebop_start(obj, {"pull_images": True})
+    return obj
+
+
+def test_status_reports_every_check(fake_docker, monkeypatch):
+    obj = start(fake_docker)
+    urls = []
+    monkeypatch.setattr(beebop_status.urllib.request, "urlopen",
+                        lambda url, **kwargs: urls.append(url) or
+                        FakeResponse())
+    r = fakeredis.FakeRedis()
+    r.sadd("rq:queues", "rq:queue:beebop")
+    r.rpush("rq:queue:beebop", "a", "b")
+    r.zadd("rq:failed:beebop", {"c": 1})
+    for i, state in enumerate(["idle", "busy", "idle"]):
+        r.sadd("rq:workers", "rq:worker:{}".format(i))
+        r.hset("rq:worker:{}".format(i),
+               mapping={"hostname": str(i), "state": state})
+    # A newer api image has been pulled since the containers started
+    fake_docker.images.add(str(obj.data.api_ref), [("newer", 10)])
+
+    report = beebop_status.health_report(obj, r)
+    assert report["network"] == {"name": "beebop_nw", "exists": True}
+    assert all(x["exists"] for x in report["volumes"])
+    containers = {x["name"]: x for x in report["containers"]}
+    assert containers["beebop-redis"]["status"] == "running"
+    assert containers["beebop-redis"]["image_current"]
+    assert not containers["beebop-api"]["image_current"]
+    workers = [x for x in report["containers"] if x["role"] == "worker"]
+    assert len(workers) == 2
+    assert not any(x["image_current"] for x in workers)
+    assert report["redis"]["queues"] == {
+        "beebop": {"queued": 2, "failed": 1}}
+    assert report["redis"]["workers"] == {"idle": 2, "busy": 1}
+    assert report["api"]["status"] == 200
+    assert urls == ["{}/version".format(obj.data.server_url)]
+    # the containers were found with one list call, not one per replica
+    assert fake_docker.calls["api.containers"] == 1
+
+    f = io.StringIO()
+    with redirect_stdout(f):
+        beebop_status.print_report(report)
+    out = f.getvalue()
+    assert "api (beebop-api): running, image outdated" in out
+    assert "queue beebop: 2 queued, 1 failed" in out
+
+
+def test_status_reports_failed_checks(fake_docker, monkeypatch):
+    cfg = beebop_deploy.BeebopConfig("config", "fake")
+    obj = beebop_deploy.beebop_constellation(cfg)
+
+    def unreachable(url, **kwargs):
+        raise urllib.error.URLError("timed out")
+    monkeypatch.setattr(beebop_status.urllib.request, "urlopen", unreachable)
+
+    f = io.StringIO()
+    with redirect_stdout(f):
+        beebop_status.beebop_status(obj, {"json": True})
+    report = json.loads(f.getvalue())
+    assert report["redis"] == {"error": "redis is not running"}
+    assert "timed out" in report["api"]["error"]
+    assert {x["status"] for x in report["containers"]} == {"missing"}
+    assert report["network"]["exists"] is False
+
+
+def test_status_does_not_wait_for_a_stuck_check(fake_docker, monkeypatch):
+    obj = start(fake_docker)
+    monkeypatch.setattr(beebop_status.urllib.request, "urlopen",
+                        lambda url, **kwargs: FakeResponse())
+    timeouts = []
+    monkeypatch.setattr(docker.client, "from_env",
+                        lambda **kwargs: timeouts.append(kwargs["timeout"])
+                        or fake_docker)
+    release = threading.Event()
+
+    def stuck(obj, client):
+        release.wait(10)
+        return []
+    monkeypatch.setattr(beebop_status, "volume_status", stuck)
+    t0 = time.time()
+    report = beebop_status.health_report(obj, fakeredis.FakeRedis(),
+                                         timeout=0.2)
+    release.set()
+    assert time.time() - t0 < 1
+    assert report["volumes"] == {"error": "timeout"}
+    assert report["network"]["exists"]
+    assert set(timeouts) == {0.2}
@@ -0,0 +1,148 @@
+import importlib.util
+import logging
+import os
+import shutil
+
+import pytest
+
+from src import beebop_storage
+
+
+@pytest.fixture
+def benchmark():
+    spec = importlib.util.spec_from_file_location(
+        "benchmark", "migrations/20250227_viz_move/benchmark.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def tree(base_folder):
+    return sorted(os.path.relpath(os.path.join(root, f), base_folder)
+                  for root, dirs, files in os.walk(base_folder)
+                  for f in files)
+
+
+def test_index_folders(tmp_path, benchmark):
+    base_folder = str(tmp_path / "poppunk_output")
+    benchmark.make_tree(base_folder, 2, 2)
+    index = beebop_storage.index_folders(base_folder)
+    assert sorted(index) == ["project0", "project1"]
+    assert sorted(index["project0"]) == \
+        ["microreact_1", "microreact_2", "network"]
+    assert index["project1"]["microreact_2"] == {"microreact_2_core_NJ.nwk"}
+
+
+def test_indexed_migration_matches_original(tmp_path, benchmark):
+    logger = logging.getLogger("test")
+    results = []
+    for i, f in enumerate([benchmark.legacy_migrate,
+                           benchmark.indexed_migrate]):
+        base_folder = str(tmp_path / str(i))
+        benchmark.make_tree(base_folder, 3, 4)
+        # an existing visualise folder and a pre-existing pruned copy
+        os.makedirs(os.path.join(base_folder, "project0", "visualise_2"))
+        with open(os.path.join(base_folder, "project1", "network",
+                               "pruned_network_component_1.graphml"),
+                  "w") as fh:
+            fh.write("pruned")
+        f(base_folder, logger)
+        results.append(tree(base_folder))
+    assert results[0] == results[1]
+    assert "project2/visualise_3/visualise_3_cytoscape.csv" in results[1]
+
+
+def test_indexed_migration_is_idempotent(tmp_path, benchmark):
+    logger = logging.getLogger("test")
+    base_folder = str(tmp_path)
+    benchmark.make_tree(base_folder, 2, 3)
+    benchmark.indexed_migrate(base_folder, logger)
+    index = beebop_storage.index_folders(base_folder)
+    plans = benchmark.migration.plan_storage_migration(index, logger)
+    assert all(not ops for ops in plans.values())
+
+
+def test_snapshot_backs_up_touched_paths_and_restores(tmp_path, benchmark):
+    logger = logging.getLogger("test")
+    base_folder = str(tmp_path / "poppunk_output")
+    backup_folder = base_folder + "_backup"
+    benchmark.make_tree(base_folder, 3, 2)
+    untouched = os.path.join(base_folder, "project0", "notes.txt")
+    with open(untouched, "w") as f:
+        f.write("keep")
+    before = tree(base_folder)
+
+    index = beebop_storage.index_folders(base_folder)
+    plans = benchmark.migration.plan_storage_migration(index, logger)
+    manifest = beebop_storage.create_snapshot(
+        base_folder, backup_folder, plans, logger)
+    assert "project0/microreact_1" in manifest["saved"]
+    assert "project0/network/network_component_1.graphml" in \
+        manifest["saved"]
+    assert "project0/notes.txt" not in tree(backup_folder)
+    # backups share storage with the originals
+    original = os.path.join(base_folder, "project0", "microreact_1",
+                            "microreact_1_core_NJ.nwk")
+    backup = os.path.join(backup_folder, "project0", "microreact_1",
+                          "microreact_1_core_NJ.nwk")
+    assert os.path.samefile(original, backup)
+
+    beebop_storage.run_operations(base_folder, plans, logger)
+    assert tree(base_folder) != before
+    beebop_storage.restore_snapshot(base_folder, backup_folder, logger)
+    assert tree(base_folder) == before
+
+
+def test_snapshot_restores_partial_migration(tmp_path, benchmark):
+    logger = logging.getLogger("test")
+    base_folder = str(tmp_path / "poppunk_output")
+    backup_folder = base_folder + "_backup"
+    benchmark.make_tree(base_folder, 2, 2)
+    before = tree(base_folder)
+    index = beebop_storage.index_folders(base_folder)
+    plans = benchmark.migration.plan_storage_migration(index, logger)
+    beebop_storage.create_snapshot(base_folder, backup_folder, plans, logger)
+    beebop_storage.run_operations(
+        base_folder, {"project0": plans["project0"]}, logger)
+    beebop_storage.restore_snapshot(base_folder, backup_folder, logger)
+    assert tree(base_folder) == before
+
+
+def test_restore_full_copy_backup_without_manifest(tmp_path, benchmark):
+    logger = logging.getLogger("test")
+    base_folder = str(tmp_path / "poppunk_output")
+    backup_folder = base_folder + "_backup"
+    benchmark.make_tree(base_folder, 2, 2)
+    before = tree(base_folder)
+    # as made by the old run.sh
+    shutil.copytree(base_folder, backup_folder)
+    benchmark.indexed_migrate(base_folder, logger)
+    assert tree(base_folder) != before
+    beebop_storage.restore_snapshot(base_folder, backup_folder, logger)
+    assert tree(base_folder) == before
+    assert not os.path.exists(backup_folder)
+    assert not os.path.exists(base_folder + ".rollback")
+
+
+def test_backup_never_replaces_a_completed_backup(tmp_path, benchmark):
+    logger = logging.getLogger("test")
+    base_folder = str(tmp_path / "poppunk_output")
+    backup_folder = base_folder + "_backup"
+    benchmark.make_tree(base_folder, 2, 2)
+    index = beebop_storage.index_folders(base_folder)
+    plans = benchmark.migration.plan_storage_migration(index, logger)
+
+    # an interrupted backup is started again
+    os.makedirs(os.path.join(backup_folder + ".partial", "project0"))
+    benchmark.migration.create_backup(base_folder, logger, plans)
+    assert not os.path.exists(backup_folder + ".partial")
+    assert os.path.exists(os.path.join(backup_folder, "manifest.json"))
+
+    with pytest.raises(Exception, match="already exists"):
+        benchmark.migration.create_backup(base_folder, logger, plans)
+    # nor is a full copy made by the old run.sh, which has no manifest
+    shutil.rmtree(backup_folder)
+    shutil.copytree(base_folder, backup_folder)
+    with pytest.raises(Exception, match="already exists"):
+        benchmark.migration.create_backup(base_folder, logger)
+    assert tree(backup_folder) == tree(base_folder)
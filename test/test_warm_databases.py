@@ -0,0 +1,25 @@
+import importlib.machinery
+import importlib.util
+import os
+
+loader = importlib.machinery.SourceFileLoader(
+    "warm_databases", "scripts/warm_databases")
+warm_databases = importlib.util.module_from_spec(
+    importlib.util.spec_from_loader(loader.name, loader))
+loader.exec_module(warm_databases)
+
+
+def test_warm_reads_each_requested_database(tmp_path, capsys):
+    dbs = str(tmp_path)
+    for name, size in [("a", 100), ("b", 2000), ("c", 5)]:
+        os.makedirs(os.path.join(dbs, name, "sub"))
+        with open(os.path.join(dbs, name, "sub", name + ".h5"), "wb") as f:
+            f.write(b"x" * size)
+    with open(os.path.join(dbs, ".manifest.json"), "w") as f:
+        f.write("{}")
+
+    res = warm_databases.warm(dbs, ["a", "b"], max_workers=2)
+    assert (res["files"], res["bytes"]) == (2, 2100)
+    res = warm_databases.warm(dbs)
+    assert (res["files"], res["bytes"]) == (3, 2105)
+    assert "from 3 files" in capsys.readouterr().out